@@ -1,19 +1,30 @@
 # -*- coding: utf-8 -*-
 import logging
 import os
+import sys
 from pathlib import Path
 
 import click
 
+import tools_path  # noqa: F401
+from metrics import metrics_options, start_metrics
+
 
 @click.command()
 @click.argument('input_filepath', type=click.Path(exists=True))
 @click.argument('output_filepath', type=click.Path())
-def main(input_filepath, output_filepath):
+@metrics_options
+def main(input_filepath, output_filepath, profile, metrics_file):
     """
     Extracts text from OCR'd PDF-files
     """
     logger = logging.getLogger(__name__)
+    metrics = start_metrics(
+        sys.modules[__name__], [], profile, metrics_file, logger,
+    )
+    if metrics is not None:
+        # pdftotext is the only stage of this script
+        metrics.instrument(os, ['system'])
     logger.info(f'Reading files from {input_filepath}')
     input_fp = Path(input_filepath)
     output_fp = Path(output_filepath)
@@ -1,21 +1,29 @@
 # -*- coding: utf-8 -*-
 import logging
 import os
+import sys
 from pathlib import Path
 
 import click
 
+import tools_path  # noqa: F401
+from metrics import metrics_options, start_metrics
 from xml_to_txt import xml_converter
 
 
 @click.command()
 @click.argument('input_filepath', type=click.Path(exists=True))
 @click.argument('output_filepath', type=click.Path())
-def main(input_filepath, output_filepath):
+@metrics_options
+def main(input_filepath, output_filepath, profile, metrics_file):
     """
     Extracts text from OCR'd XML-files
     """
     logger = logging.getLogger(__name__)
+    start_metrics(
+        sys.modules[__name__], ['xml_converter'], profile, metrics_file,
+        logger,
+    )
     logger.info(f'Reading files from {input_filepath}')
     input_fp = Path(input_filepath)
     output_fp = Path(output_filepath)
@@ -5,12 +5,15 @@ import subprocess
 from pathlib import Path
 import re
 import shutil
+import sys
 
 import click
-import requests
-from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectionError, HTTPError, Timeout
 from bs4 import BeautifulSoup
 
+import tools_path  # noqa: F401
+from metrics import metrics_options, start_metrics
+from transport import CircuitOpenError, Transport
 from xml_to_txt import xml_converter
 
 
@@ -18,13 +21,32 @@ from xml_to_txt import xml_converter
 @click.argument('url', type=click.STRING)
 @click.argument('pdf_filepath', type=click.Path())
 @click.argument('output_filepath', type=click.Path())
-@click.option('--filter', 'filter_rule', type=click.STRING, default='.', help='regular expression for selecting downloaded directories')
-def main(url, pdf_filepath, output_filepath, filter_rule):
+@click.option(
+    '--filter', 'filter_rule', type=click.STRING, default='.',
+    help='regular expression for selecting downloaded directories',
+)
+@metrics_options
+def main(
+        url, pdf_filepath, output_filepath, filter_rule, profile,
+        metrics_file,
+):
     """
     Download pdfs from riksdagstryck site
     """
     logger = logging.getLogger(__name__)
-    headers = {'User-Agent': "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/42.0.2311.135 Safari/537.36 Edge/12.246"}
+    metrics = start_metrics(
+        sys.modules[__name__], [], profile, metrics_file, logger,
+    )
+    if metrics is not None:
+        # wget and pdftotext are the stages of this script
+        metrics.instrument(Transport, ['get'])
+        metrics.instrument(subprocess, ['run'])
+        metrics.instrument(shutil, ['rmtree'])
+    headers = {'User-Agent': (
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+        "(KHTML, like Gecko) Chrome/42.0.2311.135 Safari/537.36 Edge/12.246"
+    )}
+    transport = Transport(headers=headers)
     url = url.rstrip('/')
     output_fp = Path(output_filepath)
     if not output_fp.is_dir():
@@ -33,18 +55,23 @@ def main(url, pdf_filepath, output_filepath, filter_rule):
     try:
         re.compile(filter_rule)
     except re.error as e:
-        logger.error(f'{filter_rule} is not valid regex, using default (all) - {e}')
+        logger.error(
+            f'{filter_rule} is not valid regex, using default (all) - {e}'
+        )
         filter_rule = '.'
 
     logger.info(f"Downloading a list of directories from {url}")
     try:
-        r = requests.get(url=url, headers=headers)
-    except ConnectionError as e:
+        r = transport.get(url)
+    except (ConnectionError, HTTPError, Timeout, CircuitOpenError) as e:
         logger.error(f'Connection failed, exiting - {e}')
         return
 
     soup = BeautifulSoup(r.content, features='html.parser')
-    dirs = [link.get('href').rstrip('/') for link in soup.find_all('a') if re.search('\d{4}', link.string)]
+    dirs = [
+        link.get('href').rstrip('/') for link in soup.find_all('a')
+        if re.search('\d{4}', link.string)
+    ]
     dir_filter = lambda x: re.search(filter_rule, x)
 
     os.chdir(pdf_filepath)
@@ -52,7 +79,10 @@ def main(url, pdf_filepath, output_filepath, filter_rule):
         dir_url = f'{url}/{dir_}'
         logger.info(f'Downloading pdfs from {dir_}')
         try:
-            sub_wget = subprocess.run(['wget', '-r', '-np', '-l 1', '-e robots=off', dir_url], capture_output=True)
+            sub_wget = subprocess.run(
+                ['wget', '-r', '-np', '-l 1', '-e robots=off', dir_url],
+                capture_output=True,
+            )
             logger.info(f'wget finished with exit code {sub_wget.returncode}')
             sub_wget.check_returncode()
         except subprocess.CalledProcessError as e:
@@ -60,13 +90,21 @@ def main(url, pdf_filepath, output_filepath, filter_rule):
             return
         
         dir_fp = Path.cwd() / 'weburn.kb.se/riks/ståndsriksdagen/pdf' / dir_
-        logger.info(f'Converting pdfs from {dir_fp} to txt in {output_filepath}')
+        logger.info(
+            f'Converting pdfs from {dir_fp} to txt in {output_filepath}'
+        )
         pdf_list = list(dir_fp.glob('**/*.pdf'))
         for pdf_fp in pdf_list:
             try:
                 txt_fp = output_fp / f'{pdf_fp.stem}.txt'
-                sub_pdftotext = subprocess.run(['pdftotext', '-enc', 'UTF-8', pdf_fp, txt_fp], capture_output=True)
-                logger.info(f'pdftotext finished with exit code {sub_pdftotext.returncode}')
+                sub_pdftotext = subprocess.run(
+                    ['pdftotext', '-enc', 'UTF-8', pdf_fp, txt_fp],
+                    capture_output=True,
+                )
+                logger.info(
+                    'pdftotext finished with exit code '
+                    f'{sub_pdftotext.returncode}'
+                )
                 sub_pdftotext.check_returncode()
                 logger.info(f'{pdf_fp} converted and saved to {txt_fp}')
             except subprocess.CalledProcessError as e:
@@ -1,6 +1,5 @@
 from pathlib import Path
 from typing import Sequence
-from collections import defaultdict
 import time
 import logging
 
@@ -9,6 +8,9 @@ from sqlalchemy import create_engine
 from sqlalchemy.engine import Engine
 from sqlalchemy.exc import ProgrammingError, OperationalError, NoSuchTableError
 
+import tools_path  # noqa: F401
+from kwic_database import kwic_rows, limit_rows, size_limits
+
 
 class DataBaseError(Exception):
     pass
@@ -73,15 +75,9 @@ def word_to_sql(
         logging.debug(f'{file.name} is empty, moving on')
         return
 
-    df.sort_values(by='year', inplace=True)
-    df = df.head(size_limit[file.stem])
+    df = limit_rows(df, size_limit[file.stem])
     df.index.rename('index', inplace=False)
-    df['term'] = [file.stem] * len(df.index)
-
-    if 'type' in df.columns:
-        df['lemma'] = df.type.isin(['lemma', 'both'])
-        df['regex'] = df.type.isin(['regex', 'both'])
-        df.drop(columns='type', inplace=True)
+    df = kwic_rows(df, file.stem)
 
     logging.info(f'Saving {file.stem} to database')
 
@@ -103,8 +99,10 @@ def create_index(engine: Engine, directory: str):
         )
         logging.info(f"Index created for {directory}")
     except NoSuchTableError:
-        logging.critical(f"Index creation failed because table '{directory}' does not exist. "
-              f"Check if directory '{directory}' is empty.")
+        logging.critical(
+            f"Index creation failed because table '{directory}' does not "
+            f"exist. Check if directory '{directory}' is empty."
+        )
 
 
 def main() -> None:
@@ -115,8 +113,7 @@ def main() -> None:
     )
     data_dir = Path.home() / 'gd_data/processed'
 
-    limit_dict = defaultdict(lambda: 2_000)
-    limit_dict['fred'] = 20_000
+    limit_dict = size_limits(2_000)
 
     with open('secrets') as fopen:
         database_url = fopen.read()
@@ -0,0 +1,11 @@
+"""
+Puts src/tools on the module path. The tools import each other as top-level
+modules, so the data scripts import them the same way after importing this.
+"""
+import sys
+from pathlib import Path
+
+TOOLS_DIR = str(Path(__file__).resolve().parent.parent / 'tools')
+
+if TOOLS_DIR not in sys.path:
+    sys.path.append(TOOLS_DIR)
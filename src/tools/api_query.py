@@ -1,20 +1,132 @@
+import asyncio
+from collections import deque
+from collections.abc import Generator
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import functools
+from itertools import islice
+from operator import itemgetter
 from pathlib import Path
+import sys
+import tempfile
 import time
 import logging
+from typing import Iterable, Mapping, Optional
+from urllib.parse import urlsplit
 
+import numpy as np
 import pandas as pd
-import requests
-from requests.exceptions import ConnectionError, HTTPError
+from pandas.api.types import union_categoricals
+from requests.exceptions import (
+    ConnectionError, HTTPError, RequestException, Timeout,
+)
 import click
 
-from utils import read_word_list, retry
-from exceptions import EmptyDataFrameError
+from utils import read_word_list
+from exceptions import EmptyDataFrameError, QueryError
+from storage import FORMATS, save_frame
+from response_cache import CACHE_NAME, ResponseCache
+from transport import Transport
+from query_journal import JOURNAL_NAME, QueryJournal, settings_key
+from kwic_database import KwicTable, size_limits
+from metrics import metrics_options, start_metrics
 
 HEADERS = {
     'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_6) '
                   'AppleWebKit/537.36 (KHTML, like Gecko) '
                   'Chrome/53.0.2785.143 Safari/537.36',
 }
+KWIC_COLUMNS = ['url', 'publication', 'corpus', 'context', 'year']
+# labels of the lemma and regex membership bitmasks of merge_kwic
+KWIC_TYPES = {1: 'lemma', 2: 'regex', 3: 'both'}
+TRANSPORT = Transport(headers=HEADERS)
+STAGES = [
+    'get_and_save_results',
+    'query_words',
+    'save_kwic',
+    'save_kwic_pages',
+    'count_words',
+    'query',
+    'count_hits',
+    'query_totals',
+    'make_request',
+    'merge_kwic',
+    'save_frame',
+]
+
+
+def merge_kwic(
+        results: Mapping[str, pd.DataFrame],
+        labels: Optional[Mapping[int, str]] = None,
+) -> pd.DataFrame:
+    """
+    Merges the KWIC rows of any number of named result sets, e.g. lemma,
+    regex and extra CQP variants, into one row per url, in order of first
+    appearance. The row of the first set that has the url is kept.
+
+    Membership is recorded as a bitmask in sources, with bit i set for the
+    i-th result set, and as a categorical type, named by labels or by the
+    names of the sets joined with '+'.
+
+    The old combine_regex_and_lemma_df put the rows of both sets first and
+    the others after them sorted by url, an order that came from the index
+    set operations. First appearance keeps Korp's hit order and can be
+    written page by page without holding the rows, see save_kwic_pages.
+    The database tables are sorted by year before they are limited.
+    """
+    names = list(results)
+    frames = list(results.values())
+    if len(names) > 64:
+        raise ValueError(
+            f'At most 64 result sets can be merged, got {len(names)}'
+        )
+    if all(df.empty for df in frames):
+        raise EmptyDataFrameError
+
+    dtype = next(
+        t for t in (np.uint8, np.uint16, np.uint32, np.uint64)
+        if np.iinfo(t).bits >= len(names)
+    )
+    nonempty = [df for df in frames if not df.empty]
+    # concat keeps categoricals only when their categories are the same
+    for column in nonempty[0].columns:
+        having = [df[column] for df in nonempty if column in df]
+        if all(isinstance(c.dtype, pd.CategoricalDtype) for c in having):
+            categories = union_categoricals(having).categories
+            nonempty = [
+                df.assign(**{
+                    column: df[column].cat.set_categories(categories),
+                }) if column in df else df
+                for df in nonempty
+            ]
+    data = pd.concat(nonempty, ignore_index=True)
+    bits = np.repeat(
+        np.left_shift(1, np.arange(len(names))).astype(dtype),
+        [len(df) for df in frames],
+    )
+
+    # factorize numbers urls in order of first appearance
+    codes, urls = pd.factorize(data['url'])
+    sources = np.zeros(len(urls), dtype=dtype)
+    np.bitwise_or.at(sources, codes, bits)
+    _, first = np.unique(codes, return_index=True)
+
+    columns = ['url'] + [c for c in data.columns if c != 'url']
+    data = data[columns].take(first).reset_index(drop=True)
+    data['sources'] = sources
+
+    labels = labels or {}
+    masks, inverse = np.unique(sources, return_inverse=True)
+    data['type'] = pd.Categorical.from_codes(
+        inverse.ravel(),
+        categories=[
+            labels.get(int(m))
+            or '+'.join(n for i, n in enumerate(names) if int(m) >> i & 1)
+            for m in masks
+        ],
+    )
+
+    return data
 
 
 def combine_regex_and_lemma_df(
@@ -22,94 +134,134 @@ def combine_regex_and_lemma_df(
         lemma_df: pd.DataFrame,
         regex_df: pd.DataFrame,
 ) -> pd.DataFrame:
-    if lemma_df.empty and regex_df.empty:
-        raise EmptyDataFrameError
+    data = merge_kwic({'lemma': lemma_df, 'regex': regex_df}, KWIC_TYPES)
 
-    if lemma_df.empty:
-        regex_df.set_index('url', inplace=True)
-        regex_df['type'] = ['regex'] * len(regex_df.index)
-        regex_df.reset_index(inplace=True)
+    return data.drop(columns='sources')
 
-        return regex_df
 
-    if regex_df.empty:
-        lemma_df.set_index('url', inplace=True)
-        lemma_df['type'] = ['lemma'] * len(lemma_df.index)
-        lemma_df.reset_index(inplace=True)
-
-        return lemma_df
-
-    lemma_df.set_index('url', inplace=True)
-    regex_df.set_index('url', inplace=True)
-
-    duplicates_idx = lemma_df.index.intersection(regex_df.index)
-    only_lemma_idx = lemma_df.index.difference(duplicates_idx)
-    only_regex_idx = regex_df.index.difference(duplicates_idx)
+class RateLimiter:
+    """
+    Spaces out requests so that at most rate requests per second are started
+    to each host. No limit if rate is None.
+    """
 
-    duplicates = lemma_df.loc[duplicates_idx]
-    only_lemma = lemma_df.loc[only_lemma_idx]
-    only_regex = regex_df.loc[only_regex_idx]
+    def __init__(self, rate: Optional[float] = None):
+        self.interval = 1 / rate if rate else 0.0
+        self._next = {}
 
-    duplicates['type'] = ['both'] * len(duplicates_idx)
-    only_lemma['type'] = ['lemma'] * len(only_lemma_idx)
-    only_regex['type'] = ['regex'] * len(only_regex_idx)
+    async def wait(self, url: str) -> None:
+        if not self.interval:
+            return
 
-    data = pd.concat([duplicates, only_regex, only_lemma])
-    data.reset_index(inplace=True)
-    data.rename(columns={'index': 'url'}, inplace=True)
+        host = urlsplit(url).netloc
+        now = time.monotonic()
+        start = max(now, self._next.get(host, now))
+        self._next[host] = start + self.interval
 
-    return data
+        await asyncio.sleep(start - now)
 
 
 def make_request(
         url,
         query_params,
         logger: logging.Logger,
-        retries=10,
-        timeout=120,
+        cache: Optional[ResponseCache] = None,
+        transport: Optional[Transport] = None,
 ):
+    """
+    Response of a Korp request, from the cache if possible. Retries are left
+    to the transport, QueryError is raised when it gives up.
+    """
     logger.info(f"Making query {query_params.get('cqp', query_params)}")
 
-    for i in range(1, retries + 1):
-        logger.info(f"Attempt {i}")
+    if cache is not None:
+        result = cache.get(url, query_params)
+        if result is not None:
+            logger.info("Found in response cache")
+            return result
+
+    try:
+        result = (transport or TRANSPORT).get_json(url, query_params)
+    except (ConnectionError, Timeout) as e:
+        logger.exception(f"Connection Error: {e}")
+        raise QueryError(
+            f"Query {query_params.get('cqp', '')} failed: {e}"
+        ) from e
+    except HTTPError as e:
+        logger.exception(f"HTTP Error: {e}")
+        raise QueryError(
+            f"Query {query_params.get('cqp', '')} failed: {e}"
+        ) from e
+
+    logger.info("Success!")
+    if cache is not None:
+        cache.put(url, query_params, result)
+    return result
+
+
+async def make_request_async(
+        url,
+        query_params,
+        logger: logging.Logger,
+        semaphore: asyncio.Semaphore,
+        limiter: RateLimiter,
+        executor: ThreadPoolExecutor,
+        cache: Optional[ResponseCache] = None,
+        transport: Optional[Transport] = None,
+):
+    """
+    Same as make_request, but waits for a free slot of the semaphore and for
+    the rate limit of the host first. The blocking request runs in the
+    executor, the cache is only used on the event loop thread.
+    """
+    loop = asyncio.get_running_loop()
+    logger.info(f"Making query {query_params.get('cqp', query_params)}")
+
+    if cache is not None:
+        result = cache.get(url, query_params)
+        if result is not None:
+            logger.info("Found in response cache")
+            return result
+
+    async with semaphore:
+        await limiter.wait(url)
         try:
-            req = requests.get(
-                url=url,
-                timeout=timeout * i,
-                headers=HEADERS,
-                params=query_params,
+            result = await loop.run_in_executor(
+                executor,
+                functools.partial(
+                    (transport or TRANSPORT).get_json, url, query_params,
+                ),
             )
-            req.raise_for_status()
-            logger.info("Success!")
-            return req.json()
-        except ConnectionError as e:
+        except (ConnectionError, Timeout) as e:
             logger.exception(f"Connection Error: {e}")
-            continue
+            raise QueryError(
+                f"Query {query_params.get('cqp', '')} failed: {e}"
+            ) from e
         except HTTPError as e:
             logger.exception(f"HTTP Error: {e}")
-            continue
+            raise QueryError(
+                f"Query {query_params.get('cqp', '')} failed: {e}"
+            ) from e
 
-    return {
-        'corpus_hits': {},
-        'kwic': [],
-    }
+    logger.info("Success!")
+    if cache is not None:
+        cache.put(url, query_params, result)
+    return result
 
 
-def query(
+def query_params(
         word: str,
         regex: str,
-        url: str,
         corpora: dict,
-        logger: logging.Logger,
         start: int = 0,
         end: int = 10,
         use_lemma: bool = True,
-) -> tuple:
+) -> dict:
 
     structs = 'text_binding_id text_issue_date text_issue_no ' \
               'text_page_no text_publ_title text_publ_type'.split()
 
-    query_params = {
+    params = {
         'command': 'query',
         'start': start,
         'end': end,
@@ -117,51 +269,534 @@ def query(
         'corpus': ','.join(corpora.values()),
     }
 
+    params['cqp'] = f'[{condition(word, regex, use_lemma)}]'
+
+    return params
+
+
+def condition(word: str, regex: str, use_lemma: bool = True) -> str:
     if use_lemma:
-        query_params['cqp'] = f'[lemma="{word}"]'
-    else:
-        query_params['cqp'] = f'[word="{regex}"]'
+        return f'lemma="{word}"'
+    return f'word="{regex}"'
+
+
+def count_params(
+        words: list,
+        corpora: dict,
+        use_lemma: bool = True,
+) -> dict:
+    """
+    Parameters of a count request for the hits of many words at once. The
+    main query matches any of the words and every word is a sub query, so
+    each word is counted over all corpora in the same request.
+    """
+    conditions = [condition(word, regex, use_lemma) for word, regex in words]
 
-    result = make_request(url=url, query_params=query_params, logger=logger)
+    params = {
+        'command': 'count',
+        'corpus': ','.join(corpora.values()),
+        'group_by_struct': 'text_publ_type',
+        'cqp': f'[{" | ".join(conditions)}]',
+    }
+    for i, c in enumerate(conditions):
+        params[f'subcqp{i}'] = f'[{c}]'
 
-    freq = pd.Series({y: result['corpus_hits'].get(c, None) for y, c in corpora.items()})
+    return params
 
-    kwic = []
 
-    for hit in result['kwic']:
+def parse_counts(
+        words: list,
+        corpora: dict,
+        result: dict,
+) -> dict:
+    """
+    Yearly hits of every word from a count response, like the freq Series of
+    parse_result. The result of each corpus lists the main query first and
+    then the sub queries in order.
+    """
+    counts = {}
+    corpus_results = result.get('corpora', {})
+
+    for i, (word, _) in enumerate(words, start=1):
+        counts[word] = pd.Series({
+            y: corpus_results[c][i]['sums']['absolute']
+            if c in corpus_results else None
+            for y, c in corpora.items()
+        })
+
+    return counts
+
+
+def _context(tokens) -> str:
+    try:
+        return ' '.join(map(itemgetter('word'), tokens))
+    except TypeError:
+        # missing tokens or words
+        return ''
+
+
+def parse_kwic(
+        word: str,
+        hits: list,
+) -> pd.DataFrame:
+    """
+    KWIC rows of the hits of a query, built column by column. Publication and
+    corpus names repeat across the hits and are kept as categoricals.
+    """
+    structs = [hit.get('structs') or {} for hit in hits]
+    corpus = [hit.get('corpus') for hit in hits]
+
+    context = [_context(hit.get('tokens')) for hit in hits]
+    url = [
+        f"{s.get('text_publ_type')}/binding/{s.get('text_binding_id')}"
+        f"?term={word}&page={s.get('text_page_no', 0)}"
+        for s in structs
+    ]
+    year = [s.get('text_issue_date', '').rpartition('.')[2] for s in structs]
+    year = [y if len(y) == 4 else c[-4:] for y, c in zip(year, corpus)]
+
+    return pd.DataFrame({
+        'publication': pd.Categorical(
+            [s.get('text_publ_title') for s in structs]
+        ),
+        'corpus': pd.Categorical(corpus),
+        'context': context,
+        'url': url,
+        'year': np.array(year, dtype=np.int64),
+    })
+
+
+def parse_result(
+        word: str,
+        corpora: dict,
+        result: dict,
+) -> tuple:
+    freq = pd.Series({
+        y: result['corpus_hits'].get(c, None) for y, c in corpora.items()
+    })
+
+    return freq, parse_kwic(word, result['kwic'])
+
+
+def query(
+        word: str,
+        regex: str,
+        url: str,
+        corpora: dict,
+        logger: logging.Logger,
+        start: int = 0,
+        end: int = 10,
+        use_lemma: bool = True,
+        cache: Optional[ResponseCache] = None,
+        transport: Optional[Transport] = None,
+) -> tuple:
+    params = query_params(word, regex, corpora, start, end, use_lemma)
+    result = make_request(
+        url=url, query_params=params, logger=logger, cache=cache,
+        transport=transport,
+    )
+
+    return parse_result(word, corpora, result)
+
+
+def count_hits(
+        words: list,
+        url: str,
+        corpora: dict,
+        logger: logging.Logger,
+        use_lemma: bool = True,
+        cache: Optional[ResponseCache] = None,
+        transport: Optional[Transport] = None,
+) -> dict:
+    params = count_params(words, corpora, use_lemma)
+    result = make_request(
+        url=url, query_params=params, logger=logger, cache=cache,
+        transport=transport,
+    )
+
+    return parse_counts(words, corpora, result)
+
+
+async def query_async(
+        word: str,
+        regex: str,
+        url: str,
+        corpora: dict,
+        logger: logging.Logger,
+        semaphore: asyncio.Semaphore,
+        limiter: RateLimiter,
+        executor: ThreadPoolExecutor,
+        start: int = 0,
+        end: int = 10,
+        use_lemma: bool = True,
+        cache: Optional[ResponseCache] = None,
+        transport: Optional[Transport] = None,
+) -> tuple:
+    params = query_params(word, regex, corpora, start, end, use_lemma)
+    result = await make_request_async(
+        url=url,
+        query_params=params,
+        logger=logger,
+        semaphore=semaphore,
+        limiter=limiter,
+        executor=executor,
+        cache=cache,
+        transport=transport,
+    )
+
+    return parse_result(word, corpora, result)
+
+
+async def count_hits_async(
+        words: list,
+        url: str,
+        corpora: dict,
+        logger: logging.Logger,
+        semaphore: asyncio.Semaphore,
+        limiter: RateLimiter,
+        executor: ThreadPoolExecutor,
+        use_lemma: bool = True,
+        cache: Optional[ResponseCache] = None,
+        transport: Optional[Transport] = None,
+) -> dict:
+    params = count_params(words, corpora, use_lemma)
+    result = await make_request_async(
+        url=url,
+        query_params=params,
+        logger=logger,
+        semaphore=semaphore,
+        limiter=limiter,
+        executor=executor,
+        cache=cache,
+        transport=transport,
+    )
+
+    return parse_counts(words, corpora, result)
+
+
+class QueryRunner:
+    """
+    Runs queries and yields their results in order.
+
+    By default the queries are made one at a time. With concurrency above 1
+    or a rate limit they run on an asyncio event loop instead: at most
+    concurrency requests are in flight, and later queries keep going while
+    the caller handles earlier results.
+    """
+
+    def __init__(
+            self,
+            korp_url: str,
+            corpora: dict,
+            logger: logging.Logger,
+            concurrency: int = 1,
+            rate: Optional[float] = None,
+            cache: Optional[ResponseCache] = None,
+            transport: Optional[Transport] = None,
+    ):
+        self.korp_url = korp_url
+        self.corpora = corpora
+        self.logger = logger
+        self.concurrency = concurrency
+        self.cache = cache
+        self.transport = transport
+        self.loop = None
+
+        if concurrency > 1 or rate:
+            self.loop = asyncio.new_event_loop()
+            self.executor = ThreadPoolExecutor(concurrency)
+            self.semaphore = asyncio.Semaphore(concurrency)
+            self.limiter = RateLimiter(rate)
+
+    def run(
+            self,
+            calls: Iterable[dict],
+            lookahead: Optional[int] = None,
+            counts: bool = False,
+    ) -> Generator:
+        """
+        Yields the (freq, kwic) result of query(**call) for every call, or
+        the result of count_hits(**call) with counts.
+        """
+        fn, fn_async = query, query_async
+        if counts:
+            fn, fn_async = count_hits, count_hits_async
+        kwargs = {
+            'url': self.korp_url,
+            'corpora': self.corpora,
+            'logger': self.logger,
+            'cache': self.cache,
+            'transport': self.transport,
+        }
+
+        if self.loop is None:
+            for call in calls:
+                yield fn(**kwargs, **call)
+            return
+
+        kwargs.update(
+            semaphore=self.semaphore,
+            limiter=self.limiter,
+            executor=self.executor,
+        )
+        calls = iter(calls)
+        pending = deque(
+            self.loop.create_task(fn_async(**kwargs, **call))
+            for call in islice(calls, lookahead or self.concurrency)
+        )
+
         try:
-            context = ' '.join([w['word'] for w in hit['tokens']])
-        except TypeError:
-            context = ''
+            while pending:
+                # the loop only runs until the oldest query is done, the
+                # requests of later ones keep going in the executor meanwhile
+                result = self.loop.run_until_complete(pending.popleft())
+                for call in islice(calls, 1):
+                    pending.append(
+                        self.loop.create_task(fn_async(**kwargs, **call))
+                    )
+                yield result
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                self.loop.run_until_complete(asyncio.wait(pending))
+
+    def close(self) -> None:
+        if self.loop is not None:
+            self.loop.close()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def query_words(
+        regex_dict: dict,
+        runner: QueryRunner,
+        **params,
+) -> Generator:
+    """
+    Lemma and regex queries of every word, yielded in word list order as
+    (word, (freq_lemma, kwic_lemma), (freq_regex, kwic_regex)).
+    """
+    words = [word.casefold() for word in regex_dict]
 
-        hit_data = hit.get('structs', dict())
+    def calls():
+        for word, regex in zip(words, regex_dict.values()):
+            runner.logger.info(f"Making query for {word}")
+            for use_lemma in (True, False):
+                yield {
+                    'word': word, 'regex': regex, 'use_lemma': use_lemma,
+                    **params,
+                }
 
-        text_type = hit_data.get('text_publ_type', None)
-        publication = hit_data.get('text_publ_title', None)
-        text_binding_id = hit_data.get('text_binding_id', None)
-        page = hit_data.get('text_page_no', 0)
+    results = runner.run(calls(), lookahead=2 * runner.concurrency)
 
-        url = f'{text_type}/binding/{text_binding_id}?term={word}&page={page}'
+    # the results come in pairs, lemma first
+    yield from zip(words, results, results)
 
-        year = hit_data.get('text_issue_date', '').split('.')[-1]
-        if len(year) != 4:
-            year = hit.get('corpus')[-4:]
 
-        kwic.append({
-            'publication': publication,
-            'corpus': hit.get('corpus', None),
-            'context': context,
-            'url': url,
-            'year': int(year),
-        })
+def save_kwic(
+        word: str,
+        kwic_lemma: pd.DataFrame,
+        kwic_regex: pd.DataFrame,
+        kwic_fp: Optional[Path],
+        logger: logging.Logger,
+        table: Optional[KwicTable] = None,
+) -> int:
+    """
+    Saves the merged KWIC rows of a word to its file or to the table.
+    Returns the number of rows saved.
+    """
+    results = {
+        'lemma': kwic_lemma,
+        'regex': kwic_regex,
+    }
+
+    try:
+        kwic_data = merge_kwic(results, KWIC_TYPES)
+    except EmptyDataFrameError:
+        logger.exception(f'No data to save for {word}.')
+        return 0
+
+    sources = kwic_data['sources'].to_numpy()
+    for i, name in enumerate(results):
+        found = int((np.right_shift(sources, i) & 1).sum())
+        logger.info(f"{name.capitalize()} results: {found}")
+
+    if table is not None:
+        table.add(word, kwic_data.drop(columns='sources'))
+        logger.info(f'{word} saved to table {table.table}')
+        return len(kwic_data)
+
+    kwic_data.drop(columns='sources').to_csv(kwic_fp / f'{word}.csv')
+    logger.info(f'{word} saved to file')
+
+    return len(kwic_data)
+
+
+def count_words(
+        regex_dict: dict,
+        runner: QueryRunner,
+        batch_size: int,
+) -> Generator:
+    """
+    Same as query_words without the KWIC rows, using one count request per
+    batch of words and form.
+    """
+    words = [(word.casefold(), regex) for word, regex in regex_dict.items()]
+    batches = [
+        words[i:i + batch_size] for i in range(0, len(words), batch_size)
+    ]
+
+    def calls():
+        for batch in batches:
+            runner.logger.info(
+                f"Counting hits of {len(batch)} words from {batch[0][0]}"
+            )
+            for use_lemma in (True, False):
+                yield {'words': batch, 'use_lemma': use_lemma}
+
+    results = runner.run(
+        calls(), lookahead=2 * runner.concurrency, counts=True,
+    )
+
+    for batch, lemma, regex_ in zip(batches, results, results):
+        for word, _ in batch:
+            yield word, (lemma[word], []), (regex_[word], [])
+
+
+def query_pages(
+        word: str,
+        regex: str,
+        use_lemma: bool,
+        first: tuple,
+        runner: QueryRunner,
+        page_size: int,
+        max_hits: int,
+) -> Generator:
+    """
+    KWIC rows of a query one page at a time, starting from the already
+    fetched first page. The number of pages comes from the hit counts of the
+    first page.
+    """
+    freq, kwic = first
+    yield kwic
+
+    hits = min(int(freq.fillna(0).sum()), max_hits)
+    calls = (
+        {
+            'word': word,
+            'regex': regex,
+            'use_lemma': use_lemma,
+            'start': start,
+            'end': min(start + page_size, hits) - 1,
+        }
+        for start in range(page_size, hits, page_size)
+    )
+
+    for _, kwic in runner.run(calls):
+        yield kwic
+
+
+def save_kwic_pages(
+        word: str,
+        lemma_pages: Iterable[pd.DataFrame],
+        regex_pages: Iterable[pd.DataFrame],
+        kwic_file: Optional[Path],
+        logger: logging.Logger,
+        table: Optional[KwicTable] = None,
+) -> int:
+    """
+    Writes the KWIC rows of a word page by page, with the same columns, type
+    labels and row order as merge_kwic, to kwic_file or to the table. Only
+    the urls are kept in memory, the rows wait in temporary files until the
+    regex hits are known. Returns the number of rows written.
+    """
+    lemma_urls = set()
+    both_urls = set()
+    regex_urls = set()
+    written = 0
+
+    def new_rows(pages, urls):
+        for data in pages:
+            if data.empty:
+                continue
+            data = data.drop_duplicates('url')
+            data = data[~data['url'].isin(urls)]
+            urls.update(data['url'])
+            yield data
+
+    def read_back(fopen):
+        fopen.seek(0)
+        return pd.read_csv(
+            fopen,
+            names=KWIC_COLUMNS,
+            dtype={**dict.fromkeys(KWIC_COLUMNS, str), 'year': int},
+            keep_default_na=False,
+            # missing values of the table rows stay missing, as in merge_kwic
+            na_values=[''] if table is not None else [],
+            chunksize=10_000,
+        )
+
+    if table is None:
+        output = open(kwic_file, 'w')
+    else:
+        output = contextlib.nullcontext()
+
+    with tempfile.TemporaryFile('w+') as lemma_file, \
+            tempfile.TemporaryFile('w+') as regex_file, \
+            output as fopen:
+        def write(data):
+            nonlocal written
+            if data.empty:
+                return
+            if table is not None:
+                table.add(word, data)
+            else:
+                data.index = range(written, written + len(data))
+                data.to_csv(fopen, header=written == 0)
+            written += len(data)
+
+        for data in new_rows(lemma_pages, lemma_urls):
+            data[KWIC_COLUMNS].to_csv(lemma_file, header=False, index=False)
+
+        # only the regex rows of urls the lemma query did not find are kept
+        for data in new_rows(regex_pages, regex_urls):
+            in_lemma = data['url'].isin(lemma_urls)
+            both_urls.update(data.loc[in_lemma, 'url'])
+            data.loc[~in_lemma, KWIC_COLUMNS].to_csv(
+                regex_file, header=False, index=False
+            )
+
+        # lemma rows first and then the rest, in order of first appearance
+        for data in read_back(lemma_file):
+            both = data['url'].isin(both_urls)
+            data['type'] = np.where(both, KWIC_TYPES[3], KWIC_TYPES[1])
+            write(data)
+
+        for data in read_back(regex_file):
+            write(data.assign(type=KWIC_TYPES[2]))
+
+    if not written:
+        if table is None:
+            kwic_file.unlink()
+        logger.error(f'No data to save for {word}.')
+        return written
+
+    logger.info(f"Regex results: {len(regex_urls)}")
+    logger.info(f"Lemma results: {len(lemma_urls)}")
+    if table is not None:
+        logger.info(f'{word} saved to table {table.table}')
+    else:
+        logger.info(f'{word} saved to file')
 
-    return freq, kwic
+    return written
 
 
 def query_totals(
         url: str,
         corpora: dict,
         logger: logging.Logger,
+        cache: Optional[ResponseCache] = None,
+        transport: Optional[Transport] = None,
 ):
     query_params = {
         'command': 'info',
@@ -172,6 +807,8 @@ def query_totals(
         url=url,
         query_params=query_params,
         logger=logger,
+        cache=cache,
+        transport=transport,
     )
     corpora_info = result['corpora']
 
@@ -185,7 +822,6 @@ def query_totals(
     return totals
 
 
-@retry()
 def get_and_save_results(
         regex_dict: dict,
         output_fp: Path,
@@ -193,8 +829,31 @@ def get_and_save_results(
         corpora: dict,
         kwic_or_freq: str,
         logger: logging.Logger,
+        fmt: str = 'csv',
+        concurrency: int = 1,
+        rate: Optional[float] = None,
+        cache: Optional[ResponseCache] = None,
+        page_size: Optional[int] = None,
+        max_hits: int = 10_000,
+        count_batch: int = 25,
+        transport: Optional[Transport] = None,
+        database_url: Optional[str] = None,
+        table: str = 'kwic_fi_newspapers',
+        size_limit: int = 2_000,
         **params,
 ) -> None:
+    """
+    Queries every word and saves the kwic files and frequency tables. With
+    a database url the kwic rows are inserted into the table instead, in
+    the form populate_database stores the kwic files: at most size_limit
+    rows per word (more for fred), the earliest years first.
+
+    Words are recorded in a journal in the output directory once all of
+    their requests succeeded, so a run that is started again
+    after a failure continues from the first unfinished word. A request
+    that fails for good raises QueryError. The journal is removed when all
+    files are saved.
+    """
     output_fp.mkdir(parents=True, exist_ok=True)
 
     freq = kwic_or_freq in ("freq", "both")
@@ -203,7 +862,8 @@ def get_and_save_results(
     freqs_lemma = {}
     freqs_regex = {}
 
-    if kwic:
+    kwic_fp = None
+    if kwic and not database_url:
         kwic_fp = output_fp / "kwic"
         kwic_fp.mkdir(exist_ok=True)
     
@@ -213,62 +873,108 @@ def get_and_save_results(
 
     logger.info("Iterating over words")
 
-    for word, regex in regex_dict.items():
-        word = word.casefold()
-
-        logger.info(f"Making query for {word}")
-
-        freq_lemma, kwic_lemma = query(
-            word=word,
-            regex=regex,
-            url=korp_url,
+    regexes = {word.casefold(): regex for word, regex in regex_dict.items()}
+    journal = QueryJournal(
+        output_fp / JOURNAL_NAME,
+        settings_key(
+            korp_url=korp_url,
             corpora=corpora,
-            use_lemma=True,
-            logger=logger,
-            **params
+            kwic_or_freq=kwic_or_freq,
+            page_size=page_size,
+            max_hits=max_hits,
+            database_url=database_url,
+            table=table,
+            size_limit=size_limit,
+            params=params,
+        ),
+    )
+    done = journal.completed()
+    if done:
+        logger.info(
+            f"Resuming, {len(done)} of {len(regexes)} words done earlier"
         )
-
-        freq_regex, kwic_regex = query(
-            word=word,
-            regex=regex,
-            url=korp_url,
-            corpora=corpora,
-            use_lemma=False,
-            logger=logger,
-            **params
+    # the rows of the words done earlier are already in the table
+    kwic_table = None
+    if kwic and database_url:
+        kwic_table = KwicTable(
+            database_url, table, replace=not done,
+            size_limit=size_limits(size_limit),
         )
+    todo = {word: regex for word, regex in regexes.items() if word not in done}
+    runner = QueryRunner(
+        korp_url, corpora, logger, concurrency, rate, cache, transport,
+    )
 
-        freqs_regex[word] = freq_regex
-        freqs_lemma[word] = freq_lemma
-
-        if not kwic:
-            continue
-
-        kwic_regex_cleaned = pd.DataFrame.from_dict(kwic_regex).drop_duplicates('url')
-        kwic_lemma_cleaned = pd.DataFrame.from_dict(kwic_lemma).drop_duplicates('url')
-
-        logger.info(f"Regex results: {kwic_regex_cleaned.shape[0]}")
-        logger.info(f"Lemma results: {kwic_lemma_cleaned.shape[0]}")
+    if page_size:
+        # only the first page is fetched with the word, the rest when saving
+        params.update(start=0, end=min(page_size, max_hits) - 1)
 
-        try:
-            kwic_data = combine_regex_and_lemma_df(
-                regex_df=kwic_regex_cleaned,
-                lemma_df=kwic_lemma_cleaned,
+    if not kwic and count_batch:
+        results = count_words(todo, runner, count_batch)
+    else:
+        results = query_words(todo, runner, **params)
+
+    try:
+        for word, lemma, regex_ in results:
+            if not kwic:
+                journal.add(word, lemma[0], regex_[0])
+                continue
+
+            if page_size:
+                written = save_kwic_pages(
+                    word=word,
+                    lemma_pages=query_pages(
+                        word, regexes[word], True, lemma, runner, page_size,
+                        max_hits,
+                    ),
+                    regex_pages=query_pages(
+                        word, regexes[word], False, regex_, runner, page_size,
+                        max_hits,
+                    ),
+                    kwic_file=kwic_fp / f'{word}.csv' if kwic_fp else None,
+                    logger=logger,
+                    table=kwic_table,
+                )
+            else:
+                written = save_kwic(
+                    word, lemma[1], regex_[1], kwic_fp, logger, kwic_table,
+                )
+            if kwic_table is not None:
+                # the journal may only have words whose rows are stored
+                kwic_table.finish(word)
+                kwic_table.flush()
+            journal.add(
+                word, lemma[0], regex_[0],
+                kwic_fp / f'{word}.csv' if kwic_fp and written else None,
             )
-            kwic_data.to_csv(kwic_fp / f'{word}.csv')
-            logger.info(f'{word} saved to file')
-        except EmptyDataFrameError:
-            logger.exception(f'No data to save for {word}.')
 
-    if kwic:
+        if kwic_table is not None:
+            kwic_table.create_index()
+    finally:
+        runner.close()
+        if kwic_table is not None:
+            kwic_table.close()
+
+    # earlier and new results in word list order
+    done = journal.completed()
+    for word in regexes:
+        freqs_lemma[word], freqs_regex[word] = done[word]
+
+    if kwic_table is not None:
+        logger.info(f"Keywords-in-context saved to table {table}")
+    elif kwic:
         logger.info(f"Keywords-in-context saved to {kwic_fp}")
 
     if freq:
         data_lemma = pd.DataFrame(freqs_lemma)
         data_regex = pd.DataFrame(freqs_regex)
 
-        data_totals = pd.Series(query_totals(korp_url, corpora, logger=logger)).sort_index()
-        # data_totals = data_totals.rename(lambda w: w.replace(' ', '_') if w != 'Unnamed: 0' else w)
+        data_totals = pd.Series(query_totals(
+            korp_url, corpora, logger=logger, cache=cache, transport=transport,
+        )).sort_index()
+        # data_totals = data_totals.rename(
+        #     lambda w: w.replace(' ', '_') if w != 'Unnamed: 0' else w
+        # )
 
         logger.info("Calculating relative frequencies")
         data_lemma_relative = data_lemma.div(data_totals, axis=0) * 100_000
@@ -279,29 +985,137 @@ def get_and_save_results(
         data_lemma_relative['year'] = data_lemma_relative.index
         data_regex_relative['year'] = data_regex_relative.index
 
-        logger.info("Saving frequency data to csv files")
-        data_lemma.to_csv(freq_fp / 'lemma_abs.csv')
-        data_regex.to_csv(freq_fp / 'regex_abs.csv')
-        data_lemma_relative.to_csv(freq_fp / 'lemma_rel.csv')
-        data_regex_relative.to_csv(freq_fp / 'regex_rel.csv')
+        logger.info(f"Saving frequency data to {fmt} files")
+        save_frame(data_lemma, freq_fp / 'lemma_abs.csv', fmt)
+        save_frame(data_regex, freq_fp / 'regex_abs.csv', fmt)
+        save_frame(data_lemma_relative, freq_fp / 'lemma_rel.csv', fmt)
+        save_frame(data_regex_relative, freq_fp / 'regex_rel.csv', fmt)
         logger.info(f"Frequencies saved to {freq_fp}")
 
+    journal.delete()
+
 
 @click.command()
 @click.argument("output_dir", type=click.Path(exists=True))
 @click.argument("wordlist_dir", type=click.Path(exists=True))
 @click.argument("korp_url", type=click.STRING)
-@click.option("--kwic-or-freq", type=click.Choice(['kwic', 'freq', 'both'], case_sensitive=False), default='both')
+@click.option(
+    "--kwic-or-freq",
+    type=click.Choice(['kwic', 'freq', 'both'], case_sensitive=False),
+    default='both',
+)
 @click.option("--first-year", type=click.INT, help="first year to search")
 @click.option("--last-year", type=click.INT, help="last year to search")
-@click.option("-e", "--excluded", type=click.INT, help="excluded years", multiple=True)
-def main(output_dir, wordlist_dir, korp_url, kwic_or_freq, first_year, last_year, excluded,):
+@click.option(
+    "-e", "--excluded", type=click.INT, help="excluded years", multiple=True,
+)
+@click.option(
+    "--format", "fmt", type=click.Choice(list(FORMATS)), default='csv',
+    help="frequency file format",
+)
+@click.option(
+    "--concurrency", type=click.IntRange(1, None), default=1,
+    help="number of simultaneous requests",
+)
+@click.option(
+    "--rate", type=click.FloatRange(0, None, min_open=True),
+    help="most requests per second to the Korp host",
+)
+@click.option(
+    "--cache", type=click.Path(),
+    help="response cache file, default is inside output directory",
+)
+@click.option(
+    "--no-cache", is_flag=True,
+    help="always query the server and store nothing",
+)
+@click.option(
+    "--refresh", is_flag=True,
+    help="query the server again and replace the cached responses",
+)
+@click.option(
+    "--cache-days", type=click.FloatRange(0, None), default=30,
+    help="days a cached response is used",
+)
+@click.option(
+    "--cache-mb", type=click.FloatRange(0, None), default=2000,
+    help="largest size of the response cache in megabytes",
+)
+@click.option(
+    "--page-size", type=click.IntRange(1, None),
+    help="hits per request, the kwic files are then written page by page",
+)
+@click.option(
+    "--max-hits", type=click.IntRange(1, None), default=10_000,
+    help="most hits fetched per query",
+)
+@click.option(
+    "--count-batch", type=click.IntRange(0, None), default=25,
+    help="words per count request when only frequencies are asked, 0 "
+         "queries each word",
+)
+@click.option(
+    "--retries", type=click.IntRange(0, None), default=5,
+    help="retries of a failed request",
+)
+@click.option(
+    "--timeout", type=click.FloatRange(0, None, min_open=True), default=120,
+    help="seconds to wait for a response",
+)
+@click.option(
+    "--restart", is_flag=True,
+    help="query all words again instead of resuming an interrupted run",
+)
+@click.option(
+    "--database-url", type=click.STRING,
+    help="insert the kwic rows into this database instead of writing kwic "
+         "files",
+)
+@click.option(
+    "--table", type=click.STRING, default='kwic_fi_newspapers',
+    help="database table of the kwic rows, replaced unless resuming",
+)
+@click.option(
+    "--size-limit", type=click.IntRange(1, None), default=2_000,
+    help="kwic rows kept per word in the database table, earliest years "
+         "first, as populate_database keeps them",
+)
+@metrics_options
+def main(
+    output_dir,
+    wordlist_dir,
+    korp_url,
+    kwic_or_freq,
+    first_year,
+    last_year,
+    excluded,
+    fmt,
+    concurrency,
+    rate,
+    cache,
+    no_cache,
+    refresh,
+    cache_days,
+    cache_mb,
+    page_size,
+    max_hits,
+    count_batch,
+    retries,
+    timeout,
+    restart,
+    database_url,
+    table,
+    size_limit,
+    profile,
+    metrics_file,
+    ):
     """
     Makes lemma or regex queries from korp interface 
     """
     logger = logging.getLogger(__name__)
     output_fp = Path(output_dir)
     wordlist_fp = Path(wordlist_dir)
+    start_metrics(sys.modules[__name__], STAGES, profile, metrics_file, logger)
 
     logger.info(f"Reading words from {wordlist_dir}")
     words = read_word_list(wordlist_fp / 'wordlist_fi_newspapers.csv')
@@ -309,17 +1123,62 @@ def main(output_dir, wordlist_dir, korp_url, kwic_or_freq, first_year, last_year
     years = range(first_year, last_year + 1)
     corpora = {y: f"KLK_FI_{y}" for y in years if y not in excluded}
 
-    get_and_save_results(
-        regex_dict=words,
-        output_fp=output_fp,
-        korp_url=korp_url,
-        corpora=corpora,
-        kwic_or_freq=kwic_or_freq,
-        start=0,
-        end=10_000,
-        logger=logger,
+    if restart:
+        (output_fp / JOURNAL_NAME).unlink(missing_ok=True)
+
+    transport = Transport(
+        headers=HEADERS, pool_size=concurrency, retries=retries,
+        timeout=timeout,
     )
 
+    response_cache = None
+    if not no_cache:
+        response_cache = ResponseCache(
+            cache or output_fp / CACHE_NAME, max_age_days=cache_days,
+            refresh=refresh,
+        )
+        logger.info(f"Using response cache {response_cache.path}")
+
+    try:
+        get_and_save_results(
+            regex_dict=words,
+            output_fp=output_fp,
+            korp_url=korp_url,
+            corpora=corpora,
+            kwic_or_freq=kwic_or_freq,
+            fmt=fmt,
+            concurrency=concurrency,
+            rate=rate,
+            cache=response_cache,
+            page_size=page_size,
+            max_hits=max_hits,
+            count_batch=count_batch,
+            transport=transport,
+            database_url=database_url,
+            table=table,
+            size_limit=size_limit,
+            start=0,
+            end=max_hits - 1,
+            logger=logger,
+        )
+    except (QueryError, RequestException) as e:
+        # requests are already retried by the transport, the next run
+        # resumes from the journal
+        logger.error(f"Run failed: {e}")
+        raise click.ClickException(
+            f"{e}\nRun the same command again to continue from the last "
+            "finished word."
+        )
+    finally:
+        if response_cache is not None:
+            logger.info(
+                f"{response_cache.hits} responses from cache, "
+                f"{response_cache.misses} queried"
+            )
+            response_cache.evict(cache_mb)
+            response_cache.close()
+        transport.close()
+
 
 if __name__ == '__main__':
     log_fmt = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
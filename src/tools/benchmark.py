@@ -0,0 +1,370 @@
+import json
+import logging
+import platform
+import random
+import re
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Optional
+
+import pandas as pd
+import click
+
+import kwic
+import word_frequency
+from corpus_manifest import CorpusManifest
+from utils import read_word_list
+
+SIZES = {
+    'small': {'bins': 4, 'files_per_bin': 2, 'words_per_file': 20_000},
+    'medium': {'bins': 12, 'files_per_bin': 4, 'words_per_file': 100_000},
+    'large': {'bins': 19, 'files_per_bin': 8, 'words_per_file': 500_000},
+}
+BENCHMARKS = [
+    'get_frequency',
+    'get_frequency_by_year',
+    'get_kwic_for_word',
+    'get_kwic_all',
+    'combine_regex_and_lemma_df',
+    'api_query',
+]
+# common OCR misreadings, the same ones the wordlist patterns allow for
+CONFUSIONS = {
+    'e': 'c', 'c': 'e', 't': 'f', 's': 'f', 'k': 'f', 'a': 'o', 'o': 'a',
+    'n': 'u', 'u': 'n', 'm': 'w', 'v': 'w', 'd': 'b', 'h': 'b', 'i': 'j',
+    'r': 'c', 'ä': 'a', 'ö': 'o',
+}
+SYLLABLES = (
+    'ka la ma na ta va sa ri ne te lo mi ko ar en is ut om sk st fr gr'
+).split()
+SUFFIXES = ['', '', '', 'en', 'er', 'na', 'ssa', 'n', 'a', 'ens']
+NEWSPAPERS = ['Åbo Tidning', 'Suometar', 'Helsingfors Dagblad']
+
+
+def _filler(rng: random.Random) -> str:
+    return ''.join(rng.choices(SYLLABLES, k=rng.randint(1, 4)))
+
+
+def _misread(word: str, rng: random.Random, error_rate: float) -> str:
+    return ''.join(
+        CONFUSIONS.get(c, c) if rng.random() < error_rate else c
+        for c in word
+    )
+
+
+def generate_corpus(
+        path: Path,
+        terms: list,
+        bins: int = 4,
+        files_per_bin: int = 2,
+        words_per_file: int = 20_000,
+        term_rate: float = 0.02,
+        error_rate: float = 0.05,
+        first_year: int = 1800,
+        seed: int = 0,
+) -> Path:
+    """
+    Writes a deterministic OCR-like corpus: files roa_<bin>_<n>.txt of
+    filler words, inflected terms and misread characters, with lines broken
+    and hyphenated as in scanned text. Returns the path of the bins file.
+    """
+    rng = random.Random(seed)
+    path.mkdir(parents=True, exist_ok=True)
+    bin_rows = []
+
+    for b in range(bins):
+        year = first_year + 5 * b
+        bin_ = f'{year}-{year + 4}'
+        bin_rows.append({'year': year, 'name': bin_})
+
+        for n in range(files_per_bin):
+            words = []
+            for _ in range(words_per_file):
+                if rng.random() < term_rate:
+                    word = rng.choice(terms) + rng.choice(SUFFIXES)
+                else:
+                    word = _filler(rng)
+                if rng.random() < 0.1:
+                    word = word.capitalize()
+                words.append(_misread(word, rng, error_rate))
+
+            lines = []
+            for start in range(0, len(words), 12):
+                line = ' '.join(words[start:start + 12])
+                if rng.random() < 0.05 and len(words[start]) > 3:
+                    line = line[:2] + '-\n' + line[2:]
+                lines.append(line + rng.choice(['', '.', ',']))
+            (path / f'roa_{bin_}_{n}.txt').write_text('\n'.join(lines) + '\n')
+
+    bins_file = path / 'bins.csv'
+    pd.DataFrame(bin_rows).to_csv(bins_file, index=False)
+
+    return bins_file
+
+
+def synthetic_hits(size: int, overlap: float, seed: int = 0) -> tuple:
+    """
+    Lemma and regex result frames shaped like Korp KWIC rows, sharing the
+    given fraction of urls.
+    """
+    rng = random.Random(seed)
+
+    def frame(urls):
+        return pd.DataFrame({
+            'url': urls,
+            'year': [rng.randint(1820, 1910) for _ in urls],
+            'newspaper': [rng.choice(NEWSPAPERS) for _ in urls],
+            'context': [
+                ' '.join(_filler(rng) for _ in range(30)) for _ in urls
+            ],
+        })
+
+    url = 'http://digi.kansalliskirjasto.fi/'
+    shared = [f'{url}{i}' for i in range(int(size * overlap))]
+    lemma = [f'{url}l{i}' for i in range(size - len(shared))]
+    regex = [f'{url}r{i}' for i in range(size - len(shared))]
+
+    return frame(shared + lemma), frame(shared + regex)
+
+
+def time_call(
+        fn: Callable,
+        repeat: int,
+        setup: Optional[Callable] = None,
+) -> dict:
+    runs = []
+
+    for _ in range(repeat):
+        args = setup() if setup is not None else {}
+        started = time.perf_counter()
+        fn(**args)
+        runs.append(time.perf_counter() - started)
+
+    return {
+        'repeat': repeat,
+        'min': min(runs),
+        'median': statistics.median(runs),
+        'mean': statistics.mean(runs),
+        'runs': runs,
+    }
+
+
+def query_mock_korp(
+        words: dict,
+        terms: int,
+        logger: logging.Logger,
+        latency: float = 0.05,
+        concurrency: int = 4,
+) -> None:
+    """
+    A full api_query run against a local mock Korp server.
+    """
+    from api_query import get_and_save_results
+    from mock_korp import MockKorp, make_corpora, start_server
+
+    words = dict(list(words.items())[:terms])
+    corpora = make_corpora(
+        [w.replace(' ', '') for w in words], 1850, 1854,
+        pages=50, words_per_page=400,
+    )
+    server = start_server(MockKorp(corpora), latency=latency)
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            get_and_save_results(
+                regex_dict=words,
+                output_fp=Path(tmp),
+                korp_url=f'http://127.0.0.1:{server.server_port}/',
+                corpora={int(c[-4:]): c for c in corpora},
+                kwic_or_freq='both',
+                logger=logger,
+                concurrency=concurrency,
+                start=0,
+                end=9_999,
+            )
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def run_benchmarks(
+        corpus: Path,
+        bins_file: Path,
+        wordlist: Path,
+        names: list,
+        repeat: int = 3,
+        window_size: int = 100,
+        kwic_terms: int = 5,
+        hits: int = 10_000,
+) -> dict:
+    logger = logging.getLogger(__name__)
+    manifest = CorpusManifest.load(corpus)
+    words = read_word_list(wordlist)
+    terms = list(words)[:kwic_terms]
+    results = {}
+
+    def kwic_for_words():
+        for term in terms:
+            kwic.get_kwic_for_word(
+                data_path=corpus,
+                rule='*.txt',
+                term=term,
+                regex=re.compile(words[term], flags=re.IGNORECASE),
+                window_size=window_size,
+                size_limit=50_000,
+                manifest=manifest,
+            )
+
+    calls = {
+        'get_frequency': lambda: word_frequency.get_frequency(
+            corpus, '*.txt', wordlist, manifest=manifest,
+        ),
+        'get_frequency_by_year': lambda: word_frequency.get_frequency_by_year(
+            corpus, bins_file, wordlist, logger,
+        ),
+        'get_kwic_for_word': kwic_for_words,
+        'get_kwic_all': lambda: kwic.get_kwic_all(
+            data=corpus,
+            rule='*.txt',
+            wordlist=wordlist,
+            window_size=window_size,
+            manifest=manifest,
+        ),
+    }
+
+    for name in names:
+        logger.info(f'Running benchmark {name}')
+        if name == 'combine_regex_and_lemma_df':
+            # api_query needs the HTTP client libraries, import it only when
+            # used
+            from api_query import combine_regex_and_lemma_df
+
+            def setup():
+                lemma_df, regex_df = synthetic_hits(hits, 0.5)
+                return {'lemma_df': lemma_df, 'regex_df': regex_df}
+
+            results[name] = time_call(
+                combine_regex_and_lemma_df, repeat, setup,
+            )
+        elif name == 'api_query':
+            results[name] = time_call(
+                lambda: query_mock_korp(words, kwic_terms, logger), repeat,
+            )
+        else:
+            results[name] = time_call(calls[name], repeat)
+        logger.info(f'{name}: median {results[name]["median"]:.3f} s')
+
+    return results
+
+
+def git_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            capture_output=True, text=True, check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip()
+
+
+@click.command()
+@click.argument('output_filepath', type=click.Path())
+@click.option(
+    '--wordlist', type=click.Path(exists=True),
+    default='wordlists/wordlist_sv_riksdag.csv',
+    help='word list used for counting and searching',
+)
+@click.option(
+    '--size', type=click.Choice(list(SIZES)), default='small',
+    help='size of the synthetic corpus',
+)
+@click.option(
+    '--corpus', type=click.Path(),
+    help='directory of the synthetic corpus, generated if missing, default '
+         'is a temporary directory',
+)
+@click.option(
+    '--seed', type=click.INT, default=0,
+    help='random seed of the synthetic corpus',
+)
+@click.option(
+    '--repeat', type=click.IntRange(1, None), default=3,
+    help='number of timed runs of each benchmark',
+)
+@click.option(
+    '--bench', type=click.Choice(BENCHMARKS), multiple=True,
+    help='benchmark to run, default is all',
+)
+@click.option(
+    '--baseline', type=click.Path(exists=True),
+    help='earlier result file to compare with',
+)
+def main(
+    output_filepath,
+    wordlist,
+    size,
+    corpus,
+    seed,
+    repeat,
+    bench,
+    baseline,
+    ):
+    """
+    Times the text tools on a synthetic corpus and saves the results in a
+    json file
+    """
+    logger = logging.getLogger(__name__)
+    wordlist = Path(wordlist)
+    terms = [w.replace(' ', '') for w in read_word_list(wordlist)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus_fp = Path(corpus) if corpus else Path(tmp) / 'corpus'
+        bins_fp = corpus_fp / 'bins.csv'
+        if not bins_fp.is_file():
+            logger.info(f'Generating {size} corpus in {corpus_fp}')
+            bins_fp = generate_corpus(
+                corpus_fp, terms, seed=seed, **SIZES[size],
+            )
+
+        results = run_benchmarks(
+            corpus_fp, bins_fp, wordlist, list(bench) or BENCHMARKS, repeat,
+        )
+        files = [f.stat().st_size for f in corpus_fp.glob('*.txt')]
+
+    report = {
+        'commit': git_commit(),
+        'created': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'corpus': {
+            'size': size,
+            'seed': seed,
+            'files': len(files),
+            'bytes': sum(files),
+        },
+        'benchmarks': results,
+    }
+
+    if baseline:
+        previous = json.loads(Path(baseline).read_text())['benchmarks']
+        for name, result in results.items():
+            if name in previous:
+                ratio = result['median'] / previous[name]['median']
+                result['baseline_ratio'] = ratio
+                logger.info(f'{name}: {ratio:.2f} x baseline')
+
+    Path(output_filepath).write_text(json.dumps(report, indent=1))
+    logger.info(f'Saving benchmark results to file {output_filepath}')
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    log_file = Path('./logs') / Path(__file__).stem
+    logging.basicConfig(filename=log_file, level=logging.INFO, format=log_fmt)
+
+    main()
@@ -0,0 +1,328 @@
+import locale
+import logging
+import re
+import sqlite3
+from array import array
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Generator, Iterable, Mapping, Optional, Union
+
+from corpus_manifest import CorpusManifest
+from term_counter import MARGIN, WORD_RE, scan_vocabulary
+from utils import CHUNK_SIZE, scan_chunks
+
+INDEX_NAME = '.corpus_index.sqlite'
+
+
+class CorpusIndex:
+    """
+    Positional inverted index of the \\w+ tokens of a corpus in SQLite.
+
+    For every token and file the character and byte offsets of the token are
+    stored, so term frequencies and keyword-in-context windows of patterns
+    that match inside single tokens can be read without scanning the texts.
+    Offsets assume files with LF line endings.
+    """
+
+    def __init__(
+            self,
+            path: Union[Path, str],
+            encoding: Optional[str] = None,
+    ):
+        self.path = Path(path)
+        self.encoding = encoding or locale.getpreferredencoding(False)
+        self.connection = sqlite3.connect(str(self.path))
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY,
+                path TEXT UNIQUE,
+                year TEXT,
+                hash TEXT,
+                length INTEGER,
+                words INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS tokens (
+                id INTEGER PRIMARY KEY,
+                token TEXT UNIQUE,
+                norm TEXT
+            );
+            CREATE INDEX IF NOT EXISTS tokens_norm ON tokens (norm);
+            CREATE TABLE IF NOT EXISTS postings (
+                token_id INTEGER,
+                file_id INTEGER,
+                count INTEGER,
+                offsets BLOB,
+                PRIMARY KEY (token_id, file_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS postings_file ON postings (file_id);
+            """
+        )
+        self._vocabulary = None
+        self._file_table = None
+        self._matches = {}
+
+    @classmethod
+    def for_corpus(
+            cls,
+            manifest: CorpusManifest,
+            index_file: Union[Path, str, None] = None,
+    ) -> 'CorpusIndex':
+        index = cls(index_file or manifest.data_path / INDEX_NAME)
+        index.update(manifest)
+        return index
+
+    def _token_ids(self) -> dict:
+        return dict(self.connection.execute("SELECT token, id FROM tokens"))
+
+    def update(self, manifest: CorpusManifest) -> int:
+        """
+        Adds new and changed files of the manifest and drops removed ones.
+        """
+        indexed = {
+            path: (file_id, file_hash)
+            for file_id, path, file_hash
+            in self.connection.execute("SELECT id, path, hash FROM files")
+        }
+        entries = {
+            e['path']: e for e in manifest.entries.values()
+            if e['year'] is not None
+        }
+
+        removed = [
+            file_id for path, (file_id, file_hash) in indexed.items()
+            if path not in entries or entries[path]['hash'] != file_hash
+        ]
+        for file_id in removed:
+            self.connection.execute(
+                "DELETE FROM postings WHERE file_id = ?", (file_id,)
+            )
+            self.connection.execute(
+                "DELETE FROM files WHERE id = ?", (file_id,)
+            )
+
+        added = [
+            e for path, e in sorted(entries.items())
+            if path not in indexed or indexed[path][1] != e['hash']
+        ]
+        token_ids = self._token_ids() if added else {}
+
+        for entry in added:
+            self._add_file(manifest.path(entry), entry, token_ids)
+            self.connection.commit()
+
+        self.connection.commit()
+        if added or removed:
+            self._vocabulary = None
+            self._file_table = None
+            self._matches.clear()
+            logging.info(
+                f'Index {self.path}: {len(added)} files added, '
+                f'{len(removed)} removed'
+            )
+
+        return len(added)
+
+    def _add_file(self, path: Path, entry: dict, token_ids: dict) -> None:
+        logging.info(f'Indexing {entry["path"]}')
+        offsets = defaultdict(lambda: array('q'))
+        words = 0
+        length = 0
+        chunk_byte = 0
+
+        for offset, text, begin, end in scan_chunks(path, CHUNK_SIZE, MARGIN):
+            pos = begin
+            if begin > 0 and WORD_RE.match(text, begin - 1):
+                # the token crossing the chunk border belongs to the previous
+                # chunk
+                pos = WORD_RE.match(text, begin - 1).end()
+
+            last, byte = begin, chunk_byte
+            for m in WORD_RE.finditer(text, pos):
+                if m.start() >= end:
+                    break
+                byte += len(text[last:m.start()].encode(self.encoding))
+                last = m.start()
+                offsets[m.group()].extend((offset + m.start(), byte))
+                words += 1
+
+            chunk_byte += len(text[begin:end].encode(self.encoding))
+            length = offset + end
+
+        new_tokens = [t for t in offsets if t not in token_ids]
+        if new_tokens:
+            first = self.connection.execute(
+                "SELECT COALESCE(MAX(id), 0) + 1 FROM tokens"
+            ).fetchone()[0]
+            for i, token in enumerate(new_tokens, first):
+                token_ids[token] = i
+            self.connection.executemany(
+                "INSERT INTO tokens (id, token, norm) VALUES (?, ?, ?)",
+                [(token_ids[t], t, t.lower()) for t in new_tokens],
+            )
+
+        cursor = self.connection.execute(
+            "INSERT INTO files (path, year, hash, length, words) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (entry['path'], entry['year'], entry['hash'], length, words),
+        )
+        file_id = cursor.lastrowid
+
+        self.connection.executemany(
+            "INSERT INTO postings (token_id, file_id, count, offsets) "
+            "VALUES (?, ?, ?, ?)",
+            [
+                (
+                    token_ids[token], file_id, len(positions) // 2,
+                    positions.tobytes(),
+                )
+                for token, positions in offsets.items()
+            ],
+        )
+
+    def _files(self, paths: Iterable[Path], data_path: Path) -> list:
+        if self._file_table is None:
+            self._file_table = {
+                path: (file_id, length, words)
+                for file_id, path, length, words
+                in self.connection.execute(
+                    "SELECT id, path, length, words FROM files"
+                )
+            }
+        return [
+            self._file_table[Path(p).relative_to(data_path).as_posix()]
+            for p in paths
+        ]
+
+    def vocabulary(self) -> tuple:
+        if self._vocabulary is None:
+            rows = self.connection.execute(
+                "SELECT id, token FROM tokens ORDER BY id"
+            ).fetchall()
+            self._vocabulary = ([i for i, _ in rows], [t for _, t in rows])
+        return self._vocabulary
+
+    def matching_tokens(self, regex: re.Pattern) -> dict:
+        """
+        Match spans of a token pattern in every indexed token, by token id.
+        """
+        key = (regex.pattern, regex.flags)
+        if key not in self._matches:
+            ids, tokens = self.vocabulary()
+            found = scan_vocabulary(tokens, {key: regex})[key]
+            self._matches[key] = {
+                ids[i]: (tokens[i], spans) for i, spans in found.items()
+            }
+        return self._matches[key]
+
+    def lookup(self, word: str) -> list:
+        """
+        Indexed surface forms of a word, case-insensitively.
+        """
+        rows = self.connection.execute(
+            "SELECT token FROM tokens WHERE norm = ?", (word.lower(),)
+        )
+        return [token for token, in rows]
+
+    def _postings(
+            self,
+            token_ids: Iterable[int],
+            file_ids: Iterable[int],
+    ) -> Generator:
+        self.connection.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS query_tokens "
+            "(id INTEGER PRIMARY KEY)"
+        )
+        self.connection.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS query_files "
+            "(id INTEGER PRIMARY KEY)"
+        )
+        self.connection.execute("DELETE FROM query_tokens")
+        self.connection.execute("DELETE FROM query_files")
+        self.connection.executemany(
+            "INSERT INTO query_tokens VALUES (?)", [(i,) for i in token_ids]
+        )
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO query_files VALUES (?)",
+            [(i,) for i in file_ids],
+        )
+
+        yield from self.connection.execute(
+            """
+            SELECT p.token_id, p.file_id, p.count, p.offsets
+            FROM postings p
+            JOIN query_tokens t ON p.token_id = t.id
+            JOIN query_files f ON p.file_id = f.id
+            """
+        )
+
+    def count(
+            self,
+            paths: list,
+            data_path: Path,
+            regex: Mapping[str, re.Pattern],
+    ) -> list:
+        """
+        Word totals and term counts of token patterns for each path, in the
+        same form as TermCounter.count.
+        """
+        files = self._files(paths, data_path)
+        counts = {file_id: Counter() for file_id, _, _ in files}
+
+        for term, r in regex.items():
+            matched = self.matching_tokens(r)
+            for token_id, file_id, n, _ in self._postings(matched, counts):
+                counts[file_id][term] += n * len(matched[token_id][1])
+
+        rows = []
+        for file_id, _, words in files:
+            row = {'words': words}
+            row.update({term: counts[file_id][term] for term in regex})
+            rows.append(row)
+
+        return rows
+
+    def find_contexts(
+            self,
+            path: Path,
+            data_path: Path,
+            regex: re.Pattern,
+            window_size: int,
+    ) -> Generator:
+        """
+        Context windows of a token pattern in one file, in text order. Same
+        output as kwic.find_contexts without reading the whole file.
+        """
+        (file_id, length, _), = self._files([path], data_path)
+        matched = self.matching_tokens(regex)
+        hits = []
+
+        for token_id, _, _, blob in self._postings(matched, [file_id]):
+            token, spans = matched[token_id]
+            positions = array('q')
+            positions.frombytes(blob)
+            for char, byte in zip(positions[::2], positions[1::2]):
+                for start, end in spans:
+                    prefix = len(token[:start].encode(self.encoding))
+                    hits.append((char + start, byte + prefix, end - start))
+
+        hits.sort()
+        width = 4 * window_size
+
+        with open(path, 'rb') as fopen:
+            for char, byte, size in hits:
+                before = min(window_size, char)
+                stop = char + size + window_size
+                if stop >= length:
+                    stop = length - 1
+                fopen.seek(max(0, byte - width))
+                split = byte - max(0, byte - width)
+                raw = fopen.read(split + 4 * (stop - char))
+                head = raw[:split].decode(self.encoding, errors='ignore')
+                tail = raw[split:].decode(self.encoding, errors='ignore')
+                context = head[len(head) - before:] + tail[:stop - char]
+                yield context.replace('\n', ' ')
+
+    def close(self) -> None:
+        self.connection.commit()
+        self.connection.close()
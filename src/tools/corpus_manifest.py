@@ -0,0 +1,163 @@
+import hashlib
+import json
+import logging
+import os
+import re
+from pathlib import Path, PurePath
+from typing import Optional, Union
+
+MANIFEST_NAME = '.corpus_manifest.json'
+
+
+def file_hash(path: Path, block_size: int = 1 << 20) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+
+    with open(path, 'rb') as fopen:
+        for block in iter(lambda: fopen.read(block_size), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def file_year(name: str) -> Optional[str]:
+    years = re.findall(r'\d{4}', name)
+    return years[0] if years else None
+
+
+def file_bin(name: str) -> Optional[str]:
+    parts = PurePath(name).stem.split('_')
+    return parts[1] if len(parts) > 2 else None
+
+
+class CorpusManifest:
+    """
+    Cached listing of the text files under a corpus directory.
+
+    Every entry records the relative path, year, bin, size, mtime and content
+    hash of a file. ``refresh`` walks the tree once and rehashes only files
+    whose size or mtime changed, so repeated queries by rule, year or bin do
+    not touch the file system.
+    """
+
+    def __init__(
+            self,
+            data_path: Union[Path, str],
+            manifest_file: Union[Path, str, None] = None,
+            suffix: str = '.txt',
+    ):
+        self.data_path = Path(data_path)
+        self.manifest_file = (
+            Path(manifest_file) if manifest_file
+            else self.data_path / MANIFEST_NAME
+        )
+        self.suffix = suffix
+        self.entries = {}
+
+        if self.manifest_file.is_file():
+            try:
+                data = json.loads(self.manifest_file.read_text())
+                self.entries = {e['path']: e for e in data['files']}
+            except (ValueError, KeyError) as e:
+                logging.warning(
+                    f'Ignoring unreadable manifest {self.manifest_file}: {e}'
+                )
+
+    @classmethod
+    def load(
+            cls,
+            data_path: Union[Path, str],
+            manifest_file: Union[Path, str, None] = None,
+            refresh: bool = True,
+    ) -> 'CorpusManifest':
+        data_path = Path(data_path)
+        if not data_path.exists():
+            raise FileNotFoundError(
+                f"Specified data path {str(data_path)} does not exist."
+            )
+
+        manifest = cls(data_path, manifest_file)
+        if refresh or not manifest.entries:
+            manifest.refresh()
+
+        return manifest
+
+    def refresh(self) -> bool:
+        entries = {}
+        changed = False
+
+        for root, _, files in os.walk(self.data_path):
+            for name in files:
+                if not name.endswith(self.suffix):
+                    continue
+                path = Path(root) / name
+                rel_path = path.relative_to(self.data_path).as_posix()
+                stat = path.stat()
+                entry = self.entries.get(rel_path)
+
+                if (
+                        entry is None
+                        or entry['size'] != stat.st_size
+                        or entry['mtime'] != stat.st_mtime
+                ):
+                    logging.debug(f'Indexing {rel_path}')
+                    entry = {
+                        'path': rel_path,
+                        'year': file_year(name),
+                        'bin': file_bin(name),
+                        'size': stat.st_size,
+                        'mtime': stat.st_mtime,
+                        'hash': file_hash(path),
+                    }
+                    changed = True
+
+                entries[rel_path] = entry
+
+        changed = changed or entries.keys() != self.entries.keys()
+        self.entries = entries
+
+        if changed:
+            logging.info(f'Corpus manifest updated, {len(entries)} files')
+            self.save()
+
+        return changed
+
+    def save(self) -> None:
+        data = {
+            'data_path': str(self.data_path),
+            'files': sorted(self.entries.values(), key=lambda e: e['path']),
+        }
+        try:
+            self.manifest_file.write_text(json.dumps(data, indent=1))
+        except OSError as e:
+            logging.warning(
+                f'Could not save manifest to {self.manifest_file}: {e}'
+            )
+
+    def select(
+            self,
+            rule: str = '*',
+            year: Union[int, str, None] = None,
+            bin_: Optional[str] = None,
+    ) -> list:
+        """
+        Entries whose file name matches the glob rule, sorted by year.
+        """
+        selected = [
+            e for e in self.entries.values()
+            if e['year'] is not None
+            and PurePath(e['path']).match(rule)
+            and (year is None or e['year'] == str(year))
+            and (bin_ is None or e['bin'] == bin_)
+        ]
+
+        return sorted(selected, key=lambda e: (e['year'], e['path']))
+
+    def path(self, entry: dict) -> Path:
+        return self.data_path / entry['path']
+
+    def hash_of(self, path: Path) -> str:
+        rel_path = Path(path).relative_to(self.data_path).as_posix()
+        return self.entries[rel_path]['hash']
+
+    def hashes(self) -> set:
+        return {e['hash'] for e in self.entries.values()}
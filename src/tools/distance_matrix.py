@@ -1,28 +1,70 @@
 from pathlib import Path
-from typing import Iterable, Mapping
+from typing import Iterable, Mapping, Sequence, Tuple
 
+import numpy as np
 import pandas as pd
 import gensim
 
-from src.tools.utils import read_word_list
+from storage import save_frame
+from utils import read_word_list
+
+
+def word_vectors(
+        words: Mapping,
+        model,
+) -> Tuple[list, np.ndarray]:
+    """
+    The words found in the model and their vectors scaled to unit length, as
+    a float32 matrix with a row per word.
+    """
+    idx = [word for word in words if word in model.wv]
+    if not idx:
+        return idx, np.zeros((0, model.wv.vector_size), dtype=np.float32)
+
+    vectors = np.asarray(model.wv[idx], dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    # zero vectors are left as they are, as in gensim
+    norms[norms == 0] = 1
+
+    return idx, vectors / norms
 
 
 def make_distance_matrix(
         words: Mapping,
         model,
 ) -> pd.DataFrame:
-    idx = [word for word in words if word in model.wv]
-    result = {}
+    idx, vectors = word_vectors(words, model)
+
+    return pd.DataFrame(vectors @ vectors.T, index=idx, columns=idx)
 
-    for word in idx:
-        result[word] = pd.Series(
-            [model.wv.similarity(w, word) for w in idx],
-            index=idx,
-        )
 
-    result = pd.DataFrame(result)
+def make_distance_matrix_batch(
+        vectors: Sequence[Tuple[list, np.ndarray]],
+) -> list:
+    """
+    Similarity matrices of the (words, unit vectors) of several models with
+    one batched matrix product. The vectors are placed in a zero padded array
+    with a row for every word of any model, padding does not change the dot
+    products.
+    """
+    words = list(dict.fromkeys(word for idx, _ in vectors for word in idx))
+    position = {word: i for i, word in enumerate(words)}
+    dim = max((v.shape[1] for _, v in vectors), default=0)
 
-    return result
+    batch = np.zeros((len(vectors), len(words), dim), dtype=np.float32)
+    for i, (idx, v) in enumerate(vectors):
+        batch[i, [position[word] for word in idx], :v.shape[1]] = v
+
+    products = np.matmul(batch, batch.transpose(0, 2, 1))
+
+    matrices = []
+    for (idx, _), product in zip(vectors, products):
+        rows = [position[word] for word in idx]
+        matrices.append(pd.DataFrame(
+            product[np.ix_(rows, rows)], index=idx, columns=idx,
+        ))
+
+    return matrices
 
 
 def make_distance_matrices(
@@ -30,14 +72,22 @@ def make_distance_matrices(
         models: Iterable,
         word_file: Path,
         output_dir: Path,
+        fmt: str = 'csv',
 ):
     output_dir.mkdir(parents=True, exist_ok=True)
     words = read_word_list(word_file)
 
+    # only the vectors of the words are kept, not the models
+    names = []
+    vectors = []
     for name, model in models:
-        print(f"Making similarity matrix from {name}")
-        d = make_distance_matrix(words, model)
-        d.to_csv(output_dir / f"{name}.csv")
+        print(f"Reading word vectors from {name}")
+        names.append(name)
+        vectors.append(word_vectors(words, model))
+
+    print(f"Making similarity matrices from {len(names)} models")
+    for name, d in zip(names, make_distance_matrix_batch(vectors)):
+        save_frame(d, output_dir / f"{name}.csv", fmt)
 
 
 if __name__ == '__main__':
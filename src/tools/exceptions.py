@@ -1,5 +1,9 @@
 class EmptyDataFrameError(ValueError):
     pass
 
+
+class QueryError(RuntimeError):
+    pass
+
 if __name__ == "__main__":
     pass
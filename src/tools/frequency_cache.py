@@ -0,0 +1,114 @@
+import hashlib
+import logging
+import re
+import sqlite3
+import time
+from pathlib import Path
+from typing import Iterable, Mapping, Union
+
+CACHE_NAME = '.frequency_cache.sqlite'
+
+
+def pattern_key(regex: re.Pattern) -> str:
+    source = f'{regex.flags}:{regex.pattern}'
+    return hashlib.blake2b(source.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class FrequencyCache:
+    """
+    Persistent per-file, per-pattern match counts.
+
+    Counts are keyed by the content hash of the file and a hash of the
+    compiled pattern (source and flags), so renaming a term or moving a file
+    does not invalidate anything, while editing a regex or a file does.
+    """
+
+    def __init__(self, path: Union[Path, str]):
+        self.path = Path(path)
+        self.connection = sqlite3.connect(str(self.path))
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS patterns (
+                key TEXT PRIMARY KEY,
+                source TEXT,
+                last_used REAL
+            );
+            CREATE TABLE IF NOT EXISTS counts (
+                file_hash TEXT,
+                pattern_key TEXT,
+                count INTEGER,
+                PRIMARY KEY (file_hash, pattern_key)
+            ) WITHOUT ROWID;
+            """
+        )
+
+    def touch(self, patterns: Mapping[str, re.Pattern]) -> dict:
+        keys = {term: pattern_key(r) for term, r in patterns.items()}
+        now = time.time()
+
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO patterns (key, source, last_used) "
+            "VALUES (?, ?, ?)",
+            [(keys[term], r.pattern, now) for term, r in patterns.items()],
+        )
+        self.connection.commit()
+
+        return keys
+
+    def get(self, file_hash: str) -> dict:
+        rows = self.connection.execute(
+            "SELECT pattern_key, count FROM counts WHERE file_hash = ?",
+            (file_hash,),
+        )
+        return dict(rows)
+
+    def put(self, file_hash: str, counts: Mapping[str, int]) -> None:
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO counts (file_hash, pattern_key, count) "
+            "VALUES (?, ?, ?)",
+            [(file_hash, key, int(n)) for key, n in counts.items()],
+        )
+
+    def commit(self) -> None:
+        self.connection.commit()
+
+    def evict(
+            self,
+            file_hashes: Iterable[str],
+            max_age_days: float = 30,
+    ) -> int:
+        """
+        Drops counts of files that are no longer in the corpus and of patterns
+        that have not been used for max_age_days.
+        """
+        cursor = self.connection.cursor()
+        cursor.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS live_files "
+            "(file_hash TEXT PRIMARY KEY)"
+        )
+        cursor.execute("DELETE FROM live_files")
+        cursor.executemany(
+            "INSERT OR IGNORE INTO live_files (file_hash) VALUES (?)",
+            [(h,) for h in file_hashes],
+        )
+
+        cutoff = time.time() - max_age_days * 86_400
+        cursor.execute("DELETE FROM patterns WHERE last_used < ?", (cutoff,))
+        cursor.execute(
+            """
+            DELETE FROM counts
+            WHERE file_hash NOT IN (SELECT file_hash FROM live_files)
+            OR pattern_key NOT IN (SELECT key FROM patterns)
+            """
+        )
+        evicted = cursor.rowcount
+        self.connection.commit()
+
+        if evicted:
+            logging.info(f'Evicted {evicted} stale entries from {self.path}')
+
+        return evicted
+
+    def close(self) -> None:
+        self.connection.commit()
+        self.connection.close()
@@ -1,37 +1,97 @@
+import csv
 import os
 import re
+import sys
+import time
 from pathlib import Path
-from typing import Callable, Union, Generator
+from typing import Callable, Generator, Mapping, Optional, Union
 import logging
+from concurrent.futures import ProcessPoolExecutor
 
 import pandas as pd
 from pandas import DataFrame
 import click
 
+from corpus_index import CorpusIndex
+from corpus_manifest import CorpusManifest
+from kwic_database import KwicTable, size_limits
+from metrics import metrics_options, start_metrics
+from term_counter import MARGIN, is_token_pattern
+from utils import (
+    CHUNK_SIZE, ordered_map, read_word_list, scan_chunks, text_file_paths,
+)
 
-def text_file_generator(
-        data_path: Path,
-        rule: str,
+STAGES = [
+    'save_kwic_by_word',
+    'save_kwic_all_terms',
+    'get_kwic_for_word',
+    'file_contexts',
+    'get_kwic',
+]
+
+
+def find_contexts(
+        file: Path,
+        regex_dict: Mapping[str, re.Pattern],
+        window_size: int,
+        chunk_size: int = CHUNK_SIZE,
 ) -> Generator:
-    if not data_path.exists():
-        raise FileNotFoundError(f"Specified data path {data_path} does not exist.")
+    """
+    Yields (term, context) for every match in the file, reading it in chunks
+    that overlap by more than the context window. Each pattern is searched
+    from where its last match ended, so the matches are the same
+    non-overlapping ones as in the whole text.
+    """
+    # file offset where the search of each pattern continues
+    resume = dict.fromkeys(regex_dict, 0)
+
+    chunks = scan_chunks(file, chunk_size, window_size + MARGIN)
+    for offset, text, begin, stop in chunks:
+        for w, r in regex_dict.items():
+            for m in r.finditer(text, max(begin, resume[w] - offset)):
+                if m.start() >= stop:
+                    break
+                resume[w] = offset + m.end()
+                start, end = m.span()
+                start = start - window_size
+                if start < 0:
+                    start = 0
+                end = end + window_size
+                if end >= len(text):
+                    end = len(text) - 1
+                yield w, text[start:end].replace('\n', ' ')
 
-    paths = list(data_path.rglob(rule))
-    years = [re.findall(r'\d{4}', path.name)[0] for path in paths]
 
-    for path, year in sorted(zip(paths, years), key=lambda x: x[1]):
-        text = path.read_text()
-        yield path, year, text
+def file_contexts(
+        file: Path,
+        regex_dict: Mapping[str, re.Pattern],
+        window_size: int,
+) -> list:
+    if not regex_dict:
+        return []
+    return list(find_contexts(file, regex_dict, window_size))
 
 
-def read_word_list(file):
-    data = pd.read_csv(str(file), header=None)
-    data.columns = 'word regex'.split()
-    data.dropna(inplace=True)
-    data.sort_values(by='word', inplace=True)
-    words = data['word']
-    regex = data['regex']
-    return {w.casefold(): r for w, r in zip(words, regex)}
+def contexts_by_file(
+        files: list,
+        regex_dict,
+        window_size: int,
+        executor: Optional[ProcessPoolExecutor] = None,
+        lookahead: int = 1,
+) -> Generator:
+    """
+    Yields the (term, context) list of each file in order. regex_dict may be
+    a callable returning the patterns to search for, it is called just
+    before a file is submitted.
+    """
+    patterns = regex_dict if callable(regex_dict) else lambda: regex_dict
+    args = ((file, patterns(), window_size) for file in files)
+
+    if executor is None:
+        for a in args:
+            yield file_contexts(*a)
+    else:
+        yield from ordered_map(executor, file_contexts, args, lookahead)
 
 
 def get_kwic(
@@ -40,30 +100,21 @@ def get_kwic(
         year: int,
         window_size: int,
 ):
-    rows = []
+    rows = {w: [] for w in regex_dict}
     logging.info(f'Processing file {file.name}')
-    text = file.read_text()
-    for w, r in regex_dict.items():
-        matches = r.finditer(text)
-        for m in matches:
-            start, end = m.span()
-            start = start - window_size
-            if start < 0:
-                start = 0
-            end = end + window_size
-            if end >= len(text):
-                end = len(text) - 1
-            context = text[start:end].replace('\n', ' ')
-            row = {
-                'file': file.stem,
-                'year': year,
-                'keyword': w,
-                'context': context,
-            }
+    for w, context in find_contexts(file, regex_dict, window_size):
+        row = {
+            'file': file.stem,
+            'year': year,
+            'keyword': w,
+            'context': context,
+        }
 
-            rows.append(row)
+        rows[w].append(row)
 
-    return pd.DataFrame(rows).sort_values('keyword')
+    return pd.DataFrame(
+        [row for w in regex_dict for row in rows[w]]
+    ).sort_values('keyword')
 
 
 def get_kwic_for_word(
@@ -74,25 +125,37 @@ def get_kwic_for_word(
         regex: re.Pattern,
         window_size: int,
         size_limit: int,
+        manifest: Optional[CorpusManifest] = None,
+        index: Optional[CorpusIndex] = None,
+        executor: Optional[ProcessPoolExecutor] = None,
+        lookahead: int = 1,
 ) -> DataFrame:
-    texts = text_file_generator(data_path, rule)
+    files = text_file_paths(data_path, rule, manifest=manifest)
     logging.info(f'Searching {data_path} for {term}')
     rows = []
 
-    for file, year, text in texts:
+    if index is not None and not is_token_pattern(regex):
+        logging.info(f'Pattern for {term} can span tokens, scanning texts')
+        index = None
+
+    if index is None:
+        found = contexts_by_file(
+            [file for file, _ in files], {term: regex}, window_size, executor,
+            lookahead,
+        )
+
+    for file, year in files:
         if len(rows) >= size_limit:
             break
-        matches = regex.finditer(text)
-
-        for m in matches:
-            start, end = m.span()
-            start = start - window_size
-            if start < 0:
-                start = 0
-            end = end + window_size
-            if end >= len(text):
-                end = len(text) - 1
-            context = text[start:end].replace('\n', ' ')
+
+        if index is not None:
+            contexts = index.find_contexts(
+                file, data_path, regex, window_size,
+            )
+        else:
+            contexts = (context for _, context in next(found))
+
+        for context in contexts:
             row = {
                 'file': file.stem,
                 'year': year,
@@ -101,10 +164,14 @@ def get_kwic_for_word(
             }
             rows.append(row)
 
+    if index is None:
+        found.close()
+
     if not rows:
         return pd.DataFrame()
 
-    return pd.DataFrame.from_records(rows).sort_values('year').head(size_limit).reset_index()
+    data = pd.DataFrame.from_records(rows)
+    return data.sort_values('year').head(size_limit).reset_index()
 
 
 def save_kwic_by_word(
@@ -116,34 +183,171 @@ def save_kwic_by_word(
         window_size: int,
         size_limit: int,
         word_filter_rule: Union[str, Callable[[str], bool]],
+        manifest_file: Optional[Path] = None,
+        index_file: Optional[Path] = None,
+        workers: int = 1,
+        table: Optional[KwicTable] = None,
 ):
+    """
+    Saves the KWIC rows of every term in a csv file of its own, or inserts
+    them into the table.
+    """
     output_dir.mkdir(parents=True, exist_ok=True)
     words = read_word_list(wordlist)
+    manifest = CorpusManifest.load(input_dir, manifest_file)
+    index = None
+    if index_file:
+        index = CorpusIndex.for_corpus(manifest, index_file)
+    executor = ProcessPoolExecutor(workers) if workers > 1 else None
     regex = {
         word: re.compile(regexpr, flags=re.IGNORECASE)
         for word, regexpr
         in words.items()
     }
 
-    for term, regex in regex.items():
-        if word_filter_rule != 'all' and not word_filter_rule(term):
+    try:
+        for term, regex in regex.items():
+            if word_filter_rule != 'all' and not word_filter_rule(term):
+                continue
+            output_file = output_dir / f"{term.replace(' ', '_')}.csv"
+            if table is None and output_file.is_file():
+                logging.info(f"{output_file} exists, skipping {term}")
+                continue
+            started = time.perf_counter()
+            kwic_term = get_kwic_for_word(
+                data_path=input_dir,
+                rule=rule,
+                term=term,
+                regex=regex,
+                window_size=window_size,
+                size_limit=size_limit,
+                manifest=manifest,
+                index=index,
+                executor=executor,
+                lookahead=2 * workers,
+            )
+            if not kwic_term.empty:
+                kwic_term.drop(columns=['index', 'keyword'], inplace=True)
+            logging.info(
+                f'Saving data: {term}, '
+                f'searched in {time.perf_counter() - started:.2f} s'
+            )
+            if table is not None:
+                table.add(output_file.stem, kwic_term)
+                table.finish(output_file.stem)
+            else:
+                kwic_term.to_csv(output_file)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+def save_kwic_all_terms(
+        *,
+        input_dir: Path,
+        output_dir: Path,
+        rule: str,
+        wordlist: Path,
+        window_size: int,
+        size_limit: int,
+        word_filter_rule: Union[str, Callable[[str], bool]],
+        manifest_file: Optional[Path] = None,
+        workers: int = 1,
+        table: Optional[KwicTable] = None,
+):
+    """
+    Same output files as save_kwic_by_word, but every file is scanned once
+    for all terms and rows are streamed to the term files as they are found.
+    A term is no longer searched once it has size_limit rows. With a table
+    the rows of each scanned file are added to it instead.
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    words = read_word_list(wordlist)
+    manifest = CorpusManifest.load(input_dir, manifest_file)
+    regex = {}
+
+    for word, regexpr in words.items():
+        if word_filter_rule != 'all' and not word_filter_rule(word):
             continue
-        output_file = output_dir / f"{term.replace(' ', '_')}.csv"
-        if output_file.is_file():
-            logging.info(f"{output_file} exists, skipping {term}")
+        output_file = output_dir / f"{word.replace(' ', '_')}.csv"
+        if table is None and output_file.is_file():
+            logging.info(f"{output_file} exists, skipping {word}")
             continue
-        kwic_term = get_kwic_for_word(
-            data_path=input_dir,
-            rule=rule,
-            term=term,
-            regex=regex,
-            window_size=window_size,
-            size_limit=size_limit,
+        regex[word] = re.compile(regexpr, flags=re.IGNORECASE)
+
+    outputs = {}
+    writers = {}
+    rows = dict.fromkeys(regex, 0)
+    executor = ProcessPoolExecutor(workers) if workers > 1 else None
+    found = None
+
+    try:
+        for term in regex if table is None else ():
+            part_file = output_dir / f"{term.replace(' ', '_')}.csv.part"
+            outputs[term] = open(part_file, 'w', newline='')
+            writers[term] = csv.writer(outputs[term], lineterminator='\n')
+            writers[term].writerow(['', 'file', 'year', 'context'])
+
+        files = text_file_paths(input_dir, rule, manifest=manifest)
+
+        def active():
+            return {t: r for t, r in regex.items() if rows[t] < size_limit}
+
+        found = contexts_by_file(
+            [file for file, _ in files], active, window_size, executor,
+            2 * workers,
         )
-        if not kwic_term.empty:
-            kwic_term.drop(columns=['index', 'keyword'], inplace=True)
-        logging.info(f'Saving data: {term}')
-        kwic_term.to_csv(output_file)
+
+        for file, year in files:
+            if not active():
+                break
+            logging.info(
+                f'Processing file {file.name}, {len(active())} terms left'
+            )
+
+            found_rows = {}
+            for term, context in next(found):
+                if rows[term] >= size_limit:
+                    continue
+                if table is not None:
+                    found_rows.setdefault(term, []).append(
+                        [file.stem, year, context]
+                    )
+                else:
+                    writers[term].writerow(
+                        [rows[term], file.stem, year, context]
+                    )
+                rows[term] += 1
+
+            for term, term_rows in found_rows.items():
+                table.add(term.replace(' ', '_'), pd.DataFrame(
+                    term_rows, columns=['file', 'year', 'context'],
+                ))
+    finally:
+        # closing the generator cancels the files still waiting to be scanned
+        if found is not None:
+            found.close()
+        for output in outputs.values():
+            output.close()
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    if table is not None:
+        for term in regex:
+            logging.info(f'Saving data: {term}, {rows[term]} rows')
+        return
+
+    # files are only renamed when complete, so an interrupted run is redone
+    for term in regex:
+        logging.info(f'Saving data: {term}, {rows[term]} rows')
+        output_file = output_dir / f"{term.replace(' ', '_')}.csv"
+        part_file = Path(outputs[term].name)
+        if rows[term]:
+            part_file.replace(output_file)
+        else:
+            # what save_kwic_by_word writes for an empty data frame
+            pd.DataFrame().to_csv(output_file)
+            part_file.unlink()
 
 
 def get_kwic_all(
@@ -152,8 +356,9 @@ def get_kwic_all(
         rule: str,
         wordlist: str,
         window_size: int,
+        manifest: Optional[CorpusManifest] = None,
 ) -> DataFrame:
-    texts = text_file_generator(data, rule)
+    paths = text_file_paths(data, rule, manifest=manifest)
     words = read_word_list(wordlist)
     regex = {
         word: re.compile(regexpr, flags=re.IGNORECASE)
@@ -162,7 +367,7 @@ def get_kwic_all(
     }
     files = []
 
-    for file, year, _ in texts:
+    for file, year in paths:
         kwic = get_kwic(
             file=file,
             regex_dict=regex,
@@ -178,9 +383,45 @@ def get_kwic_all(
 @click.argument('input_filepath', type=click.Path(exists=True))
 @click.argument('output_filepath', type=click.Path())
 @click.argument('wordlist_filepath', type=click.Path(exists=True))
-@click.option('--window_size', type=click.IntRange(1, 1000), help='size of context window, characters, both directions')
-@click.option('--size_limit', type=click.IntRange(10, 50_000), help='maximum number of results saved in file')
-@click.option('--files', type=click.STRING, default='*.txt', help='rule to select suitable files')
+@click.option(
+    '--window_size', type=click.IntRange(1, 1000),
+    help='size of context window, characters, both directions',
+)
+@click.option(
+    '--size_limit', type=click.IntRange(10, 50_000),
+    help='maximum number of results saved in file',
+)
+@click.option(
+    '--files', type=click.STRING, default='*.txt',
+    help='rule to select suitable files',
+)
+@click.option(
+    '--manifest', type=click.Path(),
+    help='corpus manifest file, default is inside input directory',
+)
+@click.option(
+    '--index', type=click.Path(),
+    help='positional index file, built or updated before searching',
+)
+@click.option(
+    '--one-pass', is_flag=True,
+    help='scan each file once for all terms and stream rows to the term '
+         'files',
+)
+@click.option(
+    '--workers', type=click.IntRange(1, None), default=1,
+    help='number of worker processes',
+)
+@click.option(
+    '--database-url', type=click.STRING,
+    help='insert the rows into this database instead of writing csv files',
+)
+@click.option(
+    '--table', type=click.STRING,
+    help='database table of the rows, replaced, default is the output '
+         'directory name',
+)
+@metrics_options
 def main(
     input_filepath, 
     output_filepath, 
@@ -188,6 +429,14 @@ def main(
     window_size,
     size_limit,
     files,
+    manifest,
+    index,
+    one_pass,
+    workers,
+    database_url,
+    table,
+    profile,
+    metrics_file,
     ):
     """
     Performs keywords-in-context analysis and saves results in csv files
@@ -196,16 +445,46 @@ def main(
     input_dir = Path(input_filepath)
     output_dir = Path(output_filepath)
     wordlist = Path(wordlist_filepath)
+    start_metrics(sys.modules[__name__], STAGES, profile, metrics_file, logger)
+    kwic_table = None
+    if database_url:
+        kwic_table = KwicTable(
+            database_url, table or output_dir.name,
+            size_limit=size_limits(size_limit),
+        )
+
+    if one_pass:
+        save_kwic_all_terms(
+            output_dir=output_dir,
+            input_dir=input_dir,
+            rule=files,
+            wordlist=wordlist,
+            window_size=window_size,
+            size_limit=size_limit,
+            word_filter_rule='all',
+            manifest_file=manifest,
+            workers=workers,
+            table=kwic_table,
+        )
+    else:
+        save_kwic_by_word(
+            output_dir=output_dir,
+            input_dir=input_dir,
+            rule=files,
+            wordlist=wordlist,
+            window_size=window_size,
+            size_limit=size_limit,
+            word_filter_rule='all',
+            manifest_file=manifest,
+            index_file=index,
+            workers=workers,
+            table=kwic_table,
+        )
 
-    save_kwic_by_word(
-        output_dir=output_dir,
-        input_dir=input_dir,
-        rule=files,
-        wordlist=wordlist,
-        window_size=window_size,
-        size_limit=size_limit,
-        word_filter_rule='all',
-    )
+    if kwic_table is not None:
+        kwic_table.flush()
+        kwic_table.create_index()
+        kwic_table.close()
 
 
 if __name__ == '__main__':
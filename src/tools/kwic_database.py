@@ -0,0 +1,166 @@
+import logging
+from collections import defaultdict
+from typing import Mapping, Optional
+
+import pandas as pd
+
+try:
+    from sqlalchemy import create_engine, inspect, text
+except ImportError:
+    create_engine = None
+
+BATCH_SIZE = 10_000
+
+
+def size_limits(default: int = 2_000) -> defaultdict:
+    """
+    Rows kept per term in the database tables, more for fred.
+    """
+    limits = defaultdict(lambda: default)
+    limits['fred'] = 20_000
+    return limits
+
+
+def limit_rows(data: pd.DataFrame, limit: int) -> pd.DataFrame:
+    """
+    The limit rows of the earliest years, in year order. The sort is stable,
+    so limiting the rows in parts and then all together gives the same rows.
+    """
+    return data.sort_values(by='year', kind='stable').head(limit)
+
+
+def kwic_rows(data: pd.DataFrame, term: str) -> pd.DataFrame:
+    """
+    KWIC rows in the form of the database tables: the term added, and the
+    lemma/regex/both type of Korp rows split into lemma and regex flags.
+    """
+    data = data.assign(term=term)
+
+    if 'type' in data.columns:
+        data['lemma'] = data['type'].isin(['lemma', 'both'])
+        data['regex'] = data['type'].isin(['regex', 'both'])
+        data = data.drop(columns='type')
+
+    return data
+
+
+class KwicTable:
+    """
+    Streams KWIC rows into a database table, in the form populate_database
+    gives the rows of the kwic csv files, without writing the files.
+
+    Rows are buffered and inserted batch_size at a time. With a size limit
+    only the limit rows of the earliest years of each term are kept, as
+    word_to_sql keeps them. Those are held until the term is finished and
+    inserted in year order. Without a limit rows are inserted as they come.
+
+    With replace the table is dropped first. Otherwise the stored rows of a
+    term are deleted when the term is first added, so a term that was
+    interrupted halfway is not stored twice when it is done again.
+    """
+
+    def __init__(
+            self,
+            database_url: str,
+            table: str,
+            batch_size: int = BATCH_SIZE,
+            replace: bool = True,
+            size_limit: Optional[Mapping] = None,
+    ):
+        if create_engine is None:
+            raise ImportError('Writing to a database needs sqlalchemy')
+
+        self.engine = create_engine(database_url)
+        self.table = table
+        # quoted as to_sql quotes it, the name is never pasted into sql as is
+        quote = self.engine.dialect.identifier_preparer.quote
+        self.quoted_table = quote(table)
+        self.quoted_index = quote(f'{table}_index')
+        self.batch_size = batch_size
+        self.replace = replace
+        self.size_limit = size_limit
+        self.terms = set()
+        self.pending = {}
+        self.buffer = []
+        self.buffered = 0
+        self.rows = 0
+
+        if replace:
+            with self.engine.begin() as connection:
+                connection.execute(
+                    text(f"DROP TABLE IF EXISTS {self.quoted_table}")
+                )
+
+    def add(self, term: str, data: pd.DataFrame) -> None:
+        if term not in self.terms:
+            self.terms.add(term)
+            if not self.replace and inspect(self.engine).has_table(self.table):
+                with self.engine.begin() as connection:
+                    connection.execute(
+                        text(
+                            f"DELETE FROM {self.quoted_table} "
+                            "WHERE term = :term"
+                        ),
+                        {'term': term},
+                    )
+
+        if data.empty:
+            return
+
+        if self.size_limit is not None:
+            if term in self.pending:
+                data = pd.concat([self.pending[term], data], ignore_index=True)
+            self.pending[term] = limit_rows(data, self.size_limit[term])
+            return
+
+        self._insert(kwic_rows(data, term))
+
+    def finish(self, term: str) -> None:
+        """
+        Inserts the rows kept for a term, no more rows of it may be added.
+        """
+        data = self.pending.pop(term, None)
+        if data is not None:
+            self._insert(kwic_rows(data, term))
+
+    def _insert(self, data: pd.DataFrame) -> None:
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.buffer:
+            return
+
+        data = pd.concat(self.buffer, ignore_index=True)
+        logging.info(f'Inserting {len(data)} rows into {self.table}')
+        data.to_sql(
+            self.table,
+            con=self.engine,
+            if_exists='append',
+            index=False,
+            chunksize=self.batch_size,
+        )
+        self.rows += len(data)
+        self.buffer = []
+        self.buffered = 0
+
+    def create_index(self) -> None:
+        if not inspect(self.engine).has_table(self.table):
+            logging.critical(
+                f"Index not created because table '{self.table}' has no rows."
+            )
+            return
+        with self.engine.begin() as connection:
+            connection.execute(text(
+                f"CREATE INDEX IF NOT EXISTS {self.quoted_index} "
+                f"ON {self.quoted_table} (term, year)"
+            ))
+        logging.info(f"Index created for {self.table}")
+
+    def close(self) -> None:
+        for term in list(self.pending):
+            self.finish(term)
+        self.flush()
+        self.engine.dispose()
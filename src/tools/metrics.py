@@ -0,0 +1,231 @@
+import cProfile
+import functools
+import inspect
+import io
+import json
+import logging
+import pstats
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Iterable, Mapping, Optional, Union
+
+import click
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+HOT_PATHS = 25
+
+
+def peak_rss() -> Optional[dict]:
+    """
+    Peak resident set size of this process and of its largest finished
+    child process, in bytes. None where the resource module is missing.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'children': children.ru_maxrss * 1024,
+    }
+
+
+def _file_size(value) -> Optional[int]:
+    if isinstance(value, Path) and value.is_file():
+        return value.stat().st_size
+    return None
+
+
+class Metrics:
+    """
+    Per-stage timings and throughput counters of a command line run.
+
+    ``instrument`` replaces functions of a module with timed wrappers, so
+    the stage functions themselves need no changes. A call counts as a
+    processed file when its first argument is a path to a file, and as a
+    term when it has a word or term keyword argument. Calls made in worker
+    processes are not seen.
+    """
+
+    def __init__(self, profile: bool = False):
+        self.started = time.perf_counter()
+        self.stages = defaultdict(lambda: {'calls': 0, 'seconds': 0.0})
+        self.counters = Counter()
+        self.terms = defaultdict(lambda: {'seconds': 0.0, 'matches': 0})
+        self.profiler = cProfile.Profile() if profile else None
+        if self.profiler is not None:
+            self.profiler.enable()
+
+    def _record(
+            self,
+            stage: str,
+            seconds: float,
+            args: tuple,
+            kwargs: dict,
+            result=None,
+    ) -> None:
+        self.stages[stage]['calls'] += 1
+        self.stages[stage]['seconds'] += seconds
+
+        size = _file_size(
+            args[0] if args else kwargs.get('file', kwargs.get('path'))
+        )
+        if size is not None:
+            self.counters['files'] += 1
+            self.counters['bytes'] += size
+
+        term = kwargs.get('term', kwargs.get('word'))
+        if isinstance(term, str):
+            self.terms[term]['seconds'] += seconds
+            if (
+                    hasattr(result, '__len__')
+                    and not isinstance(result, (tuple, str))
+            ):
+                self.terms[term]['matches'] += len(result)
+
+    def wrap(self, fn, stage: str):
+        if inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def timed_generator(*args, **kwargs):
+                seconds = 0.0
+                generator = fn(*args, **kwargs)
+                try:
+                    while True:
+                        started = time.perf_counter()
+                        try:
+                            item = next(generator)
+                        finally:
+                            seconds += time.perf_counter() - started
+                        yield item
+                except StopIteration:
+                    pass
+                finally:
+                    generator.close()
+                    self._record(stage, seconds, args, kwargs)
+            return timed_generator
+
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            result = fn(*args, **kwargs)
+            self._record(
+                stage, time.perf_counter() - started, args, kwargs, result,
+            )
+            return result
+        return timed
+
+    def instrument(self, module, names: Iterable[str]) -> None:
+        for name in names:
+            fn = getattr(module, name, None)
+            if fn is None:
+                continue
+            stage = name
+            if module.__name__ != '__main__':
+                stage = f'{module.__name__}.{name}'
+            setattr(module, name, self.wrap(fn, stage))
+
+    def add_terms(
+            self,
+            matches: Optional[Mapping] = None,
+            seconds: Optional[Mapping] = None,
+    ) -> None:
+        for term, n in (matches.items() if matches is not None else ()):
+            self.terms[term]['matches'] += int(n)
+        for term, s in (seconds.items() if seconds is not None else ()):
+            self.terms[term]['seconds'] += s
+
+    def report(self) -> dict:
+        elapsed = time.perf_counter() - self.started
+        report = {
+            'elapsed': elapsed,
+            'stages': dict(self.stages),
+            'counters': dict(self.counters),
+            'files_per_second': (
+                self.counters['files'] / elapsed if elapsed else 0.0
+            ),
+            'bytes_per_second': (
+                self.counters['bytes'] / elapsed if elapsed else 0.0
+            ),
+            'terms': dict(self.terms),
+            'peak_rss': peak_rss(),
+        }
+
+        if self.profiler is not None:
+            self.profiler.disable()
+            stats = pstats.Stats(self.profiler, stream=io.StringIO())
+            stats.sort_stats('cumulative')
+            report['hot_paths'] = [
+                {
+                    'function': f'{file}:{line}({name})',
+                    'calls': calls,
+                    'tottime': tottime,
+                    'cumtime': cumtime,
+                }
+                for (file, line, name), (_, calls, tottime, cumtime, _)
+                in sorted(
+                    stats.stats.items(),
+                    key=lambda item: item[1][3],
+                    reverse=True,
+                )[:HOT_PATHS]
+            ]
+
+        return report
+
+    def save(self, path: Union[Path, str], logger: logging.Logger) -> None:
+        path = Path(path)
+        report = self.report()
+        path.write_text(json.dumps(report, indent=1, default=str))
+        if self.profiler is not None:
+            self.profiler.dump_stats(str(path.with_suffix('.prof')))
+        logger.info(
+            f'Saving run metrics to file {path}, '
+            f'{report["elapsed"]:.1f} s in total'
+        )
+
+
+def metrics_options(f):
+    f = click.option(
+        '--metrics-file', type=click.Path(),
+        help='save per-stage timings and throughput as json',
+    )(f)
+    f = click.option(
+        '--profile', is_flag=True,
+        help='also profile hot paths, saved with the metrics and as a .prof '
+             'file',
+    )(f)
+    return f
+
+
+def start_metrics(
+        module,
+        stages: Iterable[str],
+        profile: bool,
+        metrics_file: Optional[str],
+        logger: logging.Logger,
+) -> Optional[Metrics]:
+    """
+    Instruments the stage functions of a module if metrics were asked for.
+    The metrics are saved when the click command finishes, by default to
+    ./logs/<script>.metrics.json.
+    """
+    if not profile and not metrics_file:
+        return None
+
+    metrics = Metrics(profile)
+    metrics.instrument(module, stages)
+    if metrics_file:
+        path = Path(metrics_file)
+    else:
+        path = Path('./logs') / f'{Path(module.__file__).stem}.metrics.json'
+    # the command may change the working directory
+    path = path.absolute()
+    click.get_current_context().call_on_close(
+        lambda: metrics.save(path, logger)
+    )
+
+    return metrics
@@ -0,0 +1,429 @@
+import json
+import logging
+import random
+import re
+import socket
+import threading
+import time
+from bisect import bisect_right
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qsl, urlsplit
+
+import click
+
+from benchmark import CONFUSIONS, SUFFIXES, SYLLABLES
+from utils import read_word_list
+
+PUBLICATIONS = [
+    ('Suometar', 'sanomalehti'),
+    ('Sanansaattaja Wiipurista', 'sanomalehti'),
+    ('Oulun Wiikko-Sanomia', 'sanomalehti'),
+    ('Kanava', 'aikakausi'),
+    ('Mehiläinen', 'aikakausi'),
+]
+STRUCTS = [
+    'text_binding_id',
+    'text_issue_date',
+    'text_issue_no',
+    'text_page_no',
+    'text_publ_title',
+    'text_publ_type',
+]
+# word="..." or lemma="..." inside a CQP token
+CONDITION = re.compile(r'(word|lemma)\s*=\s*"((?:[^"\\]|\\.)*)"')
+
+
+class SyntheticCorpus:
+    """
+    One year of newspaper text: pages of filler words with inflected and
+    misread word list terms, each with the structural attributes the
+    KLK_FI corpora have. Generated from the seed, so the same arguments
+    always give the same corpus.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            year: int,
+            terms: list,
+            pages: int,
+            words_per_page: int,
+            term_rate: float,
+            error_rate: float,
+            seed: int,
+    ):
+        rng = random.Random(f'{seed}:{name}')
+        self.name = name
+        self.words = []
+        self.lemmas = []
+        self.starts = []
+        self.structs = []
+
+        for n in range(pages):
+            self.starts.append(len(self.words))
+            title, publ_type = rng.choice(PUBLICATIONS)
+            binding_id = rng.randint(100_000, 999_999)
+            day, month = rng.randint(1, 28), rng.randint(1, 12)
+            self.structs.append({
+                'text_binding_id': str(binding_id),
+                'text_issue_date': f'{day:02}.{month:02}.{year}',
+                'text_issue_no': str(rng.randint(1, 52)),
+                'text_page_no': str(rng.randint(1, 8)),
+                'text_publ_title': title,
+                'text_publ_type': publ_type,
+            })
+            for _ in range(words_per_page):
+                if rng.random() < term_rate:
+                    lemma = rng.choice(terms)
+                    word = lemma + rng.choice(SUFFIXES)
+                else:
+                    word = lemma = ''.join(
+                        rng.choices(SYLLABLES, k=rng.randint(1, 4))
+                    )
+                word = ''.join(
+                    CONFUSIONS.get(c, c) if rng.random() < error_rate else c
+                    for c in word
+                )
+                self.words.append(word)
+                self.lemmas.append(lemma)
+
+        self.positions = {'word': {}, 'lemma': {}}
+        for attr, tokens in (('word', self.words), ('lemma', self.lemmas)):
+            for i, token in enumerate(tokens):
+                self.positions[attr].setdefault(token, []).append(i)
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+    def find(self, conditions: tuple) -> list:
+        """
+        Positions of tokens matching any of the (attribute, regex)
+        conditions, in corpus order.
+        """
+        found = set()
+        for attr, value in conditions:
+            found.update(self._find(attr, value))
+        return sorted(found)
+
+    @lru_cache(maxsize=4096)
+    def _find(self, attr: str, value: str) -> tuple:
+        try:
+            regex = re.compile(value)
+        except re.error:
+            return ()
+        return tuple(
+            i
+            for token, positions in self.positions[attr].items()
+            if regex.fullmatch(token)
+            for i in positions
+        )
+
+    def hit(self, position: int, context: int) -> dict:
+        page = bisect_right(self.starts, position) - 1
+        first = self.starts[page]
+        last = len(self.words)
+        if page + 1 < len(self.starts):
+            last = self.starts[page + 1]
+        start = max(first, position - context)
+        end = min(last, position + context + 1)
+
+        return {
+            'corpus': self.name,
+            'match': {'start': position - start, 'end': position - start + 1},
+            'structs': self.structs[page],
+            'tokens': [
+                {'word': self.words[i], 'lemma': self.lemmas[i]}
+                for i in range(start, end)
+            ],
+        }
+
+
+def parse_cqp(cqp: str) -> tuple:
+    return tuple(
+        (attr, value.replace('\\"', '"'))
+        for attr, value in CONDITION.findall(cqp)
+    )
+
+
+class MockKorp:
+    """
+    Answers the query, count and info commands of the Korp API from
+    synthetic corpora, in the shapes api_query parses.
+    """
+
+    def __init__(self, corpora: dict, context: int = 20):
+        self.corpora = corpora
+        self.context = context
+
+    def _selected(self, params: dict) -> list:
+        names = sorted({
+            c.strip().upper() for c in params.get('corpus', '').split(',')
+            if c.strip()
+        })
+        return [self.corpora[name] for name in names if name in self.corpora]
+
+    def info(self, params: dict) -> dict:
+        selected = self._selected(params)
+        return {
+            'corpora': {
+                c.name: {
+                    'attrs': {'p': ['word', 'lemma'], 's': STRUCTS},
+                    'info': {'Size': str(len(c))},
+                }
+                for c in selected
+            },
+            'total_size': sum(len(c) for c in selected),
+        }
+
+    def query(self, params: dict) -> dict:
+        conditions = parse_cqp(params.get('cqp', ''))
+        start = int(params.get('start', 0))
+        end = int(params.get('end', 25))
+        selected = self._selected(params)
+        found = {c.name: c.find(conditions) for c in selected}
+
+        # end is inclusive, as in Korp
+        kwic = []
+        offset = 0
+        for c in selected:
+            positions = found[c.name]
+            first = max(start - offset, 0)
+            last = max(end + 1 - offset, 0)
+            for position in positions[first:last]:
+                kwic.append(c.hit(position, self.context))
+            offset += len(positions)
+
+        return {
+            'hits': offset,
+            'corpus_hits': {
+                name: len(positions) for name, positions in found.items()
+            },
+            'corpus_order': [c.name for c in selected],
+            'kwic': kwic,
+        }
+
+    def count(self, params: dict) -> dict:
+        queries = [params.get('cqp', '')]
+        i = 0
+        while f'subcqp{i}' in params:
+            queries.append(params[f'subcqp{i}'])
+            i += 1
+
+        def sums(corpus, cqp):
+            n = len(corpus.find(parse_cqp(cqp)))
+            relative = n / len(corpus) * 1e6 if len(corpus) else 0.0
+            return {'absolute': n, 'relative': relative}
+
+        corpora = {}
+        for c in self._selected(params):
+            results = [{'sums': sums(c, cqp), 'rows': []} for cqp in queries]
+            for cqp, result in zip(queries[1:], results[1:]):
+                result['cqp'] = cqp
+            corpora[c.name] = results if len(queries) > 1 else results[0]
+
+        return {'corpora': corpora}
+
+    def respond(self, params: dict) -> dict:
+        command = params.get('command', '')
+        if command not in ('info', 'query', 'count'):
+            raise ValueError(f'Unknown command {command}')
+        return getattr(self, command)(params)
+
+
+def make_handler(
+        korp: MockKorp,
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        drop_rate: float = 0.0,
+        seed: int = 0,
+):
+    rng = random.Random(seed)
+    lock = threading.Lock()
+    logger = logging.getLogger(__name__)
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            params = dict(parse_qsl(url.query))
+            if url.path.strip('/'):
+                # newer Korp versions take the command from the path
+                params.setdefault('command', url.path.strip('/'))
+
+            with lock:
+                delay = latency * rng.uniform(0.5, 1.5)
+                draw = rng.random()
+            time.sleep(delay)
+
+            if draw < drop_rate:
+                # the client sees a dropped connection
+                self.connection.shutdown(socket.SHUT_RDWR)
+                self.close_connection = True
+                return
+            if draw < drop_rate + error_rate:
+                self.send_error(503, 'Service Unavailable')
+                return
+
+            try:
+                body = json.dumps(korp.respond(params)).encode('utf-8')
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+
+def make_corpora(
+        terms: list,
+        first_year: int,
+        last_year: int,
+        pages: int = 200,
+        words_per_page: int = 500,
+        term_rate: float = 0.02,
+        error_rate: float = 0.05,
+        seed: int = 0,
+) -> dict:
+    return {
+        f'KLK_FI_{year}': SyntheticCorpus(
+            f'KLK_FI_{year}', year, terms, pages, words_per_page, term_rate,
+            error_rate, seed,
+        )
+        for year in range(first_year, last_year + 1)
+    }
+
+
+def make_server(
+        korp: MockKorp,
+        host: str = '127.0.0.1',
+        port: int = 0,
+        **handler_args,
+) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(
+        (host, port), make_handler(korp, **handler_args),
+    )
+    server.daemon_threads = True
+    return server
+
+
+def start_server(
+        korp: MockKorp,
+        host: str = '127.0.0.1',
+        port: int = 0,
+        **handler_args,
+) -> ThreadingHTTPServer:
+    """
+    Serves in a daemon thread and returns the server, its url is
+    http://<host>:<server.server_port>/. Stop it with server.shutdown().
+    """
+    server = make_server(korp, host, port, **handler_args)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@click.command()
+@click.option(
+    '--host', type=click.STRING, default='127.0.0.1',
+    help='address to listen on',
+)
+@click.option('--port', type=click.INT, default=8080, help='port to listen on')
+@click.option(
+    '--wordlist', type=click.Path(exists=True),
+    default='wordlists/wordlist_fi_newspapers.csv',
+    help='word list whose terms appear in the corpus',
+)
+@click.option(
+    '--first-year', type=click.INT, default=1850, help='first yearly corpus',
+)
+@click.option(
+    '--last-year', type=click.INT, default=1860, help='last yearly corpus',
+)
+@click.option(
+    '--pages', type=click.IntRange(1, None), default=200,
+    help='pages in each yearly corpus',
+)
+@click.option(
+    '--words', type=click.IntRange(1, None), default=500,
+    help='words on each page',
+)
+@click.option(
+    '--term-rate', type=click.FloatRange(0, 1), default=0.02,
+    help='share of words that are word list terms',
+)
+@click.option(
+    '--context', type=click.IntRange(0, None), default=20,
+    help='tokens of context on both sides of a hit, sets the payload size',
+)
+@click.option(
+    '--latency', type=click.FloatRange(0, None), default=0.0,
+    help='mean seconds before each response',
+)
+@click.option(
+    '--error-rate', type=click.FloatRange(0, 1), default=0.0,
+    help='share of requests answered with 503',
+)
+@click.option(
+    '--drop-rate', type=click.FloatRange(0, 1), default=0.0,
+    help='share of connections closed without a response',
+)
+@click.option(
+    '--seed', type=click.INT, default=0,
+    help='random seed of the corpus and the failures',
+)
+def main(
+    host,
+    port,
+    wordlist,
+    first_year,
+    last_year,
+    pages,
+    words,
+    term_rate,
+    context,
+    latency,
+    error_rate,
+    drop_rate,
+    seed,
+    ):
+    """
+    Serves a local mock of the Korp API for testing and benchmarking
+    api_query offline
+    """
+    logger = logging.getLogger(__name__)
+    terms = [w.replace(' ', '') for w in read_word_list(Path(wordlist))]
+
+    logger.info(f'Generating corpora {first_year}-{last_year}')
+    corpora = make_corpora(
+        terms, first_year, last_year, pages, words, term_rate, seed=seed,
+    )
+    korp = MockKorp(corpora, context)
+
+    server = make_server(
+        korp, host, port, latency=latency, error_rate=error_rate,
+        drop_rate=drop_rate, seed=seed,
+    )
+    logger.info(f'Serving mock Korp on http://{host}:{server.server_port}/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    log_file = Path('./logs') / Path(__file__).stem
+    logging.basicConfig(filename=log_file, level=logging.INFO, format=log_fmt)
+
+    main()
@@ -0,0 +1,278 @@
+import logging
+import re
+from collections import Counter
+from itertools import product
+from pathlib import Path
+from typing import Mapping, Optional
+
+import pandas as pd
+import click
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
+
+from corpus_manifest import CorpusManifest
+from term_counter import TermCounter, WORD_RE, scan_vocabulary
+from utils import read_word_list, text_file_paths
+
+MAX_VARIANTS = 20_000
+MAX_RANGE = 32
+_RUNS = re.compile(r'(\w)\1+')
+# marks a run of two or more of the preceding character
+RUN_MARK = ':'
+
+
+def normalize(token: str) -> str:
+    """
+    Canonical form of a token: case folded, with every run of a repeated
+    character shortened to the character and a run mark, so 'Aiheuttaa' and
+    'aiheutttaaa' are the same but 'aiheutaa' is not.
+    """
+    return _RUNS.sub(r'\1' + RUN_MARK, token.casefold())
+
+
+class NotExpandable(ValueError):
+    pass
+
+
+def _product(parts: list) -> set:
+    size = 1
+    for part in parts:
+        size *= len(part)
+    if size > MAX_VARIANTS:
+        raise NotExpandable(f'more than {MAX_VARIANTS} variants')
+    return {''.join(p) for p in product(*parts)}
+
+
+def _expand(parsed) -> set:
+    parts = []
+
+    for op, av in parsed:
+        if op == sre_constants.LITERAL:
+            parts.append({chr(av)})
+        elif op == sre_constants.IN:
+            chars = set()
+            for item_op, item_av in av:
+                if item_op == sre_constants.LITERAL:
+                    chars.add(chr(item_av))
+                elif (
+                        item_op == sre_constants.RANGE
+                        and item_av[1] - item_av[0] < MAX_RANGE
+                ):
+                    first, last = item_av
+                    chars.update(chr(c) for c in range(first, last + 1))
+                else:
+                    raise NotExpandable(f'character class {item_op}')
+            parts.append(chars)
+        elif op == sre_constants.SUBPATTERN:
+            parts.append(_expand(av[-1]))
+        elif op == sre_constants.BRANCH:
+            parts.append(set().union(*(_expand(branch) for branch in av[1])))
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            low, high, sub = av
+            once = _expand(sub)
+            # normalize does not tell runs longer than two apart, so an
+            # unbounded repeat needs at most one more than its minimum
+            if high == sre_constants.MAXREPEAT:
+                high = max(low, 1) + 1
+            variants = set()
+            for n in range(low, high + 1):
+                variants |= _product([once] * n)
+            parts.append(variants)
+        elif op == sre_constants.AT:
+            # lookups ignore the neighbours of a match, so anchors are
+            # left to the regex
+            raise NotExpandable('anchor')
+        else:
+            raise NotExpandable(f'operator {op}')
+
+    return _product(parts)
+
+
+def expand_pattern(regex: re.Pattern) -> Optional[set]:
+    """
+    Normalized forms of all strings a token pattern matches, or None if the
+    pattern has wildcards, anchors, negated classes or too many variants.
+    """
+    try:
+        variants = _expand(sre_parse.parse(regex.pattern, regex.flags))
+    except (NotExpandable, re.error, TypeError, OverflowError):
+        return None
+
+    variants = {normalize(v) for v in variants}
+    if '' in variants:
+        return None
+
+    return variants
+
+
+class VariantCounter(TermCounter):
+    """
+    TermCounter that matches token patterns by dictionary lookup.
+
+    The spelling variants of every expandable token pattern are listed once
+    and normalized. Each distinct normalized token is then matched by looking
+    up its substrings, leftmost first and without overlaps as in findall, so
+    the cost depends on the vocabulary and not on the number of terms.
+    Shortening runs of repeated characters makes the counts approximate;
+    other patterns are counted as in TermCounter.
+    """
+
+    def __init__(
+            self,
+            regex: Mapping[str, re.Pattern],
+            max_cache_size: int = 5_000_000,
+    ):
+        super().__init__(regex, max_cache_size)
+        self.variants = {}
+        self.scanned_patterns = []
+
+        for term, r in self.token_patterns:
+            variants = expand_pattern(r)
+            if variants is None:
+                self.scanned_patterns.append((term, r))
+                continue
+            for variant in variants:
+                self.variants.setdefault(variant, []).append(term)
+
+        self._prefixes = {
+            v[:end] for v in self.variants for end in range(1, len(v) + 1)
+        }
+        self._normalized = {}
+
+    def _matches(self, text: str, start: int) -> list:
+        # variants that text[start:] starts with, walking the prefix set
+        found = []
+        for end in range(start + 1, len(text) + 1):
+            prefix = text[start:end]
+            if prefix not in self._prefixes:
+                break
+            if prefix in self.variants:
+                found.append((end - start, prefix))
+        return found
+
+    def _lookup(self, token: str) -> tuple:
+        hits = Counter()
+        free = {}
+
+        for i, char in enumerate(token):
+            if char == RUN_MARK:
+                continue
+            found = self._matches(token, i)
+            if token[i + 1:i + 2] == RUN_MARK:
+                # a match can also start at the last character of a run
+                found += [
+                    (size + 1, v)
+                    for size, v in self._matches(char + token[i + 2:], 0)
+                ]
+            if not found:
+                continue
+            # the longest match at a position wins, as with greedy repeats
+            for size, variant in sorted(found, reverse=True):
+                for term in self.variants[variant]:
+                    if free.get(term, 0) <= i:
+                        hits[term] += 1
+                        free[term] = i + size
+
+        return tuple(hits.items())
+
+    def _learn(self, tokens: list) -> None:
+        hits = [[] for _ in tokens]
+
+        scanned = scan_vocabulary(
+            tokens, dict(self.scanned_patterns), self.timings
+        )
+        for term, found in scanned.items():
+            for i, spans in found.items():
+                hits[i].append((term, len(spans)))
+
+        for token, token_hits in zip(tokens, hits):
+            key = normalize(token)
+            if key not in self._normalized:
+                self._normalized[key] = self._lookup(key)
+            self._cache[token] = tuple(token_hits) + self._normalized[key]
+
+        if len(self._normalized) > self.max_cache_size:
+            self._normalized.clear()
+
+
+def compare_counts(
+        paths: list,
+        regex: Mapping[str, re.Pattern],
+) -> pd.DataFrame:
+    """
+    Term counts of the regex and the lookup paths side by side, for
+    validating the normalized matching on part of a corpus.
+    """
+    exact = TermCounter(regex)
+    approximate = VariantCounter(regex)
+    rows = {term: [0, 0] for term in regex}
+
+    for path in paths:
+        tokens = Counter(WORD_RE.findall(path.read_text()))
+        for term, n in exact.count_tokens(tokens).items():
+            rows[term][0] += n
+        for term, n in approximate.count_tokens(tokens).items():
+            rows[term][1] += n
+
+    data = pd.DataFrame.from_dict(
+        rows, orient='index', columns=['regex', 'normalized'],
+    )
+    scanned = dict(approximate.scanned_patterns)
+    data['lookup'] = [term not in scanned for term in data.index]
+    data = data[[t in dict(exact.token_patterns) for t in data.index]]
+    data['difference'] = data['normalized'] - data['regex']
+
+    return data
+
+
+@click.command()
+@click.argument('input_filepath', type=click.Path(exists=True))
+@click.argument('wordlist_filepath', type=click.Path(exists=True))
+@click.argument('output_filepath', type=click.Path())
+@click.option(
+    '--files', type=click.STRING, default='*.txt',
+    help='rule to select suitable files',
+)
+@click.option(
+    '--manifest', type=click.Path(),
+    help='corpus manifest file, default is inside input directory',
+)
+def main(
+    input_filepath,
+    wordlist_filepath,
+    output_filepath,
+    files,
+    manifest,
+    ):
+    """
+    Compares regex and normalized lookup counts of the token terms of a word
+    list and saves them in a csv file
+    """
+    logger = logging.getLogger(__name__)
+    input_fp = Path(input_filepath)
+    words = read_word_list(Path(wordlist_filepath))
+    manifest = CorpusManifest.load(input_fp, manifest)
+    regex = {w: re.compile(r, flags=re.IGNORECASE) for w, r in words.items()}
+
+    paths = [
+        path for path, _ in text_file_paths(input_fp, files, manifest=manifest)
+    ]
+    logger.info(f'Comparing {len(regex)} patterns on {len(paths)} files')
+    data = compare_counts(paths, regex)
+
+    differing = data[data['difference'] != 0]
+    logger.info(f'{len(differing)} of {len(data)} token terms differ')
+    data.to_csv(output_filepath)
+    logger.info(f'Saving comparison to file {output_filepath}')
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    log_file = Path('./logs') / Path(__file__).stem
+    logging.basicConfig(filename=log_file, level=logging.INFO, format=log_fmt)
+
+    main()
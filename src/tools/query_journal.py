@@ -0,0 +1,104 @@
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+from typing import Optional, Union
+
+import pandas as pd
+
+JOURNAL_NAME = '.api_query_journal.sqlite'
+
+
+def settings_key(**settings) -> str:
+    source = json.dumps(settings, sort_keys=True, default=str)
+    return hashlib.blake2b(source.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def _series_to_json(series: pd.Series) -> str:
+    return json.dumps(
+        {str(k): (None if pd.isna(v) else v) for k, v in series.items()},
+        default=int,
+    )
+
+
+def _series_from_json(text: str) -> pd.Series:
+    return pd.Series({int(k): v for k, v in json.loads(text).items()})
+
+
+class QueryJournal:
+    """
+    Durable record of the words a query run has finished, with their yearly
+    lemma and regex hits and the kwic file written for them.
+
+    Entries belong to the run settings they were made with, a run with other
+    settings starts from scratch. Every word is committed as soon as it is
+    done, so an interrupted run loses at most the word in progress.
+    """
+
+    def __init__(self, path: Union[Path, str], key: str):
+        self.path = Path(path)
+        self.key = key
+        self.connection = sqlite3.connect(str(self.path))
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS words (
+                word TEXT PRIMARY KEY,
+                settings TEXT,
+                lemma TEXT,
+                regex TEXT,
+                kwic_file TEXT,
+                finished REAL
+            );
+            """
+        )
+        self.connection.execute(
+            "DELETE FROM words WHERE settings != ?", (key,)
+        )
+        self.connection.commit()
+
+    def completed(self) -> dict:
+        """
+        {word: (freq_lemma, freq_regex)} of the finished words.
+        """
+        rows = self.connection.execute(
+            "SELECT word, lemma, regex FROM words WHERE settings = ?",
+            (self.key,),
+        )
+        return {
+            word: (_series_from_json(lemma), _series_from_json(regex))
+            for word, lemma, regex in rows
+        }
+
+    def add(
+            self,
+            word: str,
+            freq_lemma: pd.Series,
+            freq_regex: pd.Series,
+            kwic_file: Optional[Path] = None,
+    ) -> None:
+        self.connection.execute(
+            "INSERT OR REPLACE INTO words "
+            "(word, settings, lemma, regex, kwic_file, finished) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                word,
+                self.key,
+                _series_to_json(freq_lemma),
+                _series_to_json(freq_regex),
+                str(kwic_file) if kwic_file is not None else None,
+                time.time(),
+            ),
+        )
+        self.connection.commit()
+
+    def delete(self) -> None:
+        """
+        Closes the journal and removes its file, once the run is complete.
+        """
+        self.close()
+        self.path.unlink(missing_ok=True)
+
+    def close(self) -> None:
+        self.connection.commit()
+        self.connection.close()
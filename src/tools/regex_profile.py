@@ -0,0 +1,274 @@
+import logging
+import math
+import random
+import re
+import time
+from pathlib import Path
+
+import pandas as pd
+import click
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
+
+from corpus_manifest import CorpusManifest
+from term_counter import is_token_pattern
+from utils import read_word_list, text_file_paths
+
+MAX_PROBE_LENGTH = 4096
+MAX_PROBE_SECONDS = 0.05
+MIN_PROBE_SECONDS = 0.0005
+# Scan time growing faster than length ** ORDER_LIMIT on the probes is taken
+# as super-linear backtracking.
+ORDER_LIMIT = 1.5
+
+_REPEATS = {
+    sre_constants.MAX_REPEAT,
+    sre_constants.MIN_REPEAT,
+    getattr(sre_constants, 'POSSESSIVE_REPEAT', sre_constants.MAX_REPEAT),
+}
+
+
+def _subpatterns(av) -> list:
+    """
+    Child pattern lists of one parse tree node.
+    """
+    if isinstance(av, sre_parse.SubPattern):
+        return [av]
+    if isinstance(av, (tuple, list)):
+        return [p for item in av for p in _subpatterns(item)]
+    return []
+
+
+def nested_repeats(parsed, inside: bool = False) -> int:
+    """
+    Number of unbounded repeats nested inside another repeat, e.g. (a+|o+)+,
+    the usual cause of catastrophic backtracking.
+    """
+    found = 0
+
+    for op, av in parsed:
+        if op in _REPEATS:
+            unbounded = av[1] == sre_constants.MAXREPEAT
+            if unbounded and inside:
+                found += 1
+            found += nested_repeats(av[2], inside or unbounded)
+        else:
+            for sub in _subpatterns(av):
+                found += nested_repeats(sub, inside)
+
+    return found
+
+
+def literal_chars(parsed) -> str:
+    """
+    Characters the pattern can match literally, used to build probe strings.
+    """
+    chars = []
+
+    for op, av in parsed:
+        if op == sre_constants.LITERAL:
+            chars.append(chr(av))
+        elif op == sre_constants.IN:
+            for item_op, item_av in av:
+                if item_op == sre_constants.LITERAL:
+                    chars.append(chr(item_av))
+                elif item_op == sre_constants.RANGE:
+                    chars.append(chr(item_av[0]))
+        else:
+            for sub in _subpatterns(av):
+                chars.append(literal_chars(sub))
+
+    return ''.join(dict.fromkeys(''.join(chars)))
+
+
+def _scan_time(regex: re.Pattern, text: str, repeat: int = 3) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in regex.finditer(text):
+            pass
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def _probe_order(regex: re.Pattern, unit: str) -> float:
+    # Lengths grow one character at a time at first so that an exponential
+    # pattern is caught before a single probe takes long.
+    timed = []
+    n = 8
+    while n <= MAX_PROBE_LENGTH:
+        seconds = _scan_time(regex, (unit * n)[:n] + '\x00')
+        if seconds >= MIN_PROBE_SECONDS:
+            timed.append((n, seconds))
+        if seconds > MAX_PROBE_SECONDS:
+            break
+        n = n + 1 if n < 64 else int(n * 1.25)
+
+    # too short a range of measurable lengths is only noise
+    if len(timed) < 2 or timed[-1][0] < 1.5 * timed[0][0]:
+        return 0.0
+
+    (n1, t1), (n2, t2) = timed[0], timed[-1]
+    return math.log(t2 / t1) / math.log(n2 / n1)
+
+
+def probe_order(regex: re.Pattern) -> float:
+    """
+    Empirical order of scan time in input length on probe strings made of
+    the pattern's own characters, e.g. runs of one letter for (a+|o+)+, and
+    ending in a character it cannot match. Linear patterns stay near 1, 0
+    means the probes were too fast to measure.
+    """
+    chars = literal_chars(sre_parse.parse(regex.pattern, regex.flags)) or 'a'
+    return max(_probe_order(regex, unit) for unit in [chars, *chars])
+
+
+def sample_texts(
+        data_path: Path,
+        rule: str,
+        sample_size: int,
+        sample_chars: int,
+        seed: int,
+        manifest: CorpusManifest = None,
+) -> list:
+    paths = [
+        path for path, _ in text_file_paths(data_path, rule, manifest=manifest)
+    ]
+    paths = random.Random(seed).sample(paths, min(sample_size, len(paths)))
+    texts = []
+
+    for path in paths:
+        with open(path) as fopen:
+            texts.append(fopen.read(sample_chars))
+
+    return texts
+
+
+def profile_patterns(words: dict, texts: list) -> pd.DataFrame:
+    """
+    Compile and scan time, throughput, match count and backtracking flags of
+    every pattern of a word list, backtracking ones and then the most
+    expensive first.
+    """
+    megabytes = sum(len(text.encode('utf-8')) for text in texts) / 1e6
+    rows = []
+
+    for term, regexpr in words.items():
+        started = time.perf_counter()
+        re.purge()
+        regex = re.compile(regexpr, flags=re.IGNORECASE)
+        compile_ms = (time.perf_counter() - started) * 1000
+
+        nested = nested_repeats(sre_parse.parse(regex.pattern, regex.flags))
+        order = probe_order(regex)
+        backtracking = order > ORDER_LIMIT
+
+        # a backtracking pattern can take hours on a real text, it is not
+        # scanned
+        scan = float('nan')
+        matches = None
+        if not backtracking:
+            scan = 0.0
+            matches = 0
+            for text in texts:
+                started = time.perf_counter()
+                matches += len(regex.findall(text))
+                scan += time.perf_counter() - started
+
+        rows.append({
+            'term': term,
+            'regex': regexpr,
+            'compile_ms': compile_ms,
+            'scan_ms': scan * 1000,
+            'ms_per_mb': scan * 1000 / megabytes if megabytes else 0.0,
+            'matches': matches,
+            'token_pattern': is_token_pattern(regex),
+            'nested_repeats': nested,
+            'probe_order': order,
+            'backtracking': backtracking,
+        })
+
+    report = pd.DataFrame(rows)
+    if not report.empty:
+        report.sort_values(
+            by=['backtracking', 'scan_ms'], ascending=False, inplace=True,
+        )
+
+    return report
+
+
+@click.command()
+@click.argument('input_filepath', type=click.Path(exists=True))
+@click.argument('wordlist_filepath', type=click.Path(exists=True))
+@click.argument('output_filepath', type=click.Path())
+@click.option(
+    '--files', type=click.STRING, default='*.txt',
+    help='rule to select suitable files',
+)
+@click.option(
+    '--manifest', type=click.Path(),
+    help='corpus manifest file, default is inside input directory',
+)
+@click.option(
+    '--sample_size', type=click.IntRange(1, None), default=20,
+    help='number of files sampled',
+)
+@click.option(
+    '--sample_chars', type=click.IntRange(1, None), default=1_000_000,
+    help='characters read from each file',
+)
+@click.option(
+    '--seed', type=click.INT, default=0,
+    help='random seed of the file sample',
+)
+def main(
+    input_filepath,
+    wordlist_filepath,
+    output_filepath,
+    files,
+    manifest,
+    sample_size,
+    sample_chars,
+    seed,
+    ):
+    """
+    Times the patterns of a word list on a sample of the corpus and saves a
+    per-term cost report
+    """
+    logger = logging.getLogger(__name__)
+    input_fp = Path(input_filepath)
+    words = read_word_list(Path(wordlist_filepath))
+    manifest = CorpusManifest.load(input_fp, manifest)
+
+    texts = sample_texts(
+        input_fp, files, sample_size, sample_chars, seed, manifest=manifest,
+    )
+    logger.info(f'Profiling {len(words)} patterns on {len(texts)} files')
+    report = profile_patterns(words, texts)
+
+    for row in report.itertuples():
+        if row.backtracking:
+            logger.warning(
+                f'Pattern of {row.term} backtracks, time grows as '
+                f'length ** {row.probe_order:.1f}: {row.regex}'
+            )
+        elif row.nested_repeats:
+            logger.info(
+                f'Pattern of {row.term} has {row.nested_repeats} nested '
+                f'repeats: {row.regex}'
+            )
+
+    report.to_csv(output_filepath, index=False)
+    logger.info(f'Saving report to file {output_filepath}')
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    log_file = Path('./logs') / Path(__file__).stem
+    logging.basicConfig(filename=log_file, level=logging.INFO, format=log_fmt)
+
+    main()
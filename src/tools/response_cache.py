@@ -0,0 +1,180 @@
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import time
+import zlib
+from pathlib import Path
+from typing import Mapping, Optional, Union
+
+from transport import dumps, loads
+
+CACHE_NAME = '.korp_cache.sqlite'
+# parameters that decide the response together with the sub queries of count
+# requests, others (e.g. a cache buster) are ignored
+KEY_PARAMS = [
+    'command', 'cqp', 'corpus', 'start', 'end', 'show_struct', 'group_by',
+    'group_by_struct',
+]
+LIST_PARAMS = {'corpus', 'show_struct', 'group_by', 'group_by_struct'}
+SUB_QUERY = re.compile(r'subcqp\d+')
+
+
+def normalize_params(query_params: Mapping) -> dict:
+    """
+    Request parameters in a canonical form: list parameters split, stripped
+    and sorted, the rest as stripped strings.
+    """
+    normalized = {}
+
+    names = KEY_PARAMS + sorted(
+        name for name in query_params if SUB_QUERY.fullmatch(name)
+    )
+
+    for name in names:
+        value = query_params.get(name)
+        if value is None:
+            continue
+        if name in LIST_PARAMS:
+            items = {
+                item.strip() for item in str(value).split(',')
+                if item.strip()
+            }
+            if name == 'corpus':
+                items = {item.upper() for item in items}
+            normalized[name] = ','.join(sorted(items))
+        else:
+            normalized[name] = str(value).strip()
+
+    return normalized
+
+
+def request_key(url: str, query_params: Mapping) -> str:
+    source = json.dumps(
+        [url.rstrip('/'), normalize_params(query_params)], sort_keys=True,
+    )
+    return hashlib.blake2b(source.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class ResponseCache:
+    """
+    Persistent Korp responses, keyed by the server url and the normalized
+    query parameters.
+
+    Responses older than max_age_days are not used. With refresh nothing is
+    read from the cache but new responses are still stored, replacing the
+    old ones. Bodies are stored compressed.
+    """
+
+    def __init__(
+            self,
+            path: Union[Path, str],
+            max_age_days: Optional[float] = 30,
+            refresh: bool = False,
+    ):
+        self.path = Path(path)
+        self.max_age_days = max_age_days
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(str(self.path))
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                params TEXT,
+                body BLOB,
+                size INTEGER,
+                created REAL,
+                last_used REAL
+            );
+            """
+        )
+
+    def _cutoff(self) -> float:
+        if self.max_age_days is None:
+            return float('-inf')
+        return time.time() - self.max_age_days * 86_400
+
+    def get(self, url: str, query_params: Mapping) -> Optional[dict]:
+        if self.refresh:
+            self.misses += 1
+            return None
+
+        key = request_key(url, query_params)
+        row = self.connection.execute(
+            "SELECT body FROM responses WHERE key = ? AND created >= ?",
+            (key, self._cutoff()),
+        ).fetchone()
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.connection.execute(
+            "UPDATE responses SET last_used = ? WHERE key = ?",
+            (time.time(), key),
+        )
+        self.connection.commit()
+
+        return loads(zlib.decompress(row[0]))
+
+    def put(self, url: str, query_params: Mapping, result: dict) -> None:
+        body = zlib.compress(dumps(result), 1)
+        now = time.time()
+
+        self.connection.execute(
+            "INSERT OR REPLACE INTO responses "
+            "(key, params, body, size, created, last_used) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                request_key(url, query_params),
+                json.dumps(normalize_params(query_params)),
+                body,
+                len(body),
+                now,
+                now,
+            ),
+        )
+        self.connection.commit()
+
+    def evict(self, max_megabytes: Optional[float] = None) -> int:
+        """
+        Drops responses older than max_age_days, then the least recently used
+        ones until the stored bodies take at most max_megabytes.
+        """
+        cursor = self.connection.cursor()
+        cursor.execute(
+            "DELETE FROM responses WHERE created < ?", (self._cutoff(),)
+        )
+        evicted = cursor.rowcount
+
+        if max_megabytes is not None:
+            limit = max_megabytes * 1e6
+            total = cursor.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()[0]
+            drop = []
+            oldest_first = cursor.execute(
+                "SELECT key, size FROM responses ORDER BY last_used"
+            ).fetchall()
+            for key, size in oldest_first:
+                if total <= limit:
+                    break
+                drop.append((key,))
+                total -= size
+            cursor.executemany("DELETE FROM responses WHERE key = ?", drop)
+            evicted += len(drop)
+
+        self.connection.commit()
+
+        if evicted:
+            logging.info(f'Evicted {evicted} responses from {self.path}')
+
+        return evicted
+
+    def close(self) -> None:
+        self.connection.commit()
+        self.connection.close()
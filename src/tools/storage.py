@@ -0,0 +1,65 @@
+from pathlib import Path
+from typing import Union
+
+import pandas as pd
+
+FORMATS = {
+    'csv': '.csv',
+    'parquet': '.parquet',
+    'feather': '.feather',
+}
+COMPRESSION = 'zstd'
+
+
+def save_frame(
+        data: pd.DataFrame,
+        path: Union[Path, str],
+        fmt: str = 'csv',
+) -> Path:
+    """
+    Saves a data frame with its index. The suffix of path is replaced with the
+    one of the format. Parquet and Feather need pyarrow.
+    """
+    path = Path(path).with_suffix(FORMATS[fmt])
+
+    if fmt == 'csv':
+        data.to_csv(path)
+    elif fmt == 'parquet':
+        data.to_parquet(path, compression=COMPRESSION, index=True)
+    elif fmt == 'feather':
+        # feather cannot store an index, it is kept as the first column
+        data.reset_index().to_feather(path, compression=COMPRESSION)
+
+    return path
+
+
+def load_frame(path: Union[Path, str], index: bool = True) -> pd.DataFrame:
+    """
+    Reads a data frame saved by save_frame, the format is taken from the
+    suffix. If there is no such file, the same name in the other formats is
+    tried, so readers need not know the format the table was saved in. Without
+    index the saved index is left as the first column, as pd.read_csv(path)
+    leaves it.
+    """
+    path = Path(path)
+
+    if not path.is_file():
+        for suffix in FORMATS.values():
+            if path.with_suffix(suffix).is_file():
+                path = path.with_suffix(suffix)
+                break
+
+    if path.suffix == FORMATS['parquet']:
+        data = pd.read_parquet(path)
+        return data if index else data.reset_index()
+
+    if path.suffix == FORMATS['feather']:
+        data = pd.read_feather(path)
+        if not index:
+            return data
+        data = data.set_index(data.columns[0])
+        if data.index.name == 'index':
+            data.index.name = None
+        return data
+
+    return pd.read_csv(path, index_col=0 if index else None)
@@ -0,0 +1,389 @@
+import re
+import time
+from bisect import bisect_right
+from collections import Counter
+from pathlib import Path
+from typing import Collection, Mapping, Optional
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
+
+from utils import CHUNK_SIZE, scan_chunks
+
+WORD_RE = re.compile(r'\w+')
+MARGIN = 4096
+
+_WORD_CATEGORIES = {
+    sre_constants.CATEGORY_WORD,
+    sre_constants.CATEGORY_DIGIT,
+}
+_REPEATS = {
+    sre_constants.MAX_REPEAT,
+    sre_constants.MIN_REPEAT,
+    getattr(sre_constants, 'POSSESSIVE_REPEAT', sre_constants.MAX_REPEAT),
+}
+
+
+def _is_word_char(code: int) -> bool:
+    return WORD_RE.fullmatch(chr(code)) is not None
+
+
+def _only_word_chars(parsed) -> bool:
+    for op, av in parsed:
+        if op == sre_constants.LITERAL:
+            if not _is_word_char(av):
+                return False
+        elif op == sre_constants.IN:
+            for item_op, item_av in av:
+                if item_op == sre_constants.LITERAL:
+                    if not _is_word_char(item_av):
+                        return False
+                elif item_op == sre_constants.RANGE:
+                    first, last = item_av
+                    if not all(map(_is_word_char, range(first, last + 1))):
+                        return False
+                elif item_op == sre_constants.CATEGORY:
+                    if item_av not in _WORD_CATEGORIES:
+                        return False
+                else:
+                    return False
+        elif op == sre_constants.SUBPATTERN:
+            if not _only_word_chars(av[-1]):
+                return False
+        elif op == sre_constants.BRANCH:
+            if not all(_only_word_chars(branch) for branch in av[1]):
+                return False
+        elif op in _REPEATS:
+            if not _only_word_chars(av[2]):
+                return False
+        elif op == getattr(sre_constants, 'ATOMIC_GROUP', None):
+            if not _only_word_chars(av):
+                return False
+        elif op == sre_constants.AT:
+            if av != sre_constants.AT_BOUNDARY:
+                return False
+        else:
+            return False
+
+    return True
+
+
+def is_token_pattern(regex: re.Pattern) -> bool:
+    """
+    True if every match of the pattern lies inside a single \\w+ token, so it
+    can be counted on the token vocabulary instead of the full text.
+    """
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+    except (re.error, TypeError):
+        return False
+
+    if parsed.getwidth()[0] == 0:
+        return False
+
+    return _only_word_chars(parsed)
+
+
+def _run_element(op, av) -> Optional[list]:
+    """
+    Character codes of a pattern item that matches exactly one character
+    from a fixed set, None for any other item.
+    """
+    if op == sre_constants.LITERAL:
+        return [av]
+    if op == sre_constants.IN:
+        if all(item_op == sre_constants.LITERAL for item_op, _ in av):
+            return [item_av for _, item_av in av]
+        return None
+    if op == sre_constants.SUBPATTERN:
+        _, add_flags, del_flags, p = av
+        if not add_flags and not del_flags and len(p) == 1:
+            return _run_element(*p[0])
+    return None
+
+
+def _required_run(parsed) -> list:
+    """
+    Longest run of single character items that every match of a pattern
+    contains in a row, as a list of character code lists.
+    """
+    best = current = []
+
+    for op, av in parsed:
+        codes = _run_element(op, av)
+        if codes is not None:
+            current = current + [codes]
+            continue
+
+        if op in _REPEATS and av[0] >= 1 and len(av[2]) == 1:
+            codes = _run_element(*av[2][0])
+            if codes is not None:
+                # the last repetition ends a run, the first starts the next
+                best = max(best, current + [codes], key=len)
+                current = [codes]
+                continue
+
+        best = max(best, current, key=len)
+        current = []
+
+    return max(best, current, key=len)
+
+
+def _fold_table(alphabet: str, flags: int) -> dict:
+    """
+    Maps every character of the alphabet to the first alphabet character that
+    matches it under the case flags, so folded text can be searched case
+    sensitively.
+    """
+    table = {}
+    for c in alphabet:
+        if c not in table:
+            for equal in re.findall(re.escape(c), alphabet, flags):
+                table[equal] = c
+    return table
+
+
+def _prefilter(regex: re.Pattern, alphabet: str, table: dict):
+    """
+    A case sensitive pattern for the folded text that matches in every token
+    the pattern matches in, or None if there is no such pattern. False if the
+    pattern cannot match any token made of the alphabet.
+    """
+    try:
+        run = _required_run(sre_parse.parse(regex.pattern, regex.flags))
+    except (re.error, TypeError):
+        return None
+
+    flags = regex.flags & (re.IGNORECASE | re.ASCII)
+    parts = []
+    for codes in run:
+        chars = ''.join(re.escape(chr(code)) for code in codes)
+        found = re.findall(f'[{chars}]', alphabet, flags)
+        folded = sorted({table[c] for c in found})
+        if not folded:
+            return False
+        if len(folded) == 1:
+            parts.append(re.escape(folded[0]))
+        else:
+            parts.append('[' + ''.join(map(re.escape, folded)) + ']')
+
+    # a literal start is searched for much faster than a character set
+    for i, part in enumerate(parts):
+        if not part.startswith('['):
+            parts = parts[i:]
+            break
+
+    if not parts:
+        return None
+
+    return re.compile(''.join(parts))
+
+
+def scan_vocabulary(
+        tokens: list,
+        regex: Mapping[str, re.Pattern],
+        timings: Optional[Counter] = None,
+) -> dict:
+    """
+    Match spans of token patterns in a list of tokens, as
+    {term: {token position: [(start, end), ...]}}. Scan time per term is
+    added to timings if given.
+
+    Case-insensitive scanning cannot skip ahead in the text, so patterns
+    are first searched for a run of characters every match contains, in a
+    case folded copy of the tokens. The patterns themselves are only run
+    over the tokens that contain the run.
+    """
+    starts = []
+    position = 0
+    for token in tokens:
+        starts.append(position)
+        position += len(token) + 1
+
+    # Token patterns cannot match across the newline, so scanning the joined
+    # vocabulary gives the same matches as scanning each token.
+    joined = '\n'.join(tokens)
+    alphabet = ''.join(sorted(set(joined)))
+    folded = {}
+    result = {}
+
+    for term, r in regex.items():
+        started = time.perf_counter()
+        spans = result[term] = {}
+
+        flags = r.flags & (re.IGNORECASE | re.ASCII)
+        if flags not in folded:
+            table = _fold_table(alphabet, flags)
+            folded[flags] = table, joined.translate(
+                {ord(c): ord(f) for c, f in table.items() if c != f}
+            )
+        table, text = folded[flags]
+
+        prefilter = _prefilter(r, alphabet, table)
+        if prefilter is None:
+            candidates = range(len(tokens))
+        elif prefilter is False:
+            candidates = []
+        else:
+            candidates = sorted({
+                bisect_right(starts, m.start()) - 1
+                for m in prefilter.finditer(text)
+            })
+
+        if len(candidates) == len(tokens):
+            scanned, scanned_starts = joined, starts
+        else:
+            scanned = '\n'.join(tokens[i] for i in candidates)
+            scanned_starts = []
+            position = 0
+            for i in candidates:
+                scanned_starts.append(position)
+                position += len(tokens[i]) + 1
+
+        for m in r.finditer(scanned) if candidates else ():
+            j = bisect_right(scanned_starts, m.start()) - 1
+            spans.setdefault(candidates[j], []).append(
+                (m.start() - scanned_starts[j], m.end() - scanned_starts[j])
+            )
+        if timings is not None:
+            timings[term] += time.perf_counter() - started
+
+    return result
+
+
+class TermCounter:
+    """
+    Counts all terms of a wordlist and the \\w+ word total in one pass over
+    a text.
+
+    Patterns that only match inside single tokens are evaluated once per
+    distinct token and the results are remembered across texts. Other patterns
+    (spaces, wildcards etc.) are still run over the full text. The counts are
+    the same as ``len(regex.findall(text))`` for every term.
+    """
+
+    def __init__(
+            self,
+            regex: Mapping[str, re.Pattern],
+            max_cache_size: int = 5_000_000,
+    ):
+        self.terms = list(regex)
+        self.token_patterns = [
+            (term, r) for term, r in regex.items() if is_token_pattern(r)
+        ]
+        self.text_patterns = [
+            (term, r) for term, r in regex.items() if not is_token_pattern(r)
+        ]
+        self.max_cache_size = max_cache_size
+        self.timings = Counter()
+        self.margin = max(
+            [MARGIN] + [
+                width for _, r in self.text_patterns
+                for width in [
+                    sre_parse.parse(r.pattern, r.flags).getwidth()[1]
+                ]
+                if width < sre_constants.MAXREPEAT
+            ]
+        )
+        self._cache = {}
+
+    def _learn(self, tokens: list) -> None:
+        hits = [[] for _ in tokens]
+
+        found_terms = scan_vocabulary(
+            tokens, dict(self.token_patterns), self.timings
+        )
+        for term, found in found_terms.items():
+            for i, spans in found.items():
+                hits[i].append((term, len(spans)))
+
+        for token, token_hits in zip(tokens, hits):
+            self._cache[token] = tuple(token_hits)
+
+    def count_tokens(self, tokens: Counter) -> dict:
+        if len(self._cache) + len(tokens) > self.max_cache_size:
+            self._cache.clear()
+
+        new = [token for token in tokens if token not in self._cache]
+        if new:
+            self._learn(new)
+
+        counts = dict.fromkeys(self.terms, 0)
+        for token, n in tokens.items():
+            for term, hits in self._cache[token]:
+                counts[term] += hits * n
+
+        return counts
+
+    def count(self, text: str) -> dict:
+        tokens = Counter(WORD_RE.findall(text))
+
+        row = {'words': sum(tokens.values())}
+        row.update(self.count_tokens(tokens))
+
+        for term, r in self.text_patterns:
+            started = time.perf_counter()
+            row[term] = len(r.findall(text))
+            self.timings[term] += time.perf_counter() - started
+
+        return row
+
+    def count_path(
+            self,
+            path: Path,
+            chunk_size: int = CHUNK_SIZE,
+            terms: Optional[Collection] = None,
+    ) -> dict:
+        """
+        Same as count(path.read_text()), but reads the file in chunks so that
+        memory use does not depend on file size. Tokens and text pattern
+        matches are assigned to the chunk they start in. Each pattern is
+        searched from where its last counted match ended, so the matches
+        are the same non-overlapping ones as in the whole text.
+
+        With terms only those terms and the word total are counted.
+        """
+        text_patterns = [
+            (term, r) for term, r in self.text_patterns
+            if terms is None or term in terms
+        ]
+        tokens = Counter()
+        text_counts = dict.fromkeys((term for term, _ in text_patterns), 0)
+        # file offset where the search of each pattern continues
+        resume = dict.fromkeys(text_counts, 0)
+
+        chunks = scan_chunks(path, chunk_size, self.margin)
+        for offset, text, begin, end in chunks:
+            # a token crossing a chunk border belongs to the chunk it starts in
+            pos = begin
+            if begin > 0 and WORD_RE.match(text, begin - 1):
+                pos = WORD_RE.match(text, begin - 1).end()
+            stop = end
+            if WORD_RE.match(text, end - 1):
+                stop = WORD_RE.match(text, end - 1).end()
+            tokens.update(WORD_RE.findall(text, pos, max(pos, stop)))
+
+            for term, r in text_patterns:
+                started = time.perf_counter()
+                pos = max(begin, resume[term] - offset)
+                for m in r.finditer(text, pos):
+                    if m.start() >= end:
+                        break
+                    text_counts[term] += 1
+                    resume[term] = offset + m.end()
+                self.timings[term] += time.perf_counter() - started
+
+        row = {'words': sum(tokens.values())}
+        if terms is None:
+            row.update(self.count_tokens(tokens))
+        elif any(term in terms for term, _ in self.token_patterns):
+            row.update(
+                (term, n) for term, n in self.count_tokens(tokens).items()
+                if term in terms
+            )
+        row.update(text_counts)
+
+        return row
@@ -0,0 +1,217 @@
+import json
+import logging
+import random
+import threading
+import time
+from collections import defaultdict
+from typing import Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import (
+    ConnectionError, HTTPError, RequestException, Timeout,
+)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# responses worth another attempt, anything else is returned or raised at once
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def loads(data):
+    """
+    Decodes JSON from bytes or str, with orjson when it is installed.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj) -> bytes:
+    """
+    Encodes JSON as UTF-8 bytes, with orjson when it is installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')
+
+
+class CircuitOpenError(RequestException):
+    """
+    Raised instead of making a request while the host is considered down.
+    """
+    pass
+
+
+class RetryBudget:
+    """
+    Allows retries up to a fraction of all requests made plus a fixed
+    reserve, so that a failing server gets a bounded amount of extra load
+    instead of retries * requests.
+    """
+
+    def __init__(self, ratio: float = 0.2, reserve: int = 10):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.requests = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def request(self) -> None:
+        with self._lock:
+            self.requests += 1
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self.retries >= self.reserve + self.ratio * self.requests:
+                return False
+            self.retries += 1
+            return True
+
+
+class CircuitBreaker:
+    """
+    Opens after max_failures failed requests in a row. While open, requests
+    fail at once with CircuitOpenError. After reset_seconds a single trial
+    request is let through, which closes the circuit if it succeeds and
+    opens it again if not.
+    """
+
+    def __init__(self, max_failures: int = 5, reset_seconds: float = 60):
+        self.max_failures = max_failures
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self._lock = threading.Lock()
+
+    def check(self, host: str) -> None:
+        with self._lock:
+            if self.opened is None:
+                return
+            remaining = self.opened + self.reset_seconds - time.monotonic()
+            if remaining > 0 or self.trial:
+                raise CircuitOpenError(
+                    f'Circuit to {host} is open, '
+                    f'{max(remaining, 0):.1f} s until the next trial'
+                )
+            self.trial = True
+
+    def success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened = None
+            self.trial = False
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.max_failures:
+                self.opened = time.monotonic()
+            self.trial = False
+
+
+class Transport:
+    """
+    HTTP client shared by the downloading and querying scripts.
+
+    Connections are pooled in one requests session. Connection errors,
+    timeouts and overload responses are retried with exponential backoff and
+    full jitter, limited by a retry budget shared by all requests and by a
+    circuit breaker per host. Safe to use from several threads.
+    """
+
+    def __init__(
+            self,
+            headers: Optional[dict] = None,
+            pool_size: int = 10,
+            retries: int = 5,
+            timeout: float = 120,
+            backoff: float = 1.0,
+            max_backoff: float = 60,
+            budget: Optional[RetryBudget] = None,
+            max_failures: int = 5,
+            reset_seconds: float = 60,
+    ):
+        self.session = requests.Session()
+        if headers:
+            self.session.headers.update(headers)
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size,
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.retries = retries
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.budget = budget if budget is not None else RetryBudget()
+        self.breakers = defaultdict(
+            lambda: CircuitBreaker(max_failures, reset_seconds)
+        )
+        self.logger = logging.getLogger(__name__)
+
+    def delay(
+            self,
+            attempt: int,
+            response: Optional[requests.Response] = None,
+    ) -> float:
+        delay = random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** attempt)
+        )
+        retry_after = ''
+        if response is not None:
+            retry_after = response.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            delay = max(delay, min(float(retry_after), self.max_backoff))
+        return delay
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Same as requests.request, with retries. Raises the last error when
+        the retries or the budget run out, HTTPError for error statuses.
+        """
+        host = urlsplit(url).netloc
+        breaker = self.breakers[host]
+        kwargs.setdefault('timeout', self.timeout)
+        self.budget.request()
+
+        for attempt in range(self.retries + 1):
+            breaker.check(host)
+            response = None
+            try:
+                response = self.session.request(method, url, **kwargs)
+                if response.status_code not in RETRY_STATUSES:
+                    breaker.success()
+                    response.raise_for_status()
+                    return response
+                error = HTTPError(
+                    f'{response.status_code} for {response.url}',
+                    response=response,
+                )
+            except (ConnectionError, Timeout) as e:
+                error = e
+
+            breaker.failure()
+            if attempt == self.retries or not self.budget.withdraw():
+                raise error
+            delay = self.delay(attempt, response)
+            self.logger.warning(
+                f'{method} {host} failed ({error}), '
+                f'retrying in {delay:.1f} s'
+            )
+            time.sleep(delay)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def get_json(self, url: str, params: Optional[dict] = None) -> dict:
+        return loads(self.get(url, params=params).content)
+
+    def close(self) -> None:
+        self.session.close()
@@ -1,27 +1,133 @@
+from collections import deque
 from collections.abc import Generator
+from concurrent.futures import Executor
+from itertools import islice
 from pathlib import Path
 import re
 import time
+from typing import Optional, Union
 
 import pandas as pd
 
+from corpus_manifest import CorpusManifest, file_bin
 
-def text_file_generator(
+CHUNK_SIZE = 1 << 24
+
+
+def text_file_paths(
         data_path: Path,
         rule: str,
-) -> Generator:
+        manifest: Optional[CorpusManifest] = None,
+        year: Union[int, str, None] = None,
+        bin_: Optional[str] = None,
+) -> list:
     if isinstance(data_path, str):
         data_path = Path(data_path)
 
     if not data_path.exists():
-        raise FileNotFoundError(f"Specified data path {str(data_path)} does not exist.")
+        raise FileNotFoundError(
+            f"Specified data path {str(data_path)} does not exist."
+        )
+
+    if manifest is not None:
+        files = [
+            (manifest.path(e), e['year'])
+            for e in manifest.select(rule, year, bin_)
+        ]
+    else:
+        paths = list(data_path.rglob(rule))
+        years = [re.findall(r'\d{4}', path.name)[0] for path in paths]
+        files = [
+            (path, y)
+            for path, y
+            in sorted(zip(paths, years), key=lambda x: x[1])
+            if (year is None or y == str(year))
+            and (bin_ is None or file_bin(path.name) == bin_)
+        ]
+
+    return files
 
-    paths = list(data_path.rglob(rule))
-    years = [re.findall(r'\d{4}', path.name)[0] for path in paths]
 
-    for path, year in sorted(zip(paths, years), key=lambda x: x[1]):
+def text_file_generator(
+        data_path: Path,
+        rule: str,
+        manifest: Optional[CorpusManifest] = None,
+        year: Union[int, str, None] = None,
+        bin_: Optional[str] = None,
+) -> Generator:
+    files = text_file_paths(
+        data_path, rule, manifest=manifest, year=year, bin_=bin_,
+    )
+
+    for path, year_ in files:
         text = path.read_text()
-        yield path, year, text
+        yield path, year_, text
+
+
+def scan_chunks(
+        path: Path,
+        chunk_size: int = CHUNK_SIZE,
+        margin: int = 0,
+) -> Generator:
+    """
+    Reads a text file in pieces of chunk_size characters.
+
+    Yields (offset, text, begin, end): text starts at character offset of the
+    file and text[begin:end] is the part owned by this chunk. Up to margin
+    characters of the neighbouring chunks are included on both sides, so a
+    match or context window that starts in the owned part and is shorter than
+    the margin is always complete. Owned parts cover the file exactly once.
+    """
+    with open(path) as fopen:
+        buffer = ''
+        offset = 0
+        begin = 0
+        eof = False
+
+        while True:
+            missing = begin + chunk_size + margin - len(buffer)
+            if missing > 0 and not eof:
+                data = fopen.read(missing)
+                eof = len(data) < missing
+                buffer += data
+
+            if eof and begin + chunk_size >= len(buffer):
+                yield offset, buffer, begin, len(buffer)
+                return
+
+            end = begin + chunk_size
+            yield offset, buffer, begin, end
+
+            cut = max(0, end - margin)
+            buffer = buffer[cut:]
+            offset += cut
+            begin = end - cut
+
+
+def ordered_map(
+        executor: Executor,
+        fn,
+        args,
+        lookahead: int,
+) -> Generator:
+    """
+    Like executor.map(fn, *zip(*args)), but only keeps lookahead calls in
+    flight and reads args lazily, so the consumer can stop early and later
+    arguments can depend on earlier results. Pending calls are cancelled when
+    the generator is closed.
+    """
+    args = iter(args)
+    pending = deque(executor.submit(fn, *a) for a in islice(args, lookahead))
+
+    try:
+        while pending:
+            result = pending.popleft().result()
+            for a in islice(args, 1):
+                pending.append(executor.submit(fn, *a))
+            yield result
+    finally:
+        for future in pending:
+            future.cancel()
 
 
 def read_word_list(file):
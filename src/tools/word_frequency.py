@@ -1,42 +1,27 @@
 import re
 from pathlib import Path
 import logging
-from typing import Generator
+import math
+import random
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import Generator, Optional
 
 import pandas as pd
 from pandas import DataFrame
 import nltk
 import click
 
-
-def text_file_generator(
-        data_path: Path,
-        rule: str,
-) -> Generator:
-    if isinstance(data_path, str):
-        data_path = Path(data_path)
-
-    if not data_path.exists():
-        raise FileNotFoundError(f"Specified data path {str(data_path)} does not exist.")
-
-    paths = list(data_path.rglob(rule))
-    years = [re.findall(r'\d{4}', path.name)[0] for path in paths]
-
-    for path, year in sorted(zip(paths, years), key=lambda x: x[1]):
-        text = path.read_text()
-        yield path, year, text
-
-
-def read_word_list(file):
-    data = pd.read_csv(str(file), header=None)
-    data.columns = 'word regex'.split()
-    data.dropna(inplace=True)
-    data.sort_values(by='word', inplace=True)
-
-    words = data['word']
-    regex = data['regex']
-
-    return {w.casefold(): r for w, r in zip(words, regex)}
+from corpus_index import CorpusIndex
+from corpus_manifest import CorpusManifest
+from frequency_cache import CACHE_NAME, FrequencyCache
+from metrics import metrics_options, start_metrics
+from ocr_variants import VariantCounter
+from storage import FORMATS, save_frame
+from term_counter import TermCounter, WORD_RE, is_token_pattern
+from utils import read_word_list, text_file_paths
 
 
 def retry(retries=10, timeout=5):
@@ -59,80 +44,441 @@ def retry(retries=10, timeout=5):
     return wraps
 
 
+STAGES = [
+    'get_frequency_by_year',
+    'estimate_frequency_by_year',
+    'count_files',
+    'count_indexed',
+    'count_file',
+    'save_frame',
+]
+
+_counter = TermCounter({})
+
+
+def compile_word_list(words: dict) -> dict:
+    return {
+        word: re.compile(regexpr, flags=re.IGNORECASE)
+        for word, regexpr
+        in words.items()
+    }
+
+
+def init_counter(words: dict, normalized: bool = False) -> None:
+    global _counter
+    counter_class = VariantCounter if normalized else TermCounter
+    _counter = counter_class(compile_word_list(words))
+
+
+def count_file(path: Path, terms: Optional[tuple] = None) -> dict:
+    """
+    Counts the words and the given terms (default all) of the word list set
+    up by init_counter in one file. All terms share one counter, so the
+    tokens it has seen are remembered whichever terms are counted.
+    """
+    row = {'file': path}
+    row.update(_counter.count_path(
+        path, terms=None if terms is None else set(terms),
+    ))
+
+    return row
+
+
+def log_slowest_patterns(
+        timings: Counter,
+        logger: logging.Logger,
+        n: int = 5,
+) -> None:
+    for term, seconds in timings.most_common(n):
+        logger.info(f'Pattern scan time {seconds:.2f} s: {term}')
+
+
 @retry(5, 1)
 def get_frequency(
         data: str,
         rule: str,
         wordlist: Path,
+        manifest: Optional[CorpusManifest] = None,
+        normalized: bool = False,
 ) -> DataFrame:
-    texts = text_file_generator(data, rule)
+    paths = text_file_paths(data, rule, manifest=manifest)
     words = read_word_list(wordlist)
-
-    regex = {
-        word: re.compile(regexpr, flags=re.IGNORECASE)
-        for word, regexpr
-        in words.items()
-    }
+    counter_class = VariantCounter if normalized else TermCounter
+    counter = counter_class(compile_word_list(words))
     rows = []
 
-    for file, _, text in texts:
-        row = {
-            'file': file,
-            'words': len(re.findall(r'\w+', text))
-        }
-        for w, r in regex.items():
-            row[w] = len(r.findall(text))
+    for file, _ in paths:
+        row = {'file': file}
+        row.update(counter.count_path(file))
         rows.append(row)
 
+    log_slowest_patterns(counter.timings, logging.getLogger(__name__))
+
     return pd.DataFrame(rows)
 
 
+def count_files(
+        paths: list,
+        words: dict,
+        manifest: CorpusManifest,
+        logger: logging.Logger,
+        workers: int = 1,
+        cache_file: Optional[Path] = None,
+        normalized: bool = False,
+) -> Generator:
+    """
+    Yields a row of word and term counts for each path, in order. Counts
+    found in the frequency cache are not recomputed. Normalized counts
+    are approximate and never cached.
+    """
+    columns = ['words', *words]
+    cache = None
+    if cache_file and not normalized:
+        cache = FrequencyCache(cache_file)
+    cached = [{} for _ in paths]
+    todo = list(range(len(paths)))
+
+    if cache is not None:
+        keys = cache.touch({'words': WORD_RE, **compile_word_list(words)})
+        for i, path in enumerate(paths):
+            counts = cache.get(manifest.hash_of(path))
+            cached[i] = {
+                column: counts[key] for column, key in keys.items()
+                if key in counts
+            }
+        todo = [
+            i for i, counts in enumerate(cached) if len(counts) < len(columns)
+        ]
+        logger.info(
+            f'{len(paths) - len(todo)} of {len(paths)} files fully covered '
+            'by the frequency cache'
+        )
+
+    # Only the terms missing from the cache are counted for each file.
+    todo_terms = [
+        tuple(t for t in words if t not in cached[i])
+        if cache is not None else None
+        for i in todo
+    ]
+    todo_paths = [paths[i] for i in todo]
+
+    if workers > 1:
+        logger.info(f'Counting {len(todo)} files with {workers} workers')
+        executor = ProcessPoolExecutor(
+            workers, initializer=init_counter, initargs=(words, normalized),
+        )
+        counted = executor.map(count_file, todo_paths, todo_terms)
+    else:
+        executor = None
+        init_counter(words, normalized)
+        counted = map(count_file, todo_paths, todo_terms)
+
+    try:
+        # Both map variants yield rows in submission order, so the rows come
+        # out in the same order as in a serial run.
+        counted_rows = zip(todo, counted)
+        next_todo, new = next(counted_rows, (None, None))
+
+        for i, path in enumerate(paths):
+            counts = cached[i]
+            if i == next_todo:
+                if cache is not None:
+                    cache.put(manifest.hash_of(path), {
+                        keys[t]: n for t, n in new.items() if t != 'file'
+                    })
+                    if i % 100 == 0:
+                        cache.commit()
+                counts = {**counts, **new}
+                next_todo, new = next(counted_rows, (None, None))
+
+            row = {'file': path}
+            row.update({column: counts[column] for column in columns})
+            yield row
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        else:
+            # timings of worker processes stay in the workers
+            log_slowest_patterns(_counter.timings, logger)
+        if cache is not None:
+            cache.evict(manifest.hashes())
+            cache.close()
+
+
+def count_indexed(
+        paths: list,
+        words: dict,
+        index: CorpusIndex,
+        data_path: Path,
+) -> Generator:
+    """
+    Same rows as count_files, with token patterns counted from the
+    positional index. Only patterns that can span tokens need the texts.
+    """
+    regex = compile_word_list(words)
+    token_regex = {t: r for t, r in regex.items() if is_token_pattern(r)}
+    text_terms = tuple(t for t in regex if t not in token_regex)
+    init_counter(words)
+
+    for path, counts in zip(paths, index.count(paths, data_path, token_regex)):
+        if text_terms:
+            counts.update(count_file(path, text_terms))
+
+        row = {'file': path}
+        row.update({column: counts[column] for column in ['words', *words]})
+        yield row
+
+
 @retry()
 def get_frequency_by_year(
         data,
         bins_file: Path,
         wordlist: Path,
         logger: logging.Logger,
+        manifest_file: Optional[Path] = None,
+        workers: int = 1,
+        cache_file: Optional[Path] = None,
+        index_file: Optional[Path] = None,
+        normalized: bool = False,
 ) -> DataFrame:
     frequencies = []
     bins = pd.read_csv(bins_file)
+    manifest = CorpusManifest.load(data, manifest_file)
+    words = read_word_list(wordlist)
 
-    for year, bin_ in bins.itertuples(index=False):
-        logger.info(f'Processing year {year}')
+    bins = [
+        (year, bin_, [
+            path for path, _
+            in text_file_paths(data, f"*_{bin_}_*.txt", manifest=manifest)
+        ])
+        for year, bin_
+        in bins.itertuples(index=False)
+    ]
+    paths = [path for _, _, files in bins for path in files]
 
-        freq = get_frequency(
-            data=data,
-            rule=f"*_{bin_}_*.txt",
-            wordlist=wordlist,
+    if index_file is not None and not normalized:
+        index = CorpusIndex.for_corpus(manifest, index_file)
+        rows = count_indexed(paths, words, index, manifest.data_path)
+    else:
+        rows = count_files(
+            paths, words, manifest, logger, workers, cache_file, normalized,
         )
 
-        if freq.empty:
-            continue
+    try:
+        for year, bin_, files in bins:
+            logger.info(f'Processing year {year}')
+
+            freq = pd.DataFrame([next(rows) for _ in files])
 
-        freq_sum = freq.drop(columns=['file']).sum()
-        freq_sum.name = bin_
-        freq_sum['year'] = year
-        frequencies.append(freq_sum)
+            if freq.empty:
+                continue
+
+            freq_sum = freq.drop(columns=['file']).sum()
+            freq_sum.name = bin_
+            freq_sum['year'] = year
+            frequencies.append(freq_sum)
+    finally:
+        rows.close()
 
     result = pd.concat(frequencies, axis=1).T
-    result = result.rename(columns=lambda w: w.replace(' ', '_') if w != 'Unnamed: 0' else w)
+    result = result.rename(
+        columns=lambda w: w.replace(' ', '_') if w != 'Unnamed: 0' else w
+    )
 
     return result
 
 
+def estimate_bin(
+        freq: DataFrame,
+        population: int,
+        confidence: float,
+) -> tuple:
+    """
+    Estimated absolute and relative frequencies of a bin from the counts of
+    a simple random sample of its files, with confidence interval half-widths.
+    Absolute totals are expansion estimates, relative frequencies ratio
+    estimates per 100 000 words.
+    """
+    n = len(freq)
+    words = freq['words']
+    terms = freq.drop(columns=['words'])
+
+    absolute = freq.mean() * population
+    ratio = terms.sum() / words.sum()
+    relative = ratio * 100_000
+
+    if n == population:
+        # every file was counted, the totals are exact
+        return absolute, absolute * 0.0, relative, relative * 0.0
+
+    # only the sampling mode needs scipy
+    from scipy import stats
+
+    fpc = math.sqrt((1 - n / population) / n)
+    quantile = stats.t.ppf((1 + confidence) / 2, n - 1) if n > 1 else math.nan
+
+    absolute_error = quantile * population * fpc * freq.std(ddof=1)
+
+    residuals = terms.sub(
+        words.to_numpy()[:, None] * ratio.to_numpy(), axis='columns'
+    )
+    relative_error = (
+        quantile * 100_000 * fpc * residuals.std(ddof=1) / words.mean()
+    )
+
+    return absolute, absolute_error, relative, relative_error
+
+
+def estimate_frequency_by_year(
+        data,
+        bins_file: Path,
+        wordlist: Path,
+        logger: logging.Logger,
+        sample: float,
+        seed: int = 0,
+        confidence: float = 0.95,
+        manifest_file: Optional[Path] = None,
+        workers: int = 1,
+        cache_file: Optional[Path] = None,
+        normalized: bool = False,
+) -> tuple:
+    """
+    Approximate get_frequency_by_year from a stratified sample: the given
+    fraction of the files of every bin, at least two. Returns absolute and
+    relative frequency tables with an _error column of confidence interval
+    half-widths for every column.
+    """
+    bins = pd.read_csv(bins_file)
+    manifest = CorpusManifest.load(data, manifest_file)
+    words = read_word_list(wordlist)
+    rng = random.Random(seed)
+
+    strata = []
+    for year, bin_ in bins.itertuples(index=False):
+        files = [
+            path for path, _
+            in text_file_paths(data, f"*_{bin_}_*.txt", manifest=manifest)
+        ]
+        size = min(len(files), max(2, math.ceil(sample * len(files))))
+        strata.append(
+            (year, bin_, len(files), sorted(rng.sample(files, size)))
+        )
+    paths = [path for _, _, _, files in strata for path in files]
+    logger.info(f'Counting a sample of {len(paths)} files')
+
+    rows = count_files(
+        paths, words, manifest, logger, workers, cache_file, normalized,
+    )
+    absolutes = []
+    relatives = []
+
+    try:
+        for year, bin_, population, files in strata:
+            logger.info(
+                f'Estimating year {year} from {len(files)} of {population} '
+                'files'
+            )
+
+            freq = pd.DataFrame([next(rows) for _ in files])
+
+            if freq.empty:
+                continue
+
+            freq = freq.drop(columns=['file'])
+            absolute, absolute_error, relative, relative_error = (
+                estimate_bin(freq, population, confidence)
+            )
+            absolute = pd.concat([
+                absolute, pd.Series({'year': year}),
+                absolute_error.add_suffix('_error'),
+            ])
+            relative = pd.concat([
+                relative, pd.Series({'year': year}),
+                relative_error.add_suffix('_error'),
+            ])
+            absolute.name = relative.name = bin_
+            absolutes.append(absolute)
+            relatives.append(relative)
+    finally:
+        rows.close()
+
+    result = []
+    for frequencies in absolutes, relatives:
+        frame = pd.concat(frequencies, axis=1).T
+        frame['year'] = frame['year'].astype(int)
+        result.append(frame.rename(columns=lambda w: w.replace(' ', '_')))
+
+    return tuple(result)
+
+
 @click.command()
 @click.argument('input_filepath', type=click.Path(exists=True))
 @click.argument('output_filepath', type=click.Path())
 @click.argument('wordlist_filepath', type=click.Path(exists=True))
 @click.argument('bins_filepath', type=click.Path(exists=True))
+@click.option(
+    '--manifest', type=click.Path(),
+    help='corpus manifest file, default is inside input directory',
+)
+@click.option(
+    '--workers', type=click.IntRange(1, None), default=1,
+    help='number of worker processes',
+)
+@click.option(
+    '--cache', type=click.Path(),
+    help='frequency cache file, default is inside input directory',
+)
+@click.option('--no-cache', is_flag=True, help='count every file from scratch')
+@click.option(
+    '--format', 'fmt', type=click.Choice(list(FORMATS)), default='csv',
+    help='output file format',
+)
+@click.option(
+    '--index', type=click.Path(),
+    help='positional index file, built or updated and used instead of the '
+         'cache',
+)
+@click.option(
+    '--normalized', is_flag=True,
+    help='match token terms by lookup of OCR-normalized spelling variants, '
+         'approximate',
+)
+@click.option(
+    '--sample', type=click.FloatRange(0, 1, min_open=True),
+    help='estimate from this fraction of the files of each bin, with error '
+         'columns',
+)
+@click.option(
+    '--seed', type=click.INT, default=0,
+    help='random seed of the file sample',
+)
+@click.option(
+    '--confidence',
+    type=click.FloatRange(0, 1, min_open=True, max_open=True), default=0.95,
+    help='confidence level of the sample error columns',
+)
+@metrics_options
 def main(
     input_filepath, 
     output_filepath, 
     wordlist_filepath,
     bins_filepath,
+    manifest,
+    workers,
+    cache,
+    no_cache,
+    fmt,
+    index,
+    normalized,
+    sample,
+    seed,
+    confidence,
+    profile,
+    metrics_file,
     ) -> None:
     """
-    Performs absolute and relative word frequency analysis and saves results in csv files
+    Performs absolute and relative word frequency analysis and saves results
+    in csv files
     """
     logger = logging.getLogger(__name__)
     input_fp = Path(input_filepath)
@@ -140,22 +486,58 @@ def main(
     output_fp.mkdir(exist_ok=True)
     wordlist_fp = Path(wordlist_filepath)
     bins_fp = Path(bins_filepath)
+    cache_fp = None
+    if not no_cache:
+        cache_fp = Path(cache) if cache else input_fp / CACHE_NAME
+    metrics = start_metrics(
+        sys.modules[__name__], STAGES, profile, metrics_file, logger,
+    )
     logger.info('Wordlist read')
 
+    if sample is not None:
+        absolutes, freq = estimate_frequency_by_year(
+            data=input_fp,
+            bins_file=bins_fp,
+            wordlist=wordlist_fp,
+            logger=logger,
+            sample=sample,
+            seed=seed,
+            confidence=confidence,
+            manifest_file=manifest,
+            workers=workers,
+            cache_file=cache_fp,
+            normalized=normalized,
+        )
+        abs_fp = save_frame(absolutes, output_fp / 'all_abs.csv', fmt)
+        logger.info(f'Saving estimated absolute frequencies to file {abs_fp}')
+        rel_fp = save_frame(freq, output_fp / 'all_rel.csv', fmt)
+        logger.info(f'Saving estimated relative frequencies to file {rel_fp}')
+        return
+
     absolutes = get_frequency_by_year(
         data=input_fp,
         bins_file=bins_fp,
         wordlist=wordlist_fp,
         logger=logger,
+        manifest_file=manifest,
+        workers=workers,
+        cache_file=cache_fp,
+        index_file=index,
+        normalized=normalized,
     )
     words = absolutes['words']
-    absolutes.to_csv(output_fp / 'all_abs.csv')
-    logger.info(f'Saving absolute frequencies to file {output_fp}/all_abs.csv')
+    if metrics is not None:
+        metrics.add_terms(
+            matches=absolutes.drop(columns=['year', 'words']).sum(),
+            seconds=_counter.timings,
+        )
+    abs_fp = save_frame(absolutes, output_fp / 'all_abs.csv', fmt)
+    logger.info(f'Saving absolute frequencies to file {abs_fp}')
     freq = absolutes.drop(columns=['year', 'words'])
     freq = freq[freq.columns].div(words, axis='index') * 100_000
     freq['year'] = absolutes['year']
-    logger.info(f'Saving relative frequencies to file {output_fp}/all_rel.csv')
-    freq.to_csv(output_fp / 'all_rel.csv')
+    rel_fp = save_frame(freq, output_fp / 'all_rel.csv', fmt)
+    logger.info(f'Saving relative frequencies to file {rel_fp}')
 
 
 if __name__ == '__main__':
@@ -1,12 +1,18 @@
 import os
 
-import pandas as pd
 import matplotlib.pyplot as plt
 import bokeh
 
+import tools_path  # noqa: F401
+from storage import load_frame
+
 
 if __name__ == '__main__':
-    data = pd.read_csv('../../data/processed/frequencies_riksdag_all.csv')
+    data = load_frame(
+        '../../data/processed/frequencies_riksdag_all.csv', index=False,
+    )
 
-    # data.plot.bar(title="Frequency / 100 000 words", x='year', figsize=(12, 6))
+    # data.plot.bar(
+    #     title="Frequency / 100 000 words", x='year', figsize=(12, 6)
+    # )
     # plt.savefig(fname='../../reports/figures/storfurste_freq')
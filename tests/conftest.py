@@ -0,0 +1,45 @@
+import random
+import sys
+from pathlib import Path
+
+import pytest
+
+# the tools import each other as top-level modules, the tests do the same
+TOOLS_DIR = Path(__file__).resolve().parent.parent / 'src' / 'tools'
+sys.path.insert(0, str(TOOLS_DIR))
+
+WORDS = {
+    'kansa': 'kans(a|o)',
+    'maa': 'maa',
+    'suomi': 'suom(i|e)',
+    'maan kansa': r'maan\skansa',
+}
+FILLER = 'ja on se ei hän kuin maan kansan suomen vuonna'.split()
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    """
+    A small binned corpus with a word list of token and text patterns.
+    """
+    rng = random.Random(0)
+    data = tmp_path / 'corpus'
+    data.mkdir()
+    bins = [(1850, '1850-1854'), (1855, '1855-1859'), (1860, '1860-1864')]
+
+    for _, bin_ in bins:
+        for i in range(3):
+            text = ' '.join(
+                rng.choice([*WORDS, 'Kanso', 'suome', *FILLER])
+                for _ in range(rng.randint(200, 2000))
+            )
+            (data / f'paper_{bin_}_{i}.txt').write_text(text)
+
+    bins_file = tmp_path / 'bins.csv'
+    bins_file.write_text(
+        'year,name\n' + ''.join(f'{y},{b}\n' for y, b in bins)
+    )
+    wordlist = tmp_path / 'words.csv'
+    wordlist.write_text(''.join(f'{w},{r}\n' for w, r in WORDS.items()))
+
+    return data, bins_file, wordlist
@@ -0,0 +1,162 @@
+import logging
+import random
+
+import pandas as pd
+import pytest
+
+import api_query
+
+LOGGER = logging.getLogger(__name__)
+TITLES = ['Suometar', 'Oulun Wiikko-Sanomia']
+WORDS = ['maa', 'ja', 'kansa']
+
+
+def make_hits(pages, rng):
+    return [
+        {
+            'corpus': f'KLK_FI_{1850 + page % 3}',
+            'structs': {
+                'text_publ_type': 'sanomalehti',
+                'text_binding_id': str(page // 4),
+                'text_page_no': str(page % 4),
+                'text_publ_title': rng.choice(TITLES),
+                'text_issue_date': f'01.01.{1850 + page % 3}',
+            },
+            'tokens': [{'word': w} for w in rng.choices(WORDS, k=5)],
+        }
+        for page in pages
+    ]
+
+
+@pytest.fixture
+def kwic_frames():
+    rng = random.Random(0)
+    lemma_pages = rng.sample(range(80), 50) + rng.sample(range(80), 5)
+    regex_pages = rng.sample(range(40, 120), 60)
+    return (
+        api_query.parse_kwic('maa', make_hits(lemma_pages, rng)),
+        api_query.parse_kwic('maa', make_hits(regex_pages, rng)),
+    )
+
+
+def baseline_kwic(word, hits):
+    """
+    The KWIC rows query built hit by hit before parse_kwic.
+    """
+    kwic = []
+    for hit in hits:
+        try:
+            context = ' '.join([w['word'] for w in hit['tokens']])
+        except TypeError:
+            context = ''
+        hit_data = hit.get('structs', dict())
+        text_type = hit_data.get('text_publ_type', None)
+        text_binding_id = hit_data.get('text_binding_id', None)
+        page = hit_data.get('text_page_no', 0)
+        year = hit_data.get('text_issue_date', '').split('.')[-1]
+        if len(year) != 4:
+            year = hit.get('corpus')[-4:]
+        kwic.append({
+            'publication': hit_data.get('text_publ_title', None),
+            'corpus': hit.get('corpus', None),
+            'context': context,
+            'url': f'{text_type}/binding/{text_binding_id}'
+                   f'?term={word}&page={page}',
+            'year': int(year),
+        })
+    return pd.DataFrame(kwic)
+
+
+def test_parse_kwic_matches_baseline():
+    hits = make_hits(range(30), random.Random(0))
+    hits[1]['tokens'] = None
+    hits[2]['structs']['text_issue_date'] = '1.1.51'
+    del hits[3]['structs']['text_page_no']
+    del hits[4]['structs']['text_publ_title']
+    del hits[5]['structs']
+    hits[6]['structs']['text_publ_title'] = 'Åbo Tidning'
+
+    parsed = api_query.parse_kwic('maa', hits)
+
+    expected = baseline_kwic('maa', hits)
+    assert list(parsed.columns) == list(expected.columns)
+    for column in ['publication', 'corpus']:
+        assert isinstance(parsed[column].dtype, pd.CategoricalDtype)
+    pd.testing.assert_frame_equal(
+        parsed.astype({'publication': object, 'corpus': object}),
+        expected.astype({'publication': object, 'corpus': object}),
+    )
+    assert api_query.parse_kwic('maa', []).empty
+
+
+def pages(data, size):
+    return (data.iloc[i:i + size] for i in range(0, len(data), size))
+
+
+@pytest.mark.parametrize('size', [1, 7, 100])
+def test_save_kwic_pages_matches_save_kwic(tmp_path, kwic_frames, size):
+    lemma, regex = kwic_frames
+    api_query.save_kwic('maa', lemma, regex, tmp_path, LOGGER)
+    paged = tmp_path / 'paged.csv'
+
+    written = api_query.save_kwic_pages(
+        'maa', pages(lemma, size), pages(regex, size), paged, LOGGER,
+    )
+
+    merged = pd.read_csv(tmp_path / 'maa.csv', index_col=0)
+    assert written == len(merged)
+    assert paged.read_text() == (tmp_path / 'maa.csv').read_text()
+
+
+def baseline_combine(lemma_df, regex_df):
+    """
+    combine_regex_and_lemma_df as it was before merge_kwic, for the case
+    where both sets have rows.
+    """
+    lemma_df = lemma_df.set_index('url')
+    regex_df = regex_df.set_index('url')
+
+    duplicates_idx = lemma_df.index.intersection(regex_df.index)
+    only_lemma_idx = lemma_df.index.difference(duplicates_idx)
+    only_regex_idx = regex_df.index.difference(duplicates_idx)
+
+    duplicates = lemma_df.loc[duplicates_idx].assign(type='both')
+    only_lemma = lemma_df.loc[only_lemma_idx].assign(type='lemma')
+    only_regex = regex_df.loc[only_regex_idx].assign(type='regex')
+
+    data = pd.concat([duplicates, only_regex, only_lemma])
+    data.reset_index(inplace=True)
+    return data.rename(columns={'index': 'url'})
+
+
+def as_rows(data):
+    data = data.astype({'publication': str, 'corpus': str, 'type': str})
+    return sorted(map(tuple, data[sorted(data.columns)].to_numpy().tolist()))
+
+
+def test_merge_kwic_rows_match_baseline(kwic_frames):
+    lemma, regex = (df.drop_duplicates('url') for df in kwic_frames)
+
+    merged = api_query.combine_regex_and_lemma_df(
+        lemma_df=lemma, regex_df=regex,
+    )
+
+    assert as_rows(merged) == as_rows(baseline_combine(lemma, regex))
+    # lemma rows in their order, then the regex-only rows in theirs
+    only_regex = regex[~regex['url'].isin(lemma['url'])]
+    assert merged['url'].tolist() == (
+        lemma['url'].tolist() + only_regex['url'].tolist()
+    )
+
+
+def test_merge_kwic_sources():
+    sets = {
+        name: pd.DataFrame({'url': urls, 'year': 1850})
+        for name, urls in [('a', ['x', 'y']), ('b', ['y', 'z']), ('c', ['z'])]
+    }
+
+    merged = api_query.merge_kwic(sets)
+
+    assert merged['url'].tolist() == ['x', 'y', 'z']
+    assert merged['sources'].tolist() == [0b001, 0b011, 0b110]
+    assert merged['type'].astype(str).tolist() == ['a', 'a+b', 'b+c']
@@ -0,0 +1,68 @@
+import re
+
+import kwic
+from corpus_index import CorpusIndex
+from corpus_manifest import CorpusManifest
+from term_counter import TermCounter, is_token_pattern
+
+from conftest import WORDS
+
+TOKEN_REGEX = {
+    w: re.compile(r, re.IGNORECASE) for w, r in WORDS.items()
+    if is_token_pattern(re.compile(r, re.IGNORECASE))
+}
+
+
+def test_count_matches_term_counter(tmp_path, corpus):
+    data, _, _ = corpus
+    manifest = CorpusManifest.load(data, tmp_path / 'manifest.json')
+    paths = sorted(data.glob('*.txt'))
+
+    index = CorpusIndex.for_corpus(manifest, tmp_path / 'index.sqlite')
+    counts = index.count(paths, data, TOKEN_REGEX)
+
+    counter = TermCounter(TOKEN_REGEX)
+    assert counts == [counter.count(path.read_text()) for path in paths]
+
+
+def test_find_contexts_matches_kwic(tmp_path):
+    data = tmp_path / 'corpus'
+    data.mkdir()
+    text = 'Här är maan kansa,\nmaa ja kansä; kanso Maa\n' * 40
+    (data / 'paper_1850_0.txt').write_text(text, encoding='utf-8')
+    manifest = CorpusManifest.load(data, tmp_path / 'manifest.json')
+    index = CorpusIndex(tmp_path / 'index.sqlite', encoding='utf-8')
+    index.update(manifest)
+    path = data / 'paper_1850_0.txt'
+
+    for term, regex in TOKEN_REGEX.items():
+        for window in (3, 20):
+            contexts = list(index.find_contexts(path, data, regex, window))
+            expected = kwic.find_contexts(path, {term: regex}, window)
+            assert contexts == [context for _, context in expected]
+
+
+def test_update_follows_the_corpus(tmp_path, corpus):
+    data, _, _ = corpus
+    manifest_file = tmp_path / 'manifest.json'
+    index_file = tmp_path / 'index.sqlite'
+    manifest = CorpusManifest.load(data, manifest_file)
+    CorpusIndex.for_corpus(manifest, index_file)
+
+    paths = sorted(data.glob('*.txt'))
+    paths[0].write_text('maa maa kansa')
+    paths[1].unlink()
+    (data / 'paper_1850-1854_9.txt').write_text('suomi suome')
+    manifest = CorpusManifest.load(data, manifest_file)
+
+    # the index is read back from the file and only the changes are added
+    index = CorpusIndex(index_file)
+    assert index.update(manifest) == 2
+    assert index.update(manifest) == 0
+
+    paths = sorted(data.glob('*.txt'))
+    counter = TermCounter(TOKEN_REGEX)
+    assert index.count(paths, data, TOKEN_REGEX) == [
+        counter.count(path.read_text()) for path in paths
+    ]
+    assert sorted(index.lookup('MAA')) == ['maa']
@@ -0,0 +1,65 @@
+import logging
+import re
+
+import word_frequency
+from corpus_manifest import CorpusManifest
+from frequency_cache import FrequencyCache, pattern_key
+from term_counter import WORD_RE
+from utils import read_word_list
+
+LOGGER = logging.getLogger(__name__)
+
+
+def test_round_trip(tmp_path):
+    path = tmp_path / 'cache.sqlite'
+    patterns = {'a': re.compile('a'), 'b': re.compile('b', re.IGNORECASE)}
+
+    cache = FrequencyCache(path)
+    keys = cache.touch(patterns)
+    cache.put('file1', {keys['a']: 3, keys['b']: 0})
+    cache.put('file2', {keys['a']: 5})
+    cache.close()
+
+    cache = FrequencyCache(path)
+    assert keys == {t: pattern_key(r) for t, r in patterns.items()}
+    assert cache.get('file1') == {keys['a']: 3, keys['b']: 0}
+    assert cache.get('missing') == {}
+    # same source, other flags, other key
+    assert pattern_key(re.compile('b')) != keys['b']
+
+    assert cache.evict(['file1']) == 1
+    assert cache.get('file2') == {}
+    # patterns not touched within max_age_days are dropped with their counts
+    assert cache.evict(['file1'], max_age_days=-1) == 2
+    assert cache.get('file1') == {}
+    cache.close()
+
+
+def test_count_files_with_partial_cache(tmp_path, corpus):
+    data, _, wordlist = corpus
+    manifest = CorpusManifest.load(data, tmp_path / 'manifest.json')
+    paths = sorted(data.glob('*.txt'))
+    words = read_word_list(wordlist)
+    first = dict(list(words.items())[:2])
+    cache_file = tmp_path / 'cache.sqlite'
+
+    fresh = list(word_frequency.count_files(paths, words, manifest, LOGGER))
+    # some files and terms are cached, the rest are counted
+    list(word_frequency.count_files(
+        paths[:4], first, manifest, LOGGER, cache_file=cache_file,
+    ))
+    for workers in (1, 2):
+        cached = list(word_frequency.count_files(
+            paths, words, manifest, LOGGER, workers=workers,
+            cache_file=cache_file,
+        ))
+        assert cached == fresh
+
+    cache = FrequencyCache(cache_file)
+    keys = cache.touch(
+        {'words': WORD_RE, **word_frequency.compile_word_list(words)}
+    )
+    for path, row in zip(paths, fresh):
+        counts = cache.get(manifest.hash_of(path))
+        assert counts == {key: row[t] for t, key in keys.items()}
+    cache.close()
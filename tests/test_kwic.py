@@ -0,0 +1,71 @@
+import inspect
+import re
+
+import pytest
+
+import kwic
+
+TEXT = 'a ' * 451 + 'b\n' + 'ab ' * 100 + 'a\na ' + 'a ' * 250
+
+
+def whole_text_contexts(text, regex_dict, window_size):
+    contexts = []
+    for w, r in regex_dict.items():
+        for m in r.finditer(text):
+            start = max(m.start() - window_size, 0)
+            end = min(m.end() + window_size, len(text) - 1)
+            contexts.append((w, text[start:end].replace('\n', ' ')))
+    return contexts
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 64, 99, 100, 1000, 5000])
+def test_find_contexts_matches_whole_text(tmp_path, monkeypatch, chunk_size):
+    path = tmp_path / 'text.txt'
+    path.write_text(TEXT)
+    regex_dict = {'pair': re.compile('a a'), 'spaced': re.compile(r'a\sa')}
+    # with a margin shorter than the run of a the search must continue
+    # from the previous chunk to keep the matches aligned
+    monkeypatch.setattr(kwic, 'MARGIN', 8)
+
+    contexts = kwic.find_contexts(path, regex_dict, 5, chunk_size=chunk_size)
+
+    assert sorted(contexts) == sorted(whole_text_contexts(TEXT, regex_dict, 5))
+
+
+class FailingTable:
+    def add(self, term, data):
+        raise RuntimeError('insert failed')
+
+
+def test_save_kwic_all_terms_closes_contexts_on_error(tmp_path, monkeypatch):
+    input_dir = tmp_path / 'corpus'
+    input_dir.mkdir()
+    for year in (1850, 1851):
+        (input_dir / f'text_{year}_0.txt').write_text(TEXT)
+    wordlist = tmp_path / 'words.csv'
+    wordlist.write_text('ab,ab\n')
+    generators = []
+    kwic_contexts_by_file = kwic.contexts_by_file
+
+    def contexts_by_file(*args, **kwargs):
+        generators.append(kwic_contexts_by_file(*args, **kwargs))
+        return generators[-1]
+
+    monkeypatch.setattr(kwic, 'contexts_by_file', contexts_by_file)
+
+    with pytest.raises(RuntimeError):
+        kwic.save_kwic_all_terms(
+            input_dir=input_dir,
+            output_dir=tmp_path / 'kwic',
+            rule='*.txt',
+            wordlist=wordlist,
+            window_size=5,
+            size_limit=1_000,
+            word_filter_rule='all',
+            manifest_file=tmp_path / 'manifest.json',
+            table=FailingTable(),
+        )
+
+    assert [inspect.getgeneratorstate(g) for g in generators] == [
+        inspect.GEN_CLOSED,
+    ]
@@ -0,0 +1,116 @@
+import pandas as pd
+from sqlalchemy import create_engine, inspect
+
+from kwic_database import KwicTable, size_limits
+
+TYPES = ['lemma', 'regex', 'both']
+
+
+def rows(years, word='kansa', types=None):
+    return pd.DataFrame({
+        'year': years,
+        'kwic': [f'{word} {year}' for year in years],
+        'type': types or ['both'] * len(years),
+    })
+
+
+def read_table(database_url, table):
+    engine = create_engine(database_url)
+    with engine.connect() as connection:
+        data = pd.read_sql_table(table, connection)
+    engine.dispose()
+    return data.sort_values(['term', 'year'], ignore_index=True)
+
+
+def test_rows_are_batched(tmp_path):
+    url = f"sqlite:///{tmp_path / 'kwic.sqlite'}"
+    table = KwicTable(url, 'kwic', batch_size=4)
+
+    table.add('kansa', rows([1850, 1851, 1852], 'kansa', TYPES))
+    assert table.rows == 0
+    table.add('maa', rows([1853, 1854], 'maa', TYPES[:2]))
+    # the batch is full
+    assert table.rows == 5
+    table.add('maa', rows([1855], 'maa'))
+    table.close()
+
+    data = read_table(url, 'kwic')
+    assert data['term'].tolist() == ['kansa'] * 3 + ['maa'] * 3
+    assert data['year'].tolist() == list(range(1850, 1856))
+    assert data['lemma'].astype(bool).tolist() == \
+        [True, False, True, True, False, True]
+    assert data['regex'].astype(bool).tolist() == \
+        [False, True, True, False, True, True]
+    assert 'type' not in data.columns
+
+
+def test_size_limit_keeps_earliest_years(tmp_path):
+    url = f"sqlite:///{tmp_path / 'kwic.sqlite'}"
+    table = KwicTable(url, 'kwic', size_limit=size_limits(3))
+
+    table.add('kansa', rows([1860, 1851, 1870]))
+    table.add('kansa', rows([1850, 1880, 1855]))
+    # held until the term is finished
+    table.flush()
+    assert table.rows == 0
+    table.finish('kansa')
+    table.add('fred', rows(list(range(1900, 1905)), 'fred'))
+    table.close()
+
+    data = read_table(url, 'kwic')
+    assert data.loc[data['term'] == 'kansa', 'year'].tolist() == \
+        [1850, 1851, 1855]
+    # fred has a higher limit
+    assert (data['term'] == 'fred').sum() == 5
+
+
+def test_resume_replaces_interrupted_term(tmp_path):
+    url = f"sqlite:///{tmp_path / 'kwic.sqlite'}"
+    table = KwicTable(url, 'kwic')
+    table.add('kansa', rows([1850, 1851]))
+    table.add('maa', rows([1850], 'maa'))
+    table.close()
+
+    # the run is resumed, kansa is done again from the start
+    table = KwicTable(url, 'kwic', replace=False)
+    table.add('kansa', rows([1850, 1851]))
+    table.add('kansa', rows([1852]))
+    table.close()
+
+    data = read_table(url, 'kwic')
+    assert data['term'].tolist() == ['kansa'] * 3 + ['maa']
+    assert data['year'].tolist() == [1850, 1851, 1852, 1850]
+
+    # replace drops the old rows
+    table = KwicTable(url, 'kwic')
+    table.add('suomi', rows([1860], 'suomi'))
+    table.close()
+    assert read_table(url, 'kwic')['term'].tolist() == ['suomi']
+
+
+def test_quoted_table_and_index(tmp_path):
+    url = f"sqlite:///{tmp_path / 'kwic.sqlite'}"
+    name = 'kwic "fi"; DROP TABLE other'
+    engine = create_engine(url)
+    pd.DataFrame({'a': [1]}).to_sql('other', engine, index=False)
+    engine.dispose()
+
+    table = KwicTable(url, name, replace=False)
+    # no rows, no index
+    table.create_index()
+    table.add('kansa', rows([1850]))
+    table.close()
+    table = KwicTable(url, name, replace=False)
+    table.add('kansa', rows([1851]))
+    table.flush()
+    table.create_index()
+    table.close()
+
+    assert read_table(url, name)['year'].tolist() == [1851]
+    # a new engine, the old one may not see the tables made since
+    engine = create_engine(url)
+    indexes = inspect(engine).get_indexes(name)
+    assert [(i['name'], i['column_names']) for i in indexes] == \
+        [(f'{name}_index', ['term', 'year'])]
+    assert inspect(engine).has_table('other')
+    engine.dispose()
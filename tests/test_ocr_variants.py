@@ -0,0 +1,39 @@
+import re
+from collections import Counter
+
+import pytest
+
+from ocr_variants import VariantCounter, expand_pattern, normalize
+from term_counter import TermCounter
+
+
+def test_expand_pattern():
+    assert expand_pattern(re.compile('ko(i|j)ra')) == {'koira', 'kojra'}
+    assert expand_pattern(re.compile('kis+a')) == {'kisa', 'kis:a'}
+    assert expand_pattern(re.compile('k.ira')) is None
+
+
+@pytest.mark.parametrize(
+    'pattern', [r'\bkoira', r'koira\b', r'^koira', r'koira$', r'\Bira'],
+)
+def test_anchors_are_not_expanded(pattern):
+    assert expand_pattern(re.compile(pattern)) is None
+
+
+@pytest.mark.parametrize('pattern', [r'\bkoira', r'koira\b', r'\bkoira\b'])
+def test_anchored_patterns_are_scanned(pattern):
+    regex = {'term': re.compile(pattern, flags=re.IGNORECASE)}
+    tokens = Counter(
+        {'koira': 3, 'Koiranen': 2, 'vesikoira': 5, 'koirakoira': 1}
+    )
+
+    counter = VariantCounter(regex)
+
+    assert [t for t, _ in counter.scanned_patterns] == ['term']
+    exact = TermCounter(regex)
+    assert counter.count_tokens(tokens) == exact.count_tokens(tokens)
+
+
+def test_normalize():
+    assert normalize('Aiheuttaa') == normalize('aiheutttaaa')
+    assert normalize('aiheutaa') != normalize('aiheuttaa')
@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+
+from query_journal import QueryJournal, settings_key
+
+
+def test_round_trip(tmp_path):
+    path = tmp_path / 'journal.sqlite'
+    key = settings_key(corpus='KLK_FI', start=1820, end=1920)
+    lemma = pd.Series({1850: 3, 1851: 0, 1852: 7})
+    regex = pd.Series({1850: 4.0, 1851: np.nan, 1852: 9.0})
+
+    journal = QueryJournal(path, key)
+    assert journal.completed() == {}
+    journal.add('kansa', lemma, regex, tmp_path / 'kansa.csv')
+    journal.close()
+
+    journal = QueryJournal(path, key)
+    completed = journal.completed()
+    assert list(completed) == ['kansa']
+    pd.testing.assert_series_equal(completed['kansa'][0], lemma)
+    pd.testing.assert_series_equal(completed['kansa'][1], regex)
+    # a word done again replaces the old entry
+    journal.add('kansa', lemma * 2, regex)
+    pd.testing.assert_series_equal(
+        journal.completed()['kansa'][0], lemma * 2,
+    )
+    journal.close()
+
+    # other settings start from scratch
+    other = settings_key(corpus='KLK_FI', start=1820, end=1900)
+    assert other != key
+    journal = QueryJournal(path, other)
+    assert journal.completed() == {}
+    journal.close()
+    journal = QueryJournal(path, key)
+    assert journal.completed() == {}
+
+    journal.delete()
+    assert not path.exists()
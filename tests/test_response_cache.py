@@ -0,0 +1,99 @@
+import itertools
+
+import response_cache
+from response_cache import ResponseCache, normalize_params, request_key
+
+URL = 'https://korp.example/korp/'
+PARAMS = {
+    'command': 'query',
+    'cqp': '[word = "kansa"]',
+    'corpus': 'klk_fi_1850,KLK_FI_1849',
+    'start': 0,
+    'end': 99,
+}
+
+
+def test_normalize_params():
+    params = normalize_params({
+        **PARAMS,
+        'show_struct': ' text_url, text_date ',
+        'subcqp1': '[lemma = "kansa"]',
+        'cache': 'no',
+    })
+
+    assert params == {
+        'command': 'query',
+        'cqp': '[word = "kansa"]',
+        'corpus': 'KLK_FI_1849,KLK_FI_1850',
+        'start': '0',
+        'end': '99',
+        'show_struct': 'text_date,text_url',
+        'subcqp1': '[lemma = "kansa"]',
+    }
+    # corpus order and case, the url's slash and ignored parameters do not
+    # change the key, the query does
+    same = {**PARAMS, 'corpus': 'KLK_FI_1849, klk_fi_1850', 'cache': 'no'}
+    assert request_key(URL, PARAMS) == request_key(URL.rstrip('/'), same)
+    assert request_key(URL, PARAMS) != request_key(
+        URL, {**PARAMS, 'cqp': '[word = "maa"]'},
+    )
+
+
+def test_round_trip(tmp_path):
+    path = tmp_path / 'cache.sqlite'
+    result = {'hits': 1, 'kwic': [{'tokens': [{'word': 'kansa'}]}]}
+
+    cache = ResponseCache(path)
+    assert cache.get(URL, PARAMS) is None
+    cache.put(URL, PARAMS, result)
+    cache.close()
+
+    cache = ResponseCache(path)
+    assert cache.get(URL, {**PARAMS, 'corpus': 'KLK_FI_1849,KLK_FI_1850'}) \
+        == result
+    assert cache.get(URL, {**PARAMS, 'start': 100}) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.close()
+
+    # with refresh the stored response is not read, but is replaced
+    cache = ResponseCache(path, refresh=True)
+    assert cache.get(URL, PARAMS) is None
+    cache.put(URL, PARAMS, {'hits': 2})
+    cache.close()
+
+    cache = ResponseCache(path)
+    assert cache.get(URL, PARAMS) == {'hits': 2}
+    cache.close()
+
+    # responses older than max_age_days are not used
+    cache = ResponseCache(path, max_age_days=-1)
+    assert cache.get(URL, PARAMS) is None
+    cache.close()
+
+
+def test_evict(tmp_path, monkeypatch):
+    clock = itertools.count(1_000_000)
+    monkeypatch.setattr(response_cache.time, 'time', lambda: next(clock))
+    cache = ResponseCache(tmp_path / 'cache.sqlite')
+    queries = [{**PARAMS, 'cqp': f'[word = "w{i}"]'} for i in range(3)]
+    for i, query in enumerate(queries):
+        cache.put(URL, query, {'text': str(i) * 1_000})
+    # the first response is used, the second is now the least recently used
+    cache.get(URL, queries[0])
+    sizes = dict(cache.connection.execute(
+        "SELECT key, size FROM responses"
+    ).fetchall())
+    keep = sizes[request_key(URL, queries[0])] + \
+        sizes[request_key(URL, queries[2])]
+
+    assert cache.evict() == 0
+    assert cache.evict(max_megabytes=keep / 1e6) == 1
+    assert cache.get(URL, queries[1]) is None
+    assert cache.get(URL, queries[0]) is not None
+    assert cache.get(URL, queries[2]) is not None
+
+    cache.max_age_days = -1
+    assert cache.evict() == 2
+    cache.max_age_days = None
+    assert cache.get(URL, queries[0]) is None
+    cache.close()
@@ -0,0 +1,114 @@
+import random
+import re
+from pathlib import Path
+
+import pytest
+
+from term_counter import TermCounter, is_token_pattern, scan_vocabulary
+from utils import read_word_list
+
+WORDLISTS = Path(__file__).resolve().parent.parent / 'wordlists'
+
+TEXT = 'a ' * 451 + 'b\n' + 'ab ' * 100 + 'a\na ' + 'a ' * 250
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 64, 99, 100, 1000, 5000])
+def test_count_path_matches_whole_text(tmp_path, chunk_size):
+    path = tmp_path / 'text.txt'
+    path.write_text(TEXT)
+    regex = {
+        'ab': re.compile('ab'),
+        'pair': re.compile('a a'),
+        'spaced': re.compile(r'a\sa'),
+    }
+    counter = TermCounter(regex)
+    # with a margin shorter than the run of a the search must continue
+    # from the previous chunk to keep the matches aligned
+    counter.margin = 8
+
+    counts = counter.count_path(path, chunk_size=chunk_size)
+
+    assert counts == counter.count(TEXT)
+    assert counts['pair'] == len(regex['pair'].findall(TEXT))
+
+
+@pytest.mark.parametrize('terms', [{'ab'}, {'pair'}, {'ab', 'spaced'}, set()])
+def test_count_path_terms(tmp_path, terms):
+    path = tmp_path / 'text.txt'
+    path.write_text(TEXT)
+    regex = {
+        'ab': re.compile('ab'),
+        'b': re.compile('b'),
+        'pair': re.compile('a a'),
+        'spaced': re.compile(r'a\sa'),
+    }
+    counter = TermCounter(regex)
+    counts = counter.count(TEXT)
+
+    # one counter serves every subset, in any order
+    for subset in (terms, None, terms):
+        expected = counts if subset is None else {
+            term: n for term, n in counts.items()
+            if term in subset or term == 'words'
+        }
+        assert counter.count_path(path, terms=subset) == expected
+
+
+def misread(word, rng):
+    confusions = {'e': 'c', 's': 'f', 'a': 'o', 'n': 'u', 'm': 'w', 'i': 'j'}
+    return ''.join(
+        confusions.get(c, c) if rng.random() < 0.2 else c for c in word
+    )
+
+
+@pytest.mark.parametrize('wordlist', [
+    'wordlist_sv_riksdag.csv',
+    'wordlist_fi_newspapers.csv',
+])
+def test_count_matches_baseline(wordlist):
+    words = read_word_list(WORDLISTS / wordlist)
+    regex = {
+        word: re.compile(pattern, flags=re.IGNORECASE)
+        for word, pattern in words.items()
+    }
+    rng = random.Random(0)
+    parts = []
+    for word in words:
+        parts += [misread(word, rng), word.upper(), f'{word}ens', 'och']
+    rng.shuffle(parts)
+    text = ' '.join(parts)
+
+    counts = TermCounter(regex).count(text)
+
+    # as the baseline get_frequency counted every term
+    assert counts['words'] == len(re.findall(r'\w+', text))
+    for word, r in regex.items():
+        assert counts[word] == len(r.findall(text)), word
+
+
+def test_scan_vocabulary_matches_each_token():
+    rng = random.Random(0)
+    # characters with case variants outside of plain lower and upper case
+    alphabet = 'abcksSKiI\u017f\u0130\u0131\u212a\u00df\u1e9e\u00e4\u00c49_'
+    tokens = list(dict.fromkeys(
+        ''.join(rng.choices(alphabet, k=rng.randint(1, 8)))
+        for _ in range(2000)
+    ))
+    patterns = [
+        's', 'k', '[sk]i', '(?-i:s)k', 'is+k', '(a|b)+c', 'a(b|c|)s', 'ss',
+        '\u00df', 'i{2,3}', '[^s]k', '\\d[ab]', '(?a:k)s', '[a-c]s',
+    ]
+
+    for flags in (0, re.IGNORECASE, re.IGNORECASE | re.ASCII):
+        regex = {p: re.compile(p, flags) for p in patterns}
+        regex = {p: r for p, r in regex.items() if is_token_pattern(r)}
+        expected = {
+            p: {
+                i: [m.span() for m in r.finditer(token)]
+                for i, token in enumerate(tokens)
+                if r.search(token)
+            }
+            for p, r in regex.items()
+        }
+
+        assert scan_vocabulary(tokens, regex) == expected
@@ -0,0 +1,144 @@
+import pytest
+import requests
+from requests.exceptions import ConnectionError, HTTPError
+
+import transport
+from transport import CircuitBreaker, CircuitOpenError, RetryBudget, Transport
+
+URL = 'https://korp.example/korp/'
+
+
+def make_response(status: int, body: bytes = b'{}', headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response._content = body
+    response.url = URL
+    response.headers.update(headers or {})
+    return response
+
+
+class FakeSession:
+    """
+    Gives the planned responses in order, exceptions are raised.
+    """
+
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+    monkeypatch.setattr(transport.time, 'sleep', delays.append)
+    return delays
+
+
+def fake_transport(outcomes, **kwargs):
+    client = Transport(**kwargs)
+    client.session = FakeSession(outcomes)
+    return client
+
+
+def test_retries_until_success(sleeps):
+    client = fake_transport(
+        [
+            ConnectionError('refused'),
+            make_response(503),
+            make_response(200, b'{"hits": 3}'),
+        ],
+        backoff=0.01,
+    )
+
+    assert client.get_json(URL) == {'hits': 3}
+    assert client.session.calls == 3
+    assert len(sleeps) == 2
+
+
+def test_errors_are_raised(sleeps):
+    # other error statuses are not retried
+    client = fake_transport([make_response(404)])
+    with pytest.raises(HTTPError):
+        client.get(URL)
+    assert client.session.calls == 1
+
+    # the last error is raised when the retries run out
+    client = fake_transport([make_response(503)] * 3, retries=2)
+    with pytest.raises(HTTPError):
+        client.get(URL)
+    assert client.session.calls == 3
+
+
+def test_retry_budget(sleeps):
+    budget = RetryBudget(ratio=0, reserve=1)
+    client = fake_transport(
+        [ConnectionError('refused')] * 4, budget=budget, max_failures=10,
+    )
+
+    with pytest.raises(ConnectionError):
+        client.get(URL)
+    # one retry in the budget, none left for the next request
+    assert client.session.calls == 2
+    with pytest.raises(ConnectionError):
+        client.get(URL)
+    assert client.session.calls == 3
+
+
+def test_retry_after(sleeps):
+    client = fake_transport([], backoff=0.01, max_backoff=60)
+    response = make_response(429, headers={'Retry-After': '30'})
+
+    assert client.delay(0, response) == 30
+    assert client.delay(0, make_response(429)) <= 0.01
+    # the server's delay is capped too
+    client.max_backoff = 10
+    assert client.delay(0, response) == 10
+
+
+def test_circuit_breaker(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(transport.time, 'monotonic', lambda: now[0])
+    breaker = CircuitBreaker(max_failures=2, reset_seconds=60)
+
+    breaker.failure()
+    breaker.check('host')
+    breaker.failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.check('host')
+
+    # after reset_seconds one trial is let through, a failed trial opens the
+    # circuit again
+    now[0] = 61
+    breaker.check('host')
+    with pytest.raises(CircuitOpenError):
+        breaker.check('host')
+    breaker.failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.check('host')
+
+    # a successful trial closes it
+    now[0] = 122
+    breaker.check('host')
+    breaker.success()
+    breaker.check('host')
+    breaker.check('host')
+
+
+def test_open_circuit_stops_requests(sleeps):
+    client = fake_transport(
+        [make_response(503)] * 5, retries=5, max_failures=2,
+    )
+
+    with pytest.raises(CircuitOpenError):
+        client.get(URL)
+    assert client.session.calls == 2
+    # other hosts have their own circuit
+    client.session.outcomes = [make_response(200)]
+    assert client.get('https://other.example/').status_code == 200
@@ -0,0 +1,41 @@
+import logging
+import re
+
+import pandas as pd
+import pytest
+
+import word_frequency
+from conftest import WORDS
+
+LOGGER = logging.getLogger(__name__)
+
+
+def expected_frequencies(data, bins_file):
+    rows = {}
+    for year, bin_ in pd.read_csv(bins_file).itertuples(index=False):
+        row = dict.fromkeys(['words', *WORDS], 0)
+        for path in data.glob(f'*_{bin_}_*.txt'):
+            text = path.read_text()
+            row['words'] += len(re.findall(r'\w+', text))
+            for word, pattern in WORDS.items():
+                row[word] += len(re.findall(pattern, text, re.IGNORECASE))
+        row['year'] = year
+        rows[bin_] = row
+    return pd.DataFrame.from_dict(rows, orient='index')
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_get_frequency_by_year(tmp_path, corpus, workers):
+    data, bins_file, wordlist = corpus
+
+    result = word_frequency.get_frequency_by_year(
+        data, bins_file, wordlist, LOGGER,
+        manifest_file=tmp_path / 'manifest.json', workers=workers,
+    )
+
+    expected = expected_frequencies(data, bins_file)
+    expected.columns = [c.replace(' ', '_') for c in expected.columns]
+    assert sorted(result.columns) == sorted(expected.columns)
+    pd.testing.assert_frame_equal(
+        result.astype(int), expected[result.columns], check_names=False,
+    )